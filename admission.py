@@ -0,0 +1,238 @@
+import os
+import time
+import math
+import threading
+import itertools
+from collections import OrderedDict, deque
+import metrics
+
+# 进程级准入控制：所有 Streamlit 会话共享同一组槽位
+# - CPU：同时解码/重编码的图片数不超过 CPU_SLOTS，空出的槽位按会话轮转分配，一个会话的 30 张图不会独占
+# - LLM：并发请求数上限 + 每分钟 token 速率 (令牌桶)，超出时排队而不是一起打到上游
+# 排队中的调用方通过当前线程绑定的回调收到 (队列名, 第几位, 预计等待秒数)，用于界面提示
+
+CPU_SLOTS = int(os.getenv("CPU_SLOTS", "0")) or max(1, min(os.cpu_count() or 1, 4))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+# 0 表示不限速
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+# 预扣时为输出预留的 token 数，调用结束后按实际用量多退少补
+COMPLETION_RESERVE_TOKENS = 2000
+
+# 排队时刷新位置提示的间隔
+WAIT_POLL_SECONDS = 0.5
+# 槽位占用时长的指数滑动平均系数 (用于估算等待时间)
+HOLD_SMOOTHING = 0.2
+
+DEFAULT_SESSION = "default"
+
+_local = threading.local()
+
+
+# --- 当前线程的会话与排队提示回调 ---
+def bind(session, waiter=None):
+    """
+    waiter(name, position, eta)：排队期间周期调用；position 为 None 表示已获得槽位
+    """
+    _local.session = session
+    _local.waiter = waiter
+
+def unbind():
+    _local.session = None
+    _local.waiter = None
+
+def current_session():
+    return getattr(_local, "session", None) or DEFAULT_SESSION
+
+def _notify(name, position, eta):
+    waiter = getattr(_local, "waiter", None)
+    if waiter is not None:
+        waiter(name, position, eta)
+
+
+class FairQueue:
+    """
+    计数信号量 + 按会话轮转的等待队列：槽位空出时依次分给下一个会话最早的请求
+    """
+    def __init__(self, slots, name):
+        self.slots = slots
+        self.name = name
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = OrderedDict()
+        self._granted = set()
+        self._tickets = itertools.count()
+        self._hold = None
+
+    def acquire(self, session=None):
+        """
+        阻塞直到获得槽位，返回获得时刻 (传给 release 用于统计占用时长)
+        """
+        session = session or current_session()
+        t = time.monotonic()
+        with self._cond:
+            if self._active < self.slots and not self._waiting:
+                self._active += 1
+                metrics.add(f"{self.name}排队", 0.0)
+                return t
+            ticket = next(self._tickets)
+            self._waiting.setdefault(session, deque()).append(ticket)
+            position, eta = self._estimate(session, ticket)
+        try:
+            while True:
+                _notify(self.name, position, eta)
+                with self._cond:
+                    if ticket not in self._granted:
+                        self._cond.wait(WAIT_POLL_SECONDS)
+                    if ticket in self._granted:
+                        self._granted.remove(ticket)
+                        break
+                    position, eta = self._estimate(session, ticket)
+        except BaseException:
+            # 排队时被中断 (如用户重跑脚本)：退出队列，已分到的槽位还回去
+            self._cancel(session, ticket)
+            raise
+        started = time.monotonic()
+        metrics.add(f"{self.name}排队", started - t)
+        _notify(self.name, None, None)
+        return started
+
+    def release(self, started=None):
+        with self._cond:
+            if started is not None:
+                held = time.monotonic() - started
+                self._hold = held if self._hold is None else self._hold + HOLD_SMOOTHING * (held - self._hold)
+            if self._waiting:
+                self._grant_next()
+            else:
+                self._active -= 1
+
+    def _grant_next(self):
+        # 槽位直接转交给下一个会话，_active 不变
+        session, tickets = next(iter(self._waiting.items()))
+        self._granted.add(tickets.popleft())
+        if tickets:
+            self._waiting.move_to_end(session)
+        else:
+            del self._waiting[session]
+        self._cond.notify_all()
+
+    def _cancel(self, session, ticket):
+        with self._cond:
+            if ticket in self._granted:
+                self._granted.remove(ticket)
+                if self._waiting:
+                    self._grant_next()
+                else:
+                    self._active -= 1
+                return
+            tickets = self._waiting.get(session)
+            if tickets is not None and ticket in tickets:
+                tickets.remove(ticket)
+                if not tickets:
+                    del self._waiting[session]
+
+    def _estimate(self, session, ticket):
+        """
+        按轮转顺序推算排在前面的请求数：每轮每个会话各放行一个
+        返回 (第几位, 预计等待秒数)；尚无占用时长样本时等待为 None
+        """
+        sessions = list(self._waiting)
+        rank = self._waiting[session].index(ticket)
+        order = sessions.index(session)
+        ahead = 0
+        for i, other in enumerate(sessions):
+            n = len(self._waiting[other])
+            ahead += min(n, rank) + (1 if i < order and n > rank else 0)
+        eta = None if self._hold is None else math.ceil((ahead + 1) / self.slots) * self._hold
+        return ahead + 1, eta
+
+    def stats(self):
+        with self._cond:
+            return {
+                "slots": self.slots, "active": self._active,
+                "waiting": sum(len(q) for q in self._waiting.values()), "sessions": len(self._waiting),
+            }
+
+
+class TokenBucket:
+    """
+    每分钟 token 配额：预扣可以透支，透支部分按速率折算成需要等待的秒数
+    """
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self._tokens = float(per_minute)
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._t) * self.rate)
+        self._t = now
+
+    def reserve(self, tokens):
+        """
+        预扣 tokens，返回需要等待的秒数 (0 表示可立即发送)
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= min(tokens, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+    def adjust(self, tokens):
+        # 正数为补扣，负数为退还
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - tokens)
+
+
+class Grant:
+    """
+    一次模型调用占用的并发槽位与 token 预扣；release 可重复调用
+    """
+    def __init__(self, started, reserved):
+        self.started = started
+        self.reserved = reserved
+        self._released = False
+        self._lock = threading.Lock()
+
+    def settle(self, usage):
+        total = getattr(usage, "total_tokens", None)
+        if total and token_bucket is not None:
+            token_bucket.adjust(total - self.reserved)
+            self.reserved = total
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        llm_queue.release(self.started)
+
+
+def _reserve(tokens):
+    reserved = tokens + COMPLETION_RESERVE_TOKENS
+    wait = token_bucket.reserve(reserved) if token_bucket is not None else 0.0
+    return reserved, wait
+
+def admit_llm(tokens, session=None):
+    """
+    模型调用准入：先公平排队取得并发槽位，再按预估 token 预扣速率配额 (超额时在此等待)
+    """
+    started = llm_queue.acquire(session)
+    try:
+        reserved, wait = _reserve(tokens)
+        if wait > 0:
+            _notify("模型限速", 0, wait)
+            metrics.add("模型限速等待", wait)
+            time.sleep(wait)
+            _notify("模型限速", None, None)
+    except BaseException:
+        llm_queue.release(started)
+        raise
+    return Grant(started, reserved)
+
+
+cpu_queue = FairQueue(CPU_SLOTS, "图像处理")
+llm_queue = FairQueue(LLM_MAX_CONCURRENCY, "模型调用")
+token_bucket = TokenBucket(LLM_TOKENS_PER_MINUTE) if LLM_TOKENS_PER_MINUTE > 0 else None
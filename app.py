@@ -1,16 +1,20 @@
 import streamlit as st
-from openai import OpenAI
-from PIL import Image
-import io
-import base64
-import re
 import os
-import json
+import uuid
 import pandas as pd
-from datetime import datetime
 from dotenv import load_dotenv
-import gspread
-from google.oauth2.service_account import Credentials
+from imaging import image_cache, parse_file_info, capture_info
+from pipeline import normalize_data, prepare_strength, assemble_payload, RESPONSE_SCHEMA, build_system_prompt
+from pipeline import report_date_for, file_digests, delta_sections, delta_messages, merge_delta
+from schema import SECTION_KEYS
+import llm
+import sheets
+import metrics
+import transport
+import admission
+from history import history_store, schedule_sync
+import training
+from llm import extract_json_from_response
 
 # 0. 环境配置
 load_dotenv()
@@ -32,350 +36,311 @@ else:
     sheet_status = "⚠️ 未配置 Google Sheet URL"
 
 # 1. 核心工具函数
-def smart_process_image(uploaded_file):
-    uploaded_file.seek(0)
-    file_bytes = uploaded_file.getvalue()
-    if len(file_bytes) / 1024 < 500:
-        return file_bytes, "image/jpeg"
-
-    image = Image.open(uploaded_file)
-    if image.mode in ("RGBA", "P"):
-        image = image.convert("RGB")
-        
-    filename = uploaded_file.name
-    is_screenshot = any(k in filename for k in ["Screenshot", "SHealth", "ReactNative", "屏幕截图"])
-    
-    buffer = io.BytesIO()
-    if is_screenshot:
-        image.save(buffer, format="JPEG", quality=95)
-    else:
-        target_width = 2048
-        if image.width > target_width:
-            ratio = target_width / image.width
-            new_height = int(image.height * ratio)
-            image = image.resize((target_width, new_height), Image.Resampling.LANCZOS)
-        image.save(buffer, format="JPEG", quality=75)
-    return buffer.getvalue(), "image/jpeg"
-
-def parse_file_info(filename):
-    """
-    文件名解析逻辑
-    """
-    # 1. 显式关键字匹配
-    if "ReactNative" in filename or "Screenshot" in filename or "屏幕截图" in filename:
-        return None, 'workout_snapshot'
-    if "SHealth" in filename:
-        return None, 's_health'
-    
-    # 2. 纯数字文件名匹配 (如 1769760746481.jpg)
-    if re.match(r'^\d{13}\.', filename):
-        return None, 's_health'
-    
-    # 3. 日期匹配 (YYYYMMDD)
-    match_full = re.search(r'(20\d{2})(\d{2})(\d{2})_(\d{6})', filename)
-    if match_full:
-        try:
-            y, m, d, t = match_full.groups()
-            dt_obj = datetime.strptime(f"{y}{m}{d}{t}", "%Y%m%d%H%M%S")
-            return dt_obj, 'food'
-        except:
-            pass
-
-    # 4. 时间匹配 (Fallback)
-    match_time = re.search(r'_(\d{6})', filename)
-    if match_time:
-        try:
-            t_str = match_time.group(1)
-            if int(t_str) < 240000:
-                now = datetime.now()
-                t_obj = datetime.strptime(t_str, "%H%M%S").time()
-                return datetime.combine(now.date(), t_obj), 'food'
-        except:
-            pass
-            
-    return None, 'food'
-
-def extract_json_from_response(text):
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        pass
-    text = re.sub(r"```json\s*", "", text, flags=re.IGNORECASE)
-    text = re.sub(r"```", "", text)
-    match = re.search(r'(\{.*\})', text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group(1))
-        except:
-            pass
-    return {}
-
-def normalize_data(data, target_date=None):
-    if target_date:
-        current_dt = target_date
-    else:
-        current_dt = datetime.now()
-        
-    week_map = {0:"一", 1:"二", 2:"三", 3:"四", 4:"五", 5:"六", 6:"日"}
-    data['日期'] = current_dt.strftime("%Y-%m-%d")
-    data['星期'] = f"周{week_map[current_dt.weekday()]}"
-    
-    default_schema = {
-        "营养摄入汇总": {
-            "总热量": 0, "总蛋白质": 0, "总碳水": 0, "总脂肪": 0, "总膳食纤维": 0, 
-            "总盈余缺口分析": "暂无分析"
-        },
-        "早餐": {"时间": "N/A", "内容": "", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": ""},
-        "午餐": {"时间": "N/A", "内容": "", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": ""},
-        "晚餐": {"时间": "N/A", "内容": "", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": ""},
-        "加餐": {"时间": "N/A", "内容": "", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": ""},
-        "睡眠": {
-            "入睡时间": "N/A", "起床时间": "N/A", "睡眠总时长": "0h", 
-            "睡眠阶段分析": "暂无数据", "睡眠点评": ""
-        },
-        "心率": {
-            "静息心率": 0, "平均静息范围": "N/A", "全天心率范围": "N/A", 
-            "心率时序分析": "暂无数据", "心率点评": ""
-        },
-        "压力": {
-            "压力均值": 0, "压力时序分析": "暂无数据", "压力点评": "",
-        },
-        "全天消耗与活动": {
-            "总步数": 0, "活动时长": "0min", "活动卡路里": 0, "燃烧的卡路里总数": 0
-        },
-        "力量训练": {
-            "力量主题": "休息日", "具体时间": "N/A", "训练时长": "0min", 
-            "总容量": 0, "消耗估算": 0, "力量点评": "",
-            "动作流水明细": []
-        },
-        "有氧训练": {
-            "有氧类型": "无", "具体时间": "N/A", "距离": "0km", "有氧时长": "0min", 
-            "平均心率": 0, "平均步频": 0, "平均步速": "N/A", "有氧卡路里消耗": 0
-        },
-        "本日总结": {"本日分析": "", "指导建议": ""}
-    }
-
-    for k, v in default_schema.items():
-        if k not in data:
-            data[k] = v
-        elif isinstance(v, dict):
-            for sub_k, sub_v in v.items():
-                if sub_k not in data[k]:
-                    data[k][sub_k] = sub_v
-                    
-    return data
+def load_gcp_credentials():
+    if "gcp_service_account" not in st.secrets:
+        return None
+    creds_dict = dict(st.secrets["gcp_service_account"])
+    creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+    return creds_dict
+
+def get_sheet_writer(sheet_url):
+    creds_dict = load_gcp_credentials()
+    if not sheet_url or creds_dict is None:
+        return None
+    return sheets.get_writer(sheet_url, creds_dict)
 
 def save_data_to_gsheet(data, sheet_url):
-    row = []
-    row.append(data.get('日期'))
-    row.append(data.get('星期'))
-    
-    summ = data.get('营养摄入汇总', {})
-    row.extend([
-        summ.get('总热量'), summ.get('总蛋白质'), summ.get('总碳水'), 
-        summ.get('总脂肪'), summ.get('总膳食纤维'), summ.get('总盈余缺口分析')
-    ])
-    
-    meals = ['早餐', '午餐', '晚餐', '加餐']
-    for m in meals:
-        meal = data.get(m, {})
-        row.extend([
-            meal.get('时间'), meal.get('内容'), meal.get('热量'),
-            meal.get('蛋白质'), meal.get('碳水'), meal.get('脂肪'),
-            meal.get('膳食纤维'), meal.get('点评')
-        ])
-        
-    slp = data.get('睡眠', {})
-    row.extend([
-        slp.get('入睡时间'), slp.get('起床时间'), slp.get('睡眠总时长'),
-        slp.get('睡眠阶段分析'), slp.get('睡眠点评')
-    ])
-    
-    hr = data.get('心率', {})
-    row.extend([
-        hr.get('静息心率'), hr.get('平均静息范围'), hr.get('全天心率范围'),
-        hr.get('心率时序分析'), hr.get('心率点评')
-    ])
-    
-    stres = data.get('压力', {})
-    row.extend([
-        stres.get('压力均值'), stres.get('压力时序分析'), stres.get('压力点评')
-    ])
-    
-    act = data.get('全天消耗与活动', {})
-    row.extend([
-        act.get('总步数'), act.get('活动时长'), act.get('活动卡路里'), act.get('燃烧的卡路里总数')
-    ])
-    
-    stren = data.get('力量训练', {})
-    details = stren.get('动作流水明细', [])
-    details_str = ""
-    if isinstance(details, list):
-        details_list = [f"{d.get('动作名称','')}({d.get('重量','')}kg*{d.get('次数','')})" for d in details]
-        details_str = " | ".join(details_list)
-        
-    row.extend([
-        stren.get('力量主题'), stren.get('具体时间'), stren.get('训练时长'),
-        details_str, 
-        stren.get('总容量'), stren.get('消耗估算'), stren.get('力量点评')
-    ])
-    
-    cardio = data.get('有氧训练', {})
-    row.extend([
-        cardio.get('有氧类型'), cardio.get('具体时间'), cardio.get('距离'),
-        cardio.get('有氧时长'), cardio.get('平均心率'), cardio.get('平均步频'),
-        cardio.get('平均步速'), cardio.get('有氧卡路里消耗')
-    ])
-    
-    summ_txt = data.get('本日总结', {})
-    row.extend([
-        summ_txt.get('本日分析'), summ_txt.get('指导建议')
-    ])
-
+    """
+    行写入本地 spool 后立即返回，由后台线程批量 append_rows (失败自动重试)
+    """
     try:
-        if "gcp_service_account" in st.secrets:
-            creds_dict = dict(st.secrets["gcp_service_account"])
-            creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
-            
-            scopes = [
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive"
-            ]
-            creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-            client = gspread.authorize(creds)
-            
-            try:
-                sheet = client.open_by_url(sheet_url).sheet1
-            except gspread.SpreadsheetNotFound:
-                return False, "找不到表格，请检查 URL 或权限"
-                
-            sheet.append_row(row)
-            return True, "写入成功"
-        else:
+        writer = get_sheet_writer(sheet_url)
+        if writer is None:
             return False, "未配置 Google Service Account 凭证"
+        writer.enqueue(sheets.build_row(data))
+        return True, "已加入同步队列"
     except Exception as e:
         return False, str(e)
 
 
 # 2. Payload 构建
+def queue_waiter(placeholder):
+    """
+    admission 排队回调：在占位元素中显示队列位置与预计等待，获得槽位后清除
+    """
+    def on_wait(name, position, eta):
+        if position is None:
+            placeholder.empty()
+        elif position == 0:
+            placeholder.info(f"⏳ 已达每分钟 token 上限，约 {eta:.0f} 秒后发送模型请求")
+        else:
+            wait = f"预计等待 {eta:.0f} 秒" if eta is not None else "正在估算等待时间"
+            placeholder.info(f"⏳ {name}排队中：第 {position} 位，{wait}")
+    return on_wait
+
 def build_payload(uploaded_files, quick_adds):
-    timeline_fixed = []   
-    timeline_float = []   
-    valid_dates = [] 
-    
     with st.status("正在处理图像...", expanded=False) as status:
-        for file in uploaded_files:
-            b64_str, mime = smart_process_image(file)
-            b64_encoded = base64.b64encode(b64_str).decode('utf-8')
-            
-            file_dt, file_type = parse_file_info(file.name)
-            
-            item = {"type": "image", "name": file.name, "data": b64_encoded, "mime": mime, "file_type": file_type}
-            
-            if file_type == 'food':
-                if file_dt:
-                    item['time'] = file_dt
-                    timeline_fixed.append(item)
-                    if file_dt.year > 2000:
-                        valid_dates.append(file_dt)
-                else:
-                    item['label'] = "【未归档食物】"
-                    timeline_float.append(item)
-            elif file_type == 'workout_snapshot':
-                item['label'] = "【健身详情截图】"
-                timeline_float.append(item)
-                if file_dt and file_dt.year > 2000:
-                    valid_dates.append(file_dt)
-            elif file_type == 's_health':
-                item['label'] = "【SHealth汇总】"
-                timeline_float.append(item)
-                    
-        status.update(label="图像处理完成", state="complete")
+        def on_progress(done, total, name):
+            status.update(label=f"正在处理图像 ({done}/{total}) {name}")
 
-    if valid_dates:
-        report_date = min(valid_dates)
-    else:
-        report_date = datetime.now()
+        user_content, report_date, sections, duplicates, payload_mb = assemble_payload(
+            uploaded_files, quick_adds, on_progress=on_progress
+        )
+        for dropped, kept in sorted(duplicates.items()):
+            st.write(f"🔁 已跳过重复图片 {uploaded_files[dropped].name} (与 {uploaded_files[kept].name} 近似)")
 
-    timeline_fixed.sort(key=lambda x: x['time'])
+        dedupe_note = f", 去重 {len(duplicates)} 张" if duplicates else ""
+        status.update(label=f"图像处理完成 (图片载荷 {payload_mb:.1f} MB{dedupe_note})", state="complete")
+    return user_content, report_date, sections
 
-    user_content = []
-    user_content.append({"type": "text", "text": "## Part 1: 饮食照片流\n(请对以下食物照片进行精确视觉估算，包含热量, 蛋白质, 碳水, 脂肪, 膳食纤维)\n"})
-    for item in timeline_fixed:
-        t = item['time'].strftime("%H:%M")
-        if item.get('type') == 'text':
-            user_content.append({"type": "text", "text": f"- {t} {item.get('content')}"})
-        else:
-            user_content.append({"type": "text", "text": f"- {t} [食物照片] (请估算热量及宏量营养素)"})
-            user_content.append({"type": "image_url", "image_url": {"url": f"data:{item['mime']};base64,{item['data']}"}})
-
-    supplement_text = ""
-    if quick_adds.get('bcaa'): supplement_text += "- BCAA 6g (训练中摄入)\n"
-    if quick_adds.get('protein'): supplement_text += "- 蛋白粉 32g + 肌酸 3g (训练后摄入)\n"
-    if supplement_text:
-        user_content.append({
-            "type": "text", 
-            "text": f"\n## 特别指令：补剂\n【强制要求】请将以下补剂合并计算入 JSON 的 `加餐` 字段：\n{supplement_text}"
+def analyze_delta(previous, seen, uploaded_files, digests, quick_adds, use_cache=True):
+    """
+    增量更新：只把未分析过的图片 (和新勾选的补剂) 发给模型，结果合并进当天已保存的报告
+    """
+    new_files = [file for file, digest in zip(uploaded_files, digests) if digest not in seen]
+    new_quick = {name: checked and f"quick:{name}" not in seen for name, checked in quick_adds.items()}
+    if not new_files and not any(new_quick.values()):
+        st.toast("没有新增照片，沿用当天已保存的报告", icon="♻️")
+        return previous
+
+    user_content, _, _ = build_payload(new_files, new_quick)
+    file_types = {parse_file_info(file.name)[1] for file in new_files}
+    if any(new_quick.values()):
+        file_types.add("food")
+    keys, required = delta_sections(file_types)
+    client = transport.get_client(api_key, llm.BASE_URL)
+    with st.spinner(f"正在增量解析 ({len(new_files)} 张新增图片，已有 {len(uploaded_files) - len(new_files)} 张)..."):
+        delta, missing, repaired, cached = llm.complete_report(
+            client, delta_messages(previous, user_content, file_types), keys, use_cache, required
+        )
+    if cached:
+        st.toast("⚡ 命中响应缓存，跳过模型调用", icon="💾")
+    if missing:
+        st.warning(f"以下板块未能解析，保留原有数据: {', '.join(missing)}")
+    if repaired:
+        st.warning(f"模型输出不完整，以下板块由补全请求生成 (可能为默认值，结果未缓存): {', '.join(repaired)}")
+    # 只采用本次 schema 内且解析成功的板块，避免覆盖原报告中未涉及的部分
+    allowed = set(keys) - set(missing)
+    return merge_delta(previous, {k: v for k, v in delta.items() if k in allowed})
+
+# 5. 报告渲染 (按板块拆分，流式模式下各板块在所需键到齐后即可单独渲染)
+# 每个板块分为 表格构建 (data → DataFrame) 与 渲染 两步；完整结果的表格只构建一次，随结果缓存在会话中
+def overview_tables(data):
+    strength_data, total_vol, _ = prepare_strength(data)
+    summary_data = [
+        {"指标": "总摄入", "数值": f"{data['营养摄入汇总']['总热量']} kcal", "详情": f"C: {data['营养摄入汇总']['总碳水']}g, P: {data['营养摄入汇总']['总蛋白质']}g, Fat: {data['营养摄入汇总']['总脂肪']}g"},
+        {"指标": "总消耗", "数值": f"{data['全天消耗与活动']['燃烧的卡路里总数']} kcal", "详情": "包含基础代谢与活动消耗"},
+        {"指标": "热量差", "数值": f"{data['营养摄入汇总']['总热量'] - data['全天消耗与活动']['燃烧的卡路里总数']} kcal", "详情": data['营养摄入汇总']['总盈余缺口分析']},
+        {"指标": "训练容量", "数值": f"{int(total_vol)} kg", "详情": strength_data.get('力量主题', '休息日')},
+        {"指标": "压力均值", "数值": f"{data['压力']['压力均值']}", "详情": data['压力']['压力点评'][:20]+"..."}
+    ]
+    return {"summary": pd.DataFrame(summary_data)}
+
+def render_overview(data, tables):
+    st.markdown("📊 **每日概览**")
+    st.dataframe(tables["summary"], width="stretch", hide_index=True)
+
+def diet_tables(data):
+    macros_data = []
+    for m in ['早餐', '午餐', '晚餐', '加餐']:
+        row = data[m]
+        macros_data.append({
+            "餐别": m,
+            "时间": row['时间'],
+            "内容": row['内容'],
+            "Cal": row['热量'],
+            "P": row['蛋白质'],
+            "C": row['碳水'],
+            "F": row['脂肪'],
+            "Fib": row['膳食纤维']
         })
+    return {"macros": pd.DataFrame(macros_data)}
+
+def render_diet(data, tables):
+    st.markdown("🍽️ **饮食详情**")
+    st.dataframe(tables["macros"], width="stretch", hide_index=True)
+    st.caption("注: P=蛋白质, C=碳水, F=脂肪, Fib=膳食纤维 (单位:g)")
+
+def strength_tables(data):
+    strength_data, total_vol, workout_df = prepare_strength(data)
+    wo_meta = [
+        {"项目": "开始时间", "数据": strength_data.get('具体时间')},
+        {"项目": "训练时长", "数据": strength_data.get('训练时长')},
+        {"项目": "总容量", "数据": f"{total_vol} kg"},
+        {"项目": "估算消耗", "数据": f"{strength_data.get('消耗估算')} kcal"}
+    ]
+    df_agg = None
+    if not workout_df.empty and "动作名称" in workout_df.columns:
+        workout_df['组详情'] = (
+            workout_df.get('重量', pd.Series(0, index=workout_df.index)).fillna(0).astype(str) + "kg×"
+            + workout_df.get('次数', pd.Series(0, index=workout_df.index)).fillna(0).astype(str)
+        )
+        # OCR 名称变体 (序号前缀/嵌入重量/同义名) 合并到同一动作
+        workout_df['动作名称'] = training.canonical_names(workout_df['动作名称'])
+        # 清理后名称为空 (如只有 "1/热 10+10kg 12" 的 OCR 行) 的组不单独成行
+        workout_df = workout_df[workout_df['动作名称'] != ""]
+        df_agg = workout_df.groupby("动作名称", as_index=False).agg(记录=("组详情", " | ".join))
+    return {"meta": pd.DataFrame(wo_meta), "sets": df_agg}
+
+def render_strength(data, tables):
+    strength_data = data.get('力量训练', {})
+    st.markdown("🏋️ **力量训练**")
+    st.markdown(f"**主题: {strength_data.get('力量主题', '无')}**")
+    st.dataframe(tables["meta"], width="stretch", hide_index=True)
+    if tables["sets"] is not None:
+        st.dataframe(tables["sets"], width="stretch", hide_index=True)
+    st.info(f"💡 {strength_data.get('力量点评')}")
+
+def cardio_tables(data):
+    ac = data['有氧训练']
+    cardio_table = [
+        {"指标": "距离", "数值": ac['距离']},
+        {"指标": "时长", "数值": ac['有氧时长']},
+        {"指标": "配速", "数值": ac['平均步速']},
+        {"指标": "平均心率", "数值": f"{ac['平均心率']} bpm"},
+        {"指标": "消耗", "数值": f"{ac['有氧卡路里消耗']} kcal"}
+    ]
+    return {"cardio": pd.DataFrame(cardio_table)}
+
+def render_cardio(data, tables):
+    st.markdown("🏃 **有氧训练**")
+    st.markdown(f"**项目: {data['有氧训练']['有氧类型']}**")
+    st.dataframe(tables["cardio"], width="stretch", hide_index=True)
+
+def sleep_stress_tables(data):
+    slp = data['睡眠']
+    sts = data['压力']
+    health_table = [
+        {"类别": "睡眠", "指标": "时间", "数值": f"{slp['入睡时间']} - {slp['起床时间']}"},
+        {"类别": "睡眠", "指标": "时长", "数值": slp['睡眠总时长']},
+        {"类别": "压力", "指标": "均值", "数值": sts['压力均值']},
+        {"类别": "压力", "指标": "评价", "数值": sts['压力点评']}
+    ]
+    return {"health": pd.DataFrame(health_table)}
+
+def render_sleep_stress(data, tables):
+    st.markdown("💤 **睡眠 & 压力**")
+    st.dataframe(tables["health"], width="stretch", hide_index=True)
+    st.caption(f"睡眠分析: {data['睡眠']['睡眠阶段分析']}")
+
+def heart_activity_tables(data):
+    hr = data['心率']
+    act = data['全天消耗与活动']
+    body_table = [
+        {"类别": "心率", "指标": "静息心率", "数值": f"{hr['静息心率']} bpm"},
+        {"类别": "心率", "指标": "全天范围", "数值": hr['全天心率范围']},
+        {"类别": "活动", "指标": "总步数", "数值": act['总步数']},
+        {"类别": "活动", "指标": "活动热量", "数值": f"{act['活动卡路里']} kcal"}
+    ]
+    return {"body": pd.DataFrame(body_table)}
+
+def render_heart_activity(data, tables):
+    st.markdown("❤️ **心率 & 活动**")
+    st.dataframe(tables["body"], width="stretch", hide_index=True)
+
+def summary_tables(data):
+    return {}
 
-    imgs = [x for x in timeline_float if x['file_type'] in ['workout_snapshot', 's_health']]
-    if imgs:
-        user_content.append({"type": "text", "text": "\n## Part 2: 健康数据截图 (OCR)\n请提取包括步频、配速、压力时序等所有详细数据。\n"})
-        for img in imgs:
-            user_content.append({"type": "text", "text": f"📸 {img['label']}"})
-            user_content.append({"type": "image_url", "image_url": {"url": f"data:{img['mime']};base64,{img['data']}"}})
-            
-    return user_content, report_date
-
-# 3. JSON Schema
-RESPONSE_SCHEMA = """
-{
-  "营养摄入汇总": {
-    "总热量": 0, "总蛋白质": 0, "总碳水": 0, "总脂肪": 0, "总膳食纤维": 0,
-    "总盈余缺口分析": "..."
-  },
-  "早餐": { 
-    "时间": "HH:MM", "内容": "...", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": "..." 
-  },
-  "午餐": { 
-    "时间": "HH:MM", "内容": "...", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": "..." 
-  },
-  "晚餐": { 
-    "时间": "HH:MM", "内容": "...", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": "..." 
-  },
-  "加餐": { 
-    "时间": "HH:MM", "内容": "...", "热量": 0, "蛋白质": 0, "碳水": 0, "脂肪": 0, "膳食纤维": 0, "点评": "..." 
-  },
-  "睡眠": { 
-    "入睡时间": "HH:MM", "起床时间": "HH:MM", "睡眠总时长": "...", 
-    "睡眠阶段分析": "...", "睡眠点评": "..." 
-  },
-  "心率": { 
-    "静息心率": 0, "平均静息范围": "...", "全天心率范围": "...", 
-    "心率时序分析": "...", "心率点评": "..." 
-  },
-  "压力": { 
-    "压力均值": 0, "压力时序分析": "...", "压力点评": "..." 
-  },
-  "全天消耗与活动": { 
-    "总步数": 0, "活动时长": "...", "活动卡路里": 0, "燃烧的卡路里总数": 0 
-  },
-  "力量训练": {
-    "力量主题": "...", "具体时间": "HH:MM", "训练时长": "...",
-    "动作流水明细": [ 
-      { 
-        "动作名称": "...", "OCR原始行": "如: 1/热 10+10kg 12", "组序号": "1", "重量": 20, "次数": 12 
-      } 
-    ],
-    "总容量": 0, "消耗估算": 0, "力量点评": "..."
-  },
-  "有氧训练": { 
-    "有氧类型": "...", "具体时间": "HH:MM", "距离": "...", "有氧时长": "...", 
-    "平均心率": "...", "平均步频": "...", "平均步速": "...", "有氧卡路里消耗": "..." 
-  },
-  "本日总结": { "本日分析": "...", "指导建议": "..." }
-}
-"""
+def render_summary(data, tables):
+    st.markdown("📝 **总结与建议**")
+    st.markdown("📅 **本日分析**")
+    st.write(data['本日总结']['本日分析'])
+    st.markdown("🛡️ **指导建议**")
+    st.success(data['本日总结']['指导建议'])
+
+# (板块名, 依赖的顶层键, 表格构建函数, 渲染函数)，按页面展示顺序排列
+REPORT_SECTIONS = [
+    ("overview", ["营养摄入汇总", "全天消耗与活动", "力量训练", "压力"], overview_tables, render_overview),
+    ("diet", ["早餐", "午餐", "晚餐", "加餐"], diet_tables, render_diet),
+    ("strength", ["力量训练"], strength_tables, render_strength),
+    ("cardio", ["有氧训练"], cardio_tables, render_cardio),
+    ("sleep_stress", ["睡眠", "压力"], sleep_stress_tables, render_sleep_stress),
+    ("heart_activity", ["心率", "全天消耗与活动"], heart_activity_tables, render_heart_activity),
+    ("summary", ["本日总结"], summary_tables, render_summary),
+]
+
+def create_report_slots():
+    return {name: st.empty() for name, *_ in REPORT_SECTIONS}
+
+def render_report(slots, data, only=None):
+    """
+    流式过程中将部分结果渲染到各板块占位；only 为要渲染的板块名集合 (None 表示全部)
+    """
+    for idx, (name, _, build, render) in enumerate(REPORT_SECTIONS):
+        if only is not None and name not in only:
+            continue
+        with slots[name].container():
+            render(data, build(data))
+            if idx < len(REPORT_SECTIONS) - 1:
+                st.divider()
+
+@st.fragment
+def report_section(render, data, tables):
+    """
+    单个板块的局部重跑单元：板块内的交互只重跑本函数
+    """
+    render(data, tables)
+
+@st.fragment
+def raw_json_view(data):
+    if st.toggle("查看原始 JSON"):
+        st.json(data)
+
+# --- 会话内结果缓存：按上传文件与选项记住最近几次的结果，页面交互时直接重绘 ---
+REPORT_MEMO_SIZE = 4
+
+def report_key(uploaded_files, quick_adds, options):
+    """
+    上传控件的 file_id 在重新上传前保持不变，无需读取文件内容
+    """
+    files = tuple((file.file_id, file.size) for file in uploaded_files)
+    return files, tuple(sorted(quick_adds.items())), tuple(sorted(options.items()))
+
+def remember_report(key, data):
+    reports = st.session_state.setdefault("reports", {})
+    reports.pop(key, None)
+    reports[key] = {"data": data, "tables": {name: build(data) for name, _, build, _ in REPORT_SECTIONS}, "record": None}
+    while len(reports) > REPORT_MEMO_SIZE:
+        reports.pop(next(iter(reports)))
+    return reports[key]
+
+def render_saved_report(report, slots=None):
+    """
+    slots 为流式过程中已写入部分结果的占位；片段的输出多嵌套一层，需先清空，否则旧元素会残留到本轮结束
+    """
+    slots = slots or create_report_slots()
+    for idx, (name, _, _, render) in enumerate(REPORT_SECTIONS):
+        slots[name].empty()
+        with slots[name].container():
+            report_section(render, report["data"], report["tables"][name])
+            if idx < len(REPORT_SECTIONS) - 1:
+                st.divider()
+    raw_json_view(report["data"])
+
+# 6. 性能面板
+def render_run_metrics(record):
+    stages = pd.DataFrame(list(record["stages"].items()), columns=["阶段", "耗时 (s)"])
+    c1, c2, c3 = st.columns(3)
+    c1.metric("总耗时", f"{record['total']:.1f} s")
+    c2.metric("输入 Tokens", f"{record['tokens']['prompt_tokens']:,}")
+    c3.metric("输出 Tokens", f"{record['tokens']['completion_tokens']:,}", help=f"模型请求 {record['llm_calls']} 次")
+    st.dataframe(stages, width="stretch", hide_index=True,
+                 column_config={"耗时 (s)": st.column_config.NumberColumn(format="%.3f")})
+    st.caption("图像预处理包含 base64 编码；流式模式下模型首字节包含请求上传与排队时间")
+    if record["images"]:
+        st.dataframe(pd.DataFrame(record["images"]).rename(columns={"name": "图片", "seconds": "耗时 (s)", "source": "来源"}),
+                     width="stretch", hide_index=True)
+
+def render_metrics_summary():
+    summary = metrics.cached_summary()
+    if summary is None:
+        st.caption("暂无性能记录")
+        return
+    runs, timing, tokens = summary
+    st.caption(f"最近 {runs} 条记录 ({metrics.METRICS_PATH})")
+    st.dataframe(timing.round(3), width="stretch")
+    if len(tokens):
+        st.dataframe(tokens.round(0), width="stretch")
 
 # 4. UI 主程序
 
@@ -383,10 +348,35 @@ with st.sidebar:
     st.markdown("⚙️ **系统状态**")
     st.caption(f"API Connection: {api_status}")
     st.caption(f"Storage: {sheet_status}")
+    cache_stats = image_cache.stats()
+    st.caption(f"Image Cache: 命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} ({cache_stats['memory_bytes'] // 1024} KB)")
+    # 启动写入线程：上次未同步完的 spool 行在此恢复发送
+    sheet_writer = get_sheet_writer(SHEET_URL)
+    if sheet_writer is not None:
+        schedule_sync(sheet_writer)
+        st.caption(f"Sync Queue: 待写入 {sheet_writer.depth()} 行")
+        if sheet_writer.last_error:
+            st.caption(f"⚠️ 同步重试中: {sheet_writer.last_error}")
+    st.caption(f"History: 本地 {len(history_store)} 天 (最新 {history_store.watermark() or '无'})")
+    if api_key:
+        llm_stats = transport.get_client(api_key, llm.BASE_URL).stats()
+        if llm_stats["calls"] or llm_stats["breaker"] != "closed":
+            st.caption(f"LLM: 调用 {llm_stats['calls']} 次 · 重试 {llm_stats['retries']} · "
+                       f"对冲 {llm_stats['hedges']} (胜 {llm_stats['hedge_wins']}) · 熔断 {llm_stats['breaker']}")
+    cpu_load, llm_load = admission.cpu_queue.stats(), admission.llm_queue.stats()
+    st.caption(f"Load: 图像 {cpu_load['active']}/{cpu_load['slots']} (排队 {cpu_load['waiting']}) · "
+               f"模型 {llm_load['active']}/{llm_load['slots']} (排队 {llm_load['waiting']})")
+    with st.expander("⏱️ 性能统计 (p50 / p95)"):
+        render_metrics_summary()
     
     st.divider()
     st.markdown("💾 **设置**")
     auto_save = st.checkbox("自动同步到 Google Sheets", value=True, disabled=(SHEET_URL==""))
+    bypass_llm_cache = st.checkbox("跳过 LLM 响应缓存 (强制重新解析)", value=False)
+    fan_out_mode = st.checkbox("分段并行解析 (饮食/健康/训练同时请求)", value=False)
+    stream_mode = st.checkbox("流式渲染 (各板块解析完成即显示)", value=True, disabled=fan_out_mode)
+    delta_mode = st.checkbox("增量更新 (仅分析新增照片)", value=False,
+                             help="当天已有报告时，只解析之前未上传过的图片并合并到原报告")
 
 uploaded_files = st.file_uploader("📤 **上传记录 (截图/食物)**", accept_multiple_files=True, type=['jpg', 'jpeg', 'png'])
 
@@ -398,7 +388,15 @@ with qc2:
     opt_protein = st.checkbox(''':blue-background[🥛 练后 蛋白粉]''')
 quick_adds = {"bcaa": opt_bcaa, "protein": opt_protein}
 
-if st.button("🚀 生成详细报告", type="primary"):
+# 同一组上传与选项已生成过报告时直接重绘 (任何控件交互都会重跑脚本)，不再重复整条流水线
+current_key = report_key(uploaded_files or [], quick_adds, {"fan_out": fan_out_mode, "delta": delta_mode})
+saved_report = st.session_state.get("reports", {}).get(current_key) if uploaded_files else None
+generate = st.button("🚀 生成详细报告", type="primary")
+if generate and saved_report is not None and not bypass_llm_cache:
+    st.toast("♻️ 上传与选项未变化，直接显示本次会话已生成的报告", icon="⚡")
+    generate = False
+
+if generate:
     if not uploaded_files:
         st.warning("请上传图片")
         st.stop()
@@ -406,197 +404,142 @@ if st.button("🚀 生成详细报告", type="primary"):
         st.error("未检测到 API Key，请检查 secrets.toml 配置")
         st.stop()
         
+    # 图像处理与模型调用都经过进程级准入队列，按会话公平排队
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    admission.bind(st.session_state.session_id, queue_waiter(st.empty()))
+    run = metrics.start_run(files=len(uploaded_files), fan_out=fan_out_mode, stream=stream_mode, delta=delta_mode)
     try:
-        user_content, report_date = build_payload(uploaded_files, quick_adds)
-        
-        system_prompt = f"""你是一名精英营养师和数据分析师。
-        
-        【任务 1：力量训练 - 逐行提取】
-        **不要合并！** 截图有几组，数组里就有几个对象。
-        **不要乘序号！** 单组容量 = 重量 * 次数。
-        
-        【任务 2：膳食纤维与营养】
-        对食物照片进行估算时，必须进行精确视觉估算，包含热量, 蛋白质, 碳水, 脂肪, 膳食纤维数据。
-        
-        【任务 3：压力均值】
-        若无直接均值，按 (高*90 + 中*65 + 低*40 + 放松*10)/100 计算。
-
-        【输出要求】
-        严格 JSON 格式，不要多余文本。
-        {RESPONSE_SCHEMA}
-        """
-        
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content}
-        ]
-
-        client = OpenAI(api_key=api_key, base_url="https://api.poixe.com/v1")
-        
-        with st.spinner("正在全维度解析..."):
-            response = client.chat.completions.create(
-                model="gemini-2.5-flash", 
-                messages=messages,
-                temperature=0.0, 
-                response_format={"type": "json_object"}
-            )
-            
-        result_text = response.choices[0].message.content
-        raw_data = extract_json_from_response(result_text)
+        digests, markers = file_digests(uploaded_files, quick_adds)
+        images = set(digests) | markers
+        previous, seen = None, set()
+        if delta_mode:
+            report_date = report_date_for([capture_info(file) for file in uploaded_files])
+            previous, seen = history_store.load_report(report_date.strftime("%Y-%m-%d"))
+            if previous is not None and not seen:
+                # 没有图片记录 (如早期回填的报告)：无法区分哪些是新图片，增量会把餐次重复累加，改为完整解析
+                st.info("当天已保存的报告没有图片记录，本次改为完整解析")
+                previous = None
+
+        if previous is not None:
+            images |= seen
+            raw_data = analyze_delta(previous, seen, uploaded_files, digests, quick_adds,
+                                     use_cache=not bypass_llm_cache)
+            slots = None
+        else:
+            user_content, report_date, sections = build_payload(uploaded_files, quick_adds)
+            slots = None
+
+            if fan_out_mode:
+                with st.spinner(f"正在分段并行解析 ({len(sections)} 路)..."), metrics.span("分段并行解析"):
+                    raw_data = llm.run_sectioned(api_key, sections, build_system_prompt,
+                                                 use_cache=not bypass_llm_cache)
+            else:
+                messages = [
+                    {"role": "system", "content": build_system_prompt(RESPONSE_SCHEMA)},
+                    {"role": "user", "content": user_content}
+                ]
+
+                llm_params = {"temperature": 0.0, "response_format": {"type": "json_object"}}
+                cache_key = llm.fingerprint(llm.MODEL, messages, **llm_params)
+                result_text = None if bypass_llm_cache else llm.get_cached_response(cache_key)
+
+                if result_text is not None:
+                    st.toast("⚡ 命中响应缓存，跳过模型调用", icon="💾")
+                    with metrics.span("JSON 解析"):
+                        raw_data = extract_json_from_response(result_text)
+                    cache_key = None
+                elif stream_mode:
+                    client = transport.get_client(api_key, llm.BASE_URL)
+                    slots = create_report_slots()
+                    parser = llm.IncrementalJSONParser()
+                    rendered = set()
+
+                    with st.spinner("正在全维度解析 (流式)..."):
+                        for delta in llm.stream_completion(client, messages, **llm_params):
+                            if not parser.feed(delta):
+                                continue
+                            ready = {
+                                name for name, keys, *_ in REPORT_SECTIONS
+                                if name not in rendered and all(k in parser.completed for k in keys)
+                            }
+                            if ready:
+                                partial = normalize_data(parser.completed, target_date=report_date)
+                                render_report(slots, partial, only=ready)
+                                rendered |= ready
+
+                    result_text = parser.text
+                else:
+                    client = transport.get_client(api_key, llm.BASE_URL)
+
+                    with st.spinner("正在全维度解析..."), metrics.span("模型调用"):
+                        response = client.chat.completions.create(
+                            model=llm.MODEL, 
+                            messages=messages,
+                            **llm_params
+                        )
+                    metrics.add_usage(getattr(response, "usage", None))
+                    
+                    result_text = response.choices[0].message.content
+
+                if cache_key:
+                    # 缺失/损坏的板块只用一次纯文本请求补全，而不是重新上传全部图片
+                    with metrics.span("JSON 解析"):
+                        raw_data, bad_keys = llm.decode_response(result_text, SECTION_KEYS)
+                    if bad_keys:
+                        with st.spinner(f"正在补全缺失板块: {', '.join(bad_keys)}"):
+                            fixed = llm.repair_sections(client, result_text, bad_keys)
+                        raw_data.update(fixed)
+                        missing = [k for k in bad_keys if k not in fixed]
+                        if missing:
+                            st.warning(f"以下板块未能解析，已使用默认值: {', '.join(missing)}")
+                        if fixed:
+                            st.warning(f"模型输出不完整，以下板块由补全请求生成 (可能为默认值，结果未缓存): {', '.join(fixed)}")
+
+                    # 只缓存完整通过校验的原始响应；修复补出的板块 (截断部分只能填默认值) 不应被反复命中
+                    elif raw_data:
+                        llm.store_response(cache_key, result_text)
         
         # === 数据归一化 ===
-        data = normalize_data(raw_data, target_date=report_date)
-        
-        # === 力量数据聚合 ===
-        workout_df = pd.DataFrame()
-        strength_data = data.get('力量训练', {})
-        details = strength_data.get('动作流水明细', [])
+        with metrics.span("数据归一化"):
+            data = normalize_data(raw_data, target_date=report_date)
         
-        total_vol = 0
-        if details:
-            for d in details:
-                try:
-                    w = float(d.get('重量', 0))
-                    r = float(d.get('次数', 0))
-                    d['单组容量'] = w * r
-                    total_vol += d['单组容量']
-                except:
-                    d['单组容量'] = 0
-            strength_data['总容量'] = total_vol 
-            workout_df = pd.DataFrame(details)
+            # === 力量数据聚合 (写入单组容量/总容量，供同步与渲染使用) ===
+            prepare_strength(data)
         
         # === 状态同步 ===
         st.toast(f"✅ 解析完成 | 日期: {data['日期']}", icon="📅")
+        with metrics.span("历史库写入"):
+            history_store.save_report(data, images=images)
         
         if auto_save and SHEET_URL:
-            with st.spinner("正在同步到云端..."):
+            with st.spinner("正在同步到云端..."), metrics.span("Sheet 入队"):
                 success, msg = save_data_to_gsheet(data, SHEET_URL)
                 if success:
-                    st.toast("✅ 数据已同步到 Google Sheet", icon="☁️")
+                    st.toast("✅ 数据已加入 Google Sheet 同步队列", icon="☁️")
                 else:
                     st.error(f"❌ 同步失败: {msg}")
         
         # ==========================================
-        # 5. 专业表格化展示 (Mobile Optimized - Direct Display)
+        # 专业表格化展示 (Mobile Optimized - Direct Display)
         # ==========================================
-        
-        # --- 核心摘要表 ---
-        st.markdown("📊 **每日概览**")
-        summary_data = [
-            {"指标": "总摄入", "数值": f"{data['营养摄入汇总']['总热量']} kcal", "详情": f"C: {data['营养摄入汇总']['总碳水']}g, P: {data['营养摄入汇总']['总蛋白质']}g, Fat: {data['营养摄入汇总']['总脂肪']}g"},
-            {"指标": "总消耗", "数值": f"{data['全天消耗与活动']['燃烧的卡路里总数']} kcal", "详情": "包含基础代谢与活动消耗"},
-            {"指标": "热量差", "数值": f"{data['营养摄入汇总']['总热量'] - data['全天消耗与活动']['燃烧的卡路里总数']} kcal", "详情": data['营养摄入汇总']['总盈余缺口分析']},
-            {"指标": "训练容量", "数值": f"{int(total_vol)} kg", "详情": strength_data.get('力量主题', '休息日')},
-            {"指标": "压力均值", "数值": f"{data['压力']['压力均值']}", "详情": data['压力']['压力点评'][:20]+"..."}
-        ]
-        st.dataframe(pd.DataFrame(summary_data), width="stretch", hide_index=True)
-
-        st.divider()
-
-        # --- 1. 饮食详情 ---
-        st.markdown("🍽️ **饮食详情**")
-        macros_data = []
-        for m in ['早餐', '午餐', '晚餐', '加餐']:
-            row = data[m]
-            macros_data.append({
-                "餐别": m,
-                "时间": row['时间'],
-                "内容": row['内容'],
-                "Cal": row['热量'],
-                "P": row['蛋白质'],
-                "C": row['碳水'],
-                "F": row['脂肪'],
-                "Fib": row['膳食纤维']
-            })
-        df_macros = pd.DataFrame(macros_data)
-        st.dataframe(df_macros, width="stretch", hide_index=True)
-        st.caption("注: P=蛋白质, C=碳水, F=脂肪, Fib=膳食纤维 (单位:g)")
-
-        st.divider()
-
-        # --- 2. 力量训练 ---
-        st.markdown("🏋️ **力量训练**")
-        st.markdown(f"**主题: {strength_data.get('力量主题', '无')}**")
-        wo_meta = [
-            {"项目": "开始时间", "数据": strength_data.get('具体时间')},
-            {"项目": "训练时长", "数据": strength_data.get('训练时长')},
-            {"项目": "总容量", "数据": f"{total_vol} kg"},
-            {"项目": "估算消耗", "数据": f"{strength_data.get('消耗估算')} kcal"}
-        ]
-        st.dataframe(pd.DataFrame(wo_meta), width="stretch", hide_index=True)
-        
-        if not workout_df.empty and "动作名称" in workout_df.columns:
-            workout_df['组详情'] = workout_df.apply(
-                lambda x: f"{x.get('重量',0)}kg×{x.get('次数',0)}", axis=1
-            )
-            df_agg = workout_df.groupby("动作名称", as_index=False).agg({
-                "组详情": lambda x: " | ".join(x),
-                "单组容量": "sum",
-                "OCR原始行": "count"
-            })
-            df_agg.columns = ["动作名称", "记录", "总容量", "组数"]
-            df_agg = df_agg[["动作名称", "记录"]] 
-            st.dataframe(df_agg, width="stretch", hide_index=True)
-        
-        st.info(f"💡 {strength_data.get('力量点评')}")
-
-        st.divider()
-
-        # --- 3. 有氧训练 ---
-        st.markdown("🏃 **有氧训练**")
-        st.markdown(f"**项目: {data['有氧训练']['有氧类型']}**")
-        ac = data['有氧训练']
-        cardio_table = [
-            {"指标": "距离", "数值": ac['距离']},
-            {"指标": "时长", "数值": ac['有氧时长']},
-            {"指标": "配速", "数值": ac['平均步速']},
-            {"指标": "平均心率", "数值": f"{ac['平均心率']} bpm"},
-            {"指标": "消耗", "数值": f"{ac['有氧卡路里消耗']} kcal"}
-        ]
-        st.dataframe(pd.DataFrame(cardio_table), width="stretch", hide_index=True)
-
-        st.divider()
-
-        # --- 4. 睡眠与压力 ---
-        st.markdown("💤 **睡眠 & 压力**")
-        slp = data['睡眠']
-        sts = data['压力']
-        health_table = [
-            {"类别": "睡眠", "指标": "时间", "数值": f"{slp['入睡时间']} - {slp['起床时间']}"},
-            {"类别": "睡眠", "指标": "时长", "数值": slp['睡眠总时长']},
-            {"类别": "压力", "指标": "均值", "数值": sts['压力均值']},
-            {"类别": "压力", "指标": "评价", "数值": sts['压力点评']}
-        ]
-        st.dataframe(pd.DataFrame(health_table), width="stretch", hide_index=True)
-        st.caption(f"睡眠分析: {slp['睡眠阶段分析']}")
-
-        st.divider()
-
-        # --- 5. 心率与活动 ---
-        st.markdown("❤️ **心率 & 活动**")
-        hr = data['心率']
-        act = data['全天消耗与活动']
-        body_table = [
-            {"类别": "心率", "指标": "静息心率", "数值": f"{hr['静息心率']} bpm"},
-            {"类别": "心率", "指标": "全天范围", "数值": hr['全天心率范围']},
-            {"类别": "活动", "指标": "总步数", "数值": act['总步数']},
-            {"类别": "活动", "指标": "活动热量", "数值": f"{act['活动卡路里']} kcal"}
-        ]
-        st.dataframe(pd.DataFrame(body_table), width="stretch", hide_index=True)
-
-        st.divider()
-
-        # --- 6. 总结与建议 ---
-        st.markdown("📝 **总结与建议**")
-        st.markdown("📅 **本日分析**")
-        st.write(data['本日总结']['本日分析'])
-        st.markdown("🛡️ **指导建议**")
-        st.success(data['本日总结']['指导建议'])
-        
-        with st.expander("查看原始 JSON"):
-            st.json(data)
+        with metrics.span("渲染"):
+            report = remember_report(current_key, data)
+            render_saved_report(report, slots)
+
+        report["record"] = metrics.finish_run()
+        with st.expander(f"⏱️ 本次耗时 {report['record']['total']:.1f} s"):
+            render_run_metrics(report["record"])
             
     except Exception as e:
-
+        run.meta["error"] = str(e)
+        metrics.finish_run()
         st.error(f"处理过程中发生错误: {e}")
+    finally:
+        admission.unbind()
+elif saved_report is not None:
+    render_saved_report(saved_report)
+    if saved_report["record"]:
+        with st.expander(f"⏱️ 生成耗时 {saved_report['record']['total']:.1f} s"):
+            render_run_metrics(saved_report["record"])
 
@@ -0,0 +1,217 @@
+import os
+import io
+import sys
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from collections import defaultdict
+from dotenv import load_dotenv
+import llm
+import sheets
+import transport
+from imaging import parse_file_info, filename_datetime, exif_datetime
+from pipeline import normalize_data, prepare_strength, assemble_payload, RESPONSE_SCHEMA, build_system_prompt
+from pipeline import file_digests
+from history import history_store
+from schema import SECTION_KEYS
+
+# 命令行批量回填：按天分组 → 预处理 → LLM → 归一化 → 历史库/Sheet，每个阶段并发有上限，已完成的天写入 checkpoint
+# 用法: python backfill.py <图片目录> [--llm-workers 4] [--sheet-url URL --credentials sa.json]
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+# 处理完所有天后等待 Sheet 同步队列清空的上限 (写入线程会无限重试，如 URL 错误或凭证失效)
+SHEET_WAIT_SECONDS = 300
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "backfill_checkpoint.jsonl")
+_DONE = object()
+
+
+def load_file(path):
+    with open(path, "rb") as f:
+        buf = io.BytesIO(f.read())
+    buf.name = os.path.basename(path)
+    return buf
+
+def group_by_day(directory):
+    """
+    拍摄时间：文件名完整日期 → EXIF → 文件修改时间 (仅用于分组)
+    返回 {date: [(path, (拍摄时间或 None, 类型)), ...]}
+    """
+    days = defaultdict(list)
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            if not name.lower().endswith(IMAGE_EXTS):
+                continue
+            path = os.path.join(root, name)
+            _, file_type = parse_file_info(name)
+            with open(path, "rb") as f:
+                taken = filename_datetime(name) or exif_datetime(f)
+            day = (taken or datetime.fromtimestamp(os.path.getmtime(path))).date()
+            days[day].append((path, (taken, file_type)))
+    return dict(sorted(days.items()))
+
+def day_key(day, entries):
+    h = hashlib.sha1(str(day).encode())
+    for path, _ in sorted(entries):
+        h.update(f"|{os.path.basename(path)}:{os.path.getsize(path)}".encode())
+    return h.hexdigest()
+
+def load_checkpoint(path):
+    done = set()
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["key"])
+                except (ValueError, KeyError):
+                    continue
+    except OSError:
+        pass
+    return done
+
+def append_checkpoint(path, record):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# --- 各阶段 ---
+def prepare_stage(todo, out_q):
+    while True:
+        try:
+            day, key, entries = todo.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            files = [load_file(path) for path, _ in entries]
+            infos = [info for _, info in entries]
+            user_content, _, _, duplicates, payload_mb = assemble_payload(files, {}, file_infos=infos)
+            # 记录图片指纹，之后在应用里对这一天做增量更新时不会把这些图片再计一次
+            digests, _ = file_digests(files)
+            messages = [
+                {"role": "system", "content": build_system_prompt(RESPONSE_SCHEMA)},
+                {"role": "user", "content": user_content},
+            ]
+            out_q.put({"day": day, "key": key, "images": len(files), "digests": digests,
+                       "duplicates": len(duplicates), "payload_mb": payload_mb, "messages": messages})
+        except Exception as e:
+            out_q.put({"day": day, "key": key, "error": f"预处理失败: {e}"})
+
+def llm_stage(client, in_q, out_q, use_cache):
+    while True:
+        job = in_q.get()
+        if job is _DONE:
+            return
+        if "error" not in job:
+            try:
+                data, missing, repaired, cached = llm.complete_report(client, job.pop("messages"), SECTION_KEYS, use_cache)
+                job.update(data=data, missing=missing, repaired=repaired, cached=cached)
+            except Exception as e:
+                job["error"] = f"模型调用失败: {e}"
+        out_q.put(job)
+
+def run(days, args, client, writer):
+    todo = queue.Queue()
+    for item in days:
+        todo.put(item)
+    prepared = queue.Queue(maxsize=args.queue_size)
+    analyzed = queue.Queue(maxsize=args.queue_size)
+
+    preparers = [threading.Thread(target=prepare_stage, args=(todo, prepared), daemon=True)
+                 for _ in range(args.prep_workers)]
+    callers = [threading.Thread(target=llm_stage, args=(client, prepared, analyzed, not args.no_cache), daemon=True)
+               for _ in range(args.llm_workers)]
+    for t in preparers + callers:
+        t.start()
+
+    def close_llm_stage():
+        for t in preparers:
+            t.join()
+        for _ in callers:
+            prepared.put(_DONE)
+    threading.Thread(target=close_llm_stage, daemon=True).start()
+
+    start = time.perf_counter()
+    ok = failed = 0
+    for n in range(1, len(days) + 1):
+        job = analyzed.get()
+        day = job["day"]
+        if "error" in job:
+            failed += 1
+            print(f"[{n}/{len(days)}] {day} ✗ {job['error']}", flush=True)
+            continue
+        data = normalize_data(job["data"], target_date=datetime.combine(day, datetime.min.time()))
+        prepare_strength(data)
+        history_store.save_report(data, images=job["digests"])
+        if writer is not None:
+            writer.enqueue(sheets.build_row(data))
+        append_checkpoint(args.checkpoint, {
+            "key": job["key"], "date": data["日期"], "images": job["images"],
+            "missing": job["missing"], "repaired": job["repaired"], "cached": job["cached"], "finished": time.time(),
+        })
+        ok += 1
+        rate = ok / max(time.perf_counter() - start, 1e-9) * 60
+        note = f", 缺失 {','.join(job['missing'])}" if job["missing"] else ""
+        note += f", 补全 {','.join(job['repaired'])}" if job["repaired"] else ""
+        note += ", 缓存" if job["cached"] else ""
+        print(f"[{n}/{len(days)}] {day} ✓ {job['images']} 张 ({job['payload_mb']:.1f} MB{note}) | {rate:.2f} days/min", flush=True)
+    return ok, failed, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量回填历史照片/截图到历史库与 Google Sheet")
+    parser.add_argument("directory", help="图片目录 (递归扫描 jpg/jpeg/png)")
+    parser.add_argument("--prep-workers", type=int, default=1, help="并行预处理的天数 (单天内已使用进程池)")
+    parser.add_argument("--llm-workers", type=int, default=4, help="并发模型请求数")
+    parser.add_argument("--queue-size", type=int, default=2, help="阶段间缓冲的天数，限制内存占用")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="已完成天的记录文件，重跑时跳过")
+    parser.add_argument("--no-cache", action="store_true", help="跳过 LLM 响应缓存")
+    parser.add_argument("--sheet-url", default=os.getenv("SPREADSHEET_URL", ""), help="同步到的 Google Sheet")
+    parser.add_argument("--credentials", default=os.getenv("GCP_SERVICE_ACCOUNT_FILE", ""), help="Service Account JSON 文件")
+    parser.add_argument("--sheet-timeout", type=float, default=SHEET_WAIT_SECONDS, help="等待 Sheet 同步完成的秒数")
+    parser.add_argument("--dry-run", action="store_true", help="只打印按天分组结果")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    grouped = group_by_day(args.directory)
+    done = load_checkpoint(args.checkpoint)
+    days = []
+    for day, entries in grouped.items():
+        key = day_key(day, entries)
+        if key not in done:
+            days.append((day, key, entries))
+    print(f"共 {len(grouped)} 天, 已完成 {len(grouped) - len(days)} 天, 待处理 {len(days)} 天")
+    if args.dry_run:
+        for day, _, entries in days:
+            print(f"  {day}: {len(entries)} 张")
+        return 0
+    if not days:
+        return 0
+
+    api_key = os.getenv("POIXE_API_KEY", "")
+    if not api_key:
+        print("未配置 POIXE_API_KEY", file=sys.stderr)
+        return 1
+    client = transport.get_client(api_key, llm.BASE_URL)
+
+    writer = None
+    if args.sheet_url and args.credentials:
+        with open(args.credentials, encoding="utf-8") as f:
+            writer = sheets.get_writer(args.sheet_url, json.load(f))
+
+    ok, failed, elapsed = run(days, args, client, writer)
+    print(f"完成 {ok} 天, 失败 {failed} 天, 用时 {elapsed:.1f}s, 吞吐 {ok / max(elapsed, 1e-9) * 60:.2f} days/min")
+    if writer is not None:
+        print(f"等待 Sheet 同步队列 ({writer.depth()} 行)...")
+        if not writer.wait_idle(args.sheet_timeout):
+            # 未写入的行保留在 spool 文件中，下次运行 (或启动应用) 时继续同步
+            error = f": {writer.last_error}" if writer.last_error else ""
+            print(f"Sheet 同步超时，{writer.depth()} 行仍在 spool 中 ({writer.spool_path}){error}", file=sys.stderr)
+            return 3
+    return 0 if not failed else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
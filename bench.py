@@ -0,0 +1,575 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import base64
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 可复现的性能基准：合成图片语料 + 微基准 + 端到端 (本地假 OpenAI 服务 / 假 gspread)，结果输出为 JSON
+# 用法: python bench.py [--suite micro,e2e] [--repeat 5] [--latency 0.5] [--output result.json] [--baseline old.json]
+#       python bench.py --serve 8765   # 只启动假模型服务，可配合 LLM_BASE_URL=http://127.0.0.1:8765/v1 运行 app.py
+
+# 基准运行不写入项目 .cache (历史库 / 性能日志 / 响应缓存)，须在导入项目模块之前设置
+BENCH_DIR = tempfile.mkdtemp(prefix="health-bench-")
+os.environ.setdefault("HISTORY_DB_PATH", os.path.join(BENCH_DIR, "history.sqlite3"))
+os.environ.setdefault("METRICS_LOG_PATH", os.path.join(BENCH_DIR, "metrics.jsonl"))
+os.environ.setdefault("LLM_CACHE_DIR", os.path.join(BENCH_DIR, "llm"))
+os.environ.setdefault("SHEET_SPOOL_PATH", os.path.join(BENCH_DIR, "sheet_spool.jsonl"))
+os.environ["IMAGE_CACHE_DIR"] = ""
+
+import numpy as np
+from PIL import Image
+import llm
+import sheets
+import metrics
+import transport
+import admission
+from imaging import smart_process_image, parse_file_info, capture_info, decode_budget, image_cache, vision_tokens
+from pipeline import normalize_data, prepare_strength, assemble_payload, RESPONSE_SCHEMA, build_system_prompt
+from history import HistoryStore
+from schema import SECTION_KEYS
+from llm import extract_json_from_response
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "bench_corpus")
+CORPUS_VERSION = "1"
+SEED = 20240101
+START_DATE = datetime(2025, 3, 3)
+
+
+# 1. 合成语料
+# 每天的文件: (文件名模板, 类别, 宽, 高, 格式, 是否写入 EXIF 拍摄时间)
+DAY_SPEC = [
+    ("IMG_{date}_{hms}.jpg", "photo", 4032, 3024, "JPEG", False),
+    ("IMG_{date}_{hms}.jpg", "photo", 3000, 4000, "JPEG", False),
+    ("IMG_{date}_{hms}.jpg", "photo", 1920, 1080, "JPEG", False),
+    ("food_{n}.jpg", "photo", 1600, 1200, "JPEG", True),
+    ("snack_{n}.png", "photo", 800, 800, "PNG", False),
+    ("Screenshot_{date}_{hms}_ReactNative.jpg", "screenshot", 1080, 5400, "JPEG", False),
+    ("SHealth_{n}.png", "screenshot", 1080, 2400, "PNG", False),
+    ("SHealth_{n}.jpg", "screenshot", 1080, 7200, "JPEG", False),
+]
+
+def _photo(rng, width, height):
+    # 低频色块放大 + 细噪声，压缩后体积接近手机照片
+    base = Image.fromarray(rng.integers(0, 256, (max(2, height // 96), max(2, width // 96), 3), dtype=np.uint8))
+    pixels = np.asarray(base.resize((width, height), Image.Resampling.BICUBIC), dtype=np.int16)
+    pixels += rng.integers(-10, 11, (height, width, 1), dtype=np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+def _screenshot(rng, width, height):
+    # 白底 + 逐行深色 "文字" 条块，模拟 OCR 截图
+    pixels = np.full((height, width, 3), 250, dtype=np.uint8)
+    for top in range(24, height - 40, 44):
+        x = 32
+        while x < width - 64:
+            w = int(rng.integers(20, 140))
+            pixels[top:top + 22, x:min(x + w, width - 32)] = rng.integers(20, 90)
+            x += w + int(rng.integers(10, 24))
+    return Image.fromarray(pixels)
+
+def generate_corpus(directory, days):
+    """
+    生成 days 天的语料并写入 manifest.json；同参数的语料已存在时直接复用
+    """
+    manifest_path = os.path.join(directory, "manifest.json")
+    spec = {"version": CORPUS_VERSION, "seed": SEED, "days": days}
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["spec"] == spec and all(os.path.exists(os.path.join(directory, e["name"])) for e in manifest["files"]):
+            return manifest["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(SEED)
+    files = []
+    n = 0
+    for day in range(days):
+        date = START_DATE + timedelta(days=day)
+        for slot, (template, kind, width, height, fmt, with_exif) in enumerate(DAY_SPEC):
+            n += 1
+            taken = date + timedelta(hours=8 + slot * 1.5)
+            name = template.format(date=taken.strftime("%Y%m%d"), hms=taken.strftime("%H%M%S"), n=n)
+            image = _photo(rng, width, height) if kind == "photo" else _screenshot(rng, width, height)
+            options = {"quality": 92} if fmt == "JPEG" else {}
+            if with_exif:
+                exif = Image.Exif()
+                exif.get_ifd(0x8769)[36867] = taken.strftime("%Y:%m:%d %H:%M:%S")
+                options["exif"] = exif.tobytes()
+            path = os.path.join(directory, name)
+            image.save(path, fmt, **options)
+            files.append({"name": name, "kind": kind, "format": fmt, "day": date.strftime("%Y-%m-%d"),
+                          "width": width, "height": height, "bytes": os.path.getsize(path)})
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"spec": spec, "files": files}, f, ensure_ascii=False, indent=1)
+    return files
+
+def load_upload(directory, name):
+    with open(os.path.join(directory, name), "rb") as f:
+        buf = io.BytesIO(f.read())
+    buf.name = name
+    return buf
+
+
+# 2. 离线替身
+FAKE_REPORT = {
+    "营养摄入汇总": {"总热量": 2150, "总蛋白质": 142, "总碳水": 230, "总脂肪": 68, "总膳食纤维": 26, "总盈余缺口分析": "缺口约 350 kcal"},
+    "早餐": {"时间": "08:00", "内容": "燕麦 + 鸡蛋 2 个 + 牛奶", "热量": 520, "蛋白质": 32, "碳水": 60, "脂肪": 16, "膳食纤维": 8, "点评": "蛋白质充足"},
+    "午餐": {"时间": "12:30", "内容": "米饭 + 鸡胸肉 + 西兰花", "热量": 680, "蛋白质": 48, "碳水": 85, "脂肪": 14, "膳食纤维": 7, "点评": "均衡"},
+    "晚餐": {"时间": "19:00", "内容": "三文鱼 + 红薯 + 沙拉", "热量": 620, "蛋白质": 40, "碳水": 55, "脂肪": 26, "膳食纤维": 9, "点评": "脂肪来源优质"},
+    "加餐": {"时间": "16:00", "内容": "蛋白粉 32g + 香蕉", "热量": 330, "蛋白质": 22, "碳水": 30, "脂肪": 12, "膳食纤维": 2, "点评": ""},
+    "睡眠": {"入睡时间": "23:40", "起床时间": "07:10", "睡眠总时长": "7h 30min", "睡眠阶段分析": "深睡 1h 20min，REM 1h 35min", "睡眠点评": "规律"},
+    "心率": {"静息心率": 56, "平均静息范围": "54-60", "全天心率范围": "52-168", "心率时序分析": "训练时段峰值 168", "心率点评": "正常"},
+    "压力": {"压力均值": 38, "压力时序分析": "午后略高", "压力点评": "整体放松"},
+    "全天消耗与活动": {"总步数": 9800, "活动时长": "1h 25min", "活动卡路里": 620, "燃烧的卡路里总数": 2500},
+    "力量训练": {
+        "力量主题": "胸 + 三头", "具体时间": "18:00", "训练时长": "65min",
+        "动作流水明细": [
+            {"动作名称": name, "OCR原始行": f"{s}/ {w}kg {r}", "组序号": str(s), "重量": w, "次数": r}
+            for name, w, r in (("杠铃卧推", 60, 8), ("上斜哑铃卧推", "22+22", 10), ("绳索下压", 25, 12))
+            for s in range(1, 5)
+        ],
+        "总容量": 0, "消耗估算": 320, "力量点评": "容量稳定",
+    },
+    "有氧训练": {"有氧类型": "跑步", "具体时间": "07:30", "距离": "5.2km", "有氧时长": "31min", "平均心率": 148,
+              "平均步频": 172, "平均步速": "5'58\"", "有氧卡路里消耗": 380},
+    "本日总结": {"本日分析": "摄入与训练匹配，蛋白质达标。", "指导建议": "保持睡眠节律，明日安排腿部训练。"},
+}
+
+def fake_completion_text(system_prompt):
+    """
+    按 system prompt 中出现的 schema 键返回对应板块 (分段 / 修复 / 增量请求同样适用)
+    """
+    out = {k: v for k, v in FAKE_REPORT.items() if f'"{k}"' in system_prompt}
+    if '"总盈余缺口分析"' in system_prompt and "营养摄入汇总" not in out:
+        out["总盈余缺口分析"] = FAKE_REPORT["营养摄入汇总"]["总盈余缺口分析"]
+    return json.dumps(out or FAKE_REPORT, ensure_ascii=False, indent=1)
+
+def prompt_tokens(messages):
+    """
+    粗略 token 计数：文本按 4 字符 1 token，图片按实际尺寸计算视觉 token
+    """
+    total = 0
+    for message in messages:
+        content = message.get("content", "")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                data = part["image_url"]["url"].partition(",")[2]
+                with Image.open(io.BytesIO(base64.b64decode(data))) as image:
+                    total += vision_tokens(*image.size)
+            else:
+                total += len(part.get("text", "")) // 4
+    return total
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI 兼容的 /chat/completions：固定延迟 (模拟排队 + 推理)，流式时按 chunk 间隔逐段输出
+    可按比例注入 503 失败与长尾延迟，用于验证重试 / 熔断 / 对冲
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # 对冲落败的流式请求会被客户端提前关闭
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.requests += 1
+            roll = self.server.rng.random()
+        if roll < self.server.fail_ratio:
+            self._json(503, {"error": {"message": "bench: injected overload", "type": "server_error"}})
+            return
+        time.sleep(self.server.tail_latency if roll < self.server.fail_ratio + self.server.tail_ratio else self.server.latency)
+        messages = body.get("messages", [])
+        text = fake_completion_text(messages[0].get("content", "") if messages else "")
+        usage = {"prompt_tokens": prompt_tokens(messages), "completion_tokens": len(text) // 2}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model", "bench")}
+
+        if not body.get("stream"):
+            self._json(200, dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+            ]))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [text[i:i + self.server.chunk_chars] for i in range(0, len(text), self.server.chunk_chars)]
+        for i, piece in enumerate(pieces):
+            finish = "stop" if i == len(pieces) - 1 else None
+            self._event(dict(base, object="chat.completion.chunk", choices=[
+                {"index": 0, "delta": {"content": piece}, "finish_reason": finish}
+            ]))
+            time.sleep(self.server.chunk_delay)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._event(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        self._chunk(b"data: [DONE]\n\n")
+        self._chunk(b"")
+
+    def _json(self, status, obj):
+        payload = json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _event(self, obj):
+        self._chunk(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode())
+
+    def _chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+def start_fake_openai(latency=0.5, chunk_delay=0.01, chunk_chars=64, port=0,
+                      fail_ratio=0.0, tail_ratio=0.0, tail_latency=5.0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_ratio = fail_ratio
+    server.tail_ratio = tail_ratio
+    server.tail_latency = tail_latency
+    server.rng = random.Random(SEED)
+    server.lock = threading.Lock()
+    server.chunk_delay = chunk_delay
+    server.chunk_chars = chunk_chars
+    server.requests = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class FakeWorksheet:
+    """
+    SheetWriter / sync_from_sheet 用到的 gspread Worksheet 子集，每次调用附加固定延迟
+    """
+    def __init__(self, latency=0.0):
+        self.rows = []
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def col_values(self, col):
+        self._call()
+        with self._lock:
+            return [row[col - 1] if len(row) >= col else "" for row in self.rows]
+
+    def get(self, range_name):
+        self._call()
+        start, _, end = range_name.partition(":")
+        first = int("".join(c for c in start if c.isdigit()) or 1)
+        last = int("".join(c for c in end if c.isdigit()) or len(self.rows))
+        with self._lock:
+            return [list(row) for row in self.rows[first - 1:last]]
+
+    def batch_get(self, ranges):
+        self._call()
+        with self._lock:
+            out = []
+            for range_name in ranges:
+                row = int("".join(c for c in range_name if c.isdigit()))
+                out.append([[self.rows[row - 1][0]]] if row <= len(self.rows) and self.rows[row - 1] else [])
+            return out
+
+    def batch_update(self, updates):
+        self._call()
+        with self._lock:
+            for update in updates:
+                row = int("".join(c for c in update["range"] if c.isdigit()))
+                self.rows[row - 1] = list(update["values"][0])
+
+    def append_rows(self, rows):
+        self._call()
+        with self._lock:
+            start = len(self.rows) + 1
+            self.rows.extend(list(row) for row in rows)
+            return {"updates": {"updatedRange": f"Sheet1!A{start}:BV{len(self.rows)}"}}
+
+class FakeSheetClient:
+    def __init__(self, latency=0.0):
+        self.sheet1 = FakeWorksheet(latency)
+
+    def open_by_url(self, url):
+        return self
+
+
+# 3. 计时与统计
+def stats(samples, **extra):
+    values = np.asarray(samples, dtype=float)
+    return dict(
+        n=len(values), unit="s",
+        mean=round(float(values.mean()), 6), p50=round(float(np.percentile(values, 50)), 6),
+        p95=round(float(np.percentile(values, 95)), 6), min=round(float(values.min()), 6),
+        max=round(float(values.max()), 6), **extra,
+    )
+
+def measure(fn, repeat, setup=None, warmup=1):
+    """
+    每轮先调用 setup (不计时)，再计时 fn；预热轮次不计入结果
+    """
+    samples = []
+    for i in range(warmup + repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        fn()
+        if i >= warmup:
+            samples.append(time.perf_counter() - t)
+    return samples
+
+def cold_cache():
+    image_cache.memory.clear()
+
+
+# 4. 微基准
+def micro_benchmarks(corpus_dir, files, repeat):
+    results = {}
+    budget = decode_budget()
+    uploads = {e["name"]: load_upload(corpus_dir, e["name"]) for e in files}
+
+    # smart_process_image：每种 (类别, 格式, 尺寸) 取第一天的一张
+    seen = set()
+    for entry in files:
+        key = (entry["kind"], entry["format"], entry["width"], entry["height"])
+        if key in seen:
+            continue
+        seen.add(key)
+        upload = uploads[entry["name"]]
+        file_type = parse_file_info(entry["name"])[1]
+        samples = measure(lambda: smart_process_image(upload, budget, file_type, 0), repeat)
+        name = f"smart_process_image/{entry['kind']}_{entry['format'].lower()}_{entry['width']}x{entry['height']}"
+        results[name] = stats(samples, input_bytes=entry["bytes"])
+
+    names = [e["name"] for e in files]
+    samples = measure(lambda: [parse_file_info(n) for n in names], repeat)
+    results["parse_file_info/per_file"] = stats([s / len(names) for s in samples])
+    upload_list = list(uploads.values())
+    samples = measure(lambda: [capture_info(u) for u in upload_list], repeat)
+    results["capture_info/per_file"] = stats([s / len(upload_list) for s in samples])
+
+    # build_payload 的 Streamlit 无关部分 (预处理 + 去重 + 组装)
+    day = files[0]["day"]
+    day_uploads = [uploads[e["name"]] for e in files if e["day"] == day]
+    payload = {}
+    def assemble():
+        payload["result"] = assemble_payload(day_uploads, {"bcaa": True, "protein": True})
+    results["assemble_payload/cold"] = stats(measure(assemble, repeat, setup=cold_cache),
+                                             images=len(day_uploads), payload_mb=round(payload["result"][4], 2))
+    results["assemble_payload/warm"] = stats(measure(assemble, repeat), images=len(day_uploads))
+
+    text = json.dumps(FAKE_REPORT, ensure_ascii=False, indent=1)
+    variants = {
+        "clean": text,
+        "fenced": f"好的，以下是解析结果：\n```json\n{text}\n```\n",
+        "truncated": text[:int(len(text) * 0.7)],
+    }
+    for label, variant in variants.items():
+        samples = measure(lambda: extract_json_from_response(variant), repeat * 20)
+        results[f"extract_json_from_response/{label}"] = stats(samples, chars=len(variant))
+
+    # normalize_data 不修改输入，可重复使用同一份部分结果
+    partial = {k: v for k, v in FAKE_REPORT.items() if k not in ("睡眠", "心率", "有氧训练")}
+    results["normalize_data"] = stats(measure(lambda: normalize_data(partial, target_date=START_DATE), repeat * 20))
+    report = normalize_data(FAKE_REPORT, target_date=START_DATE)
+    results["build_row"] = stats(measure(lambda: sheets.build_row(report), repeat * 20))
+    return results
+
+
+# 5. 端到端 (假模型服务 + 假 Sheet)
+def e2e_benchmarks(corpus_dir, files, repeat, args):
+    """
+    模型调用经过 transport.ModelTransport (长连接池 / 重试 / 熔断 / 对冲)，与应用中的路径一致
+    """
+    results = {}
+    server = start_fake_openai(latency=args.latency, fail_ratio=args.fail_ratio,
+                               tail_ratio=args.tail_ratio, tail_latency=args.tail_latency)
+    if args.hedge_after:
+        transport.HEDGE_AFTER_SECONDS = args.hedge_after
+    client = transport.ModelTransport("bench", server.url, hedge_model=args.hedge_model)
+    latency, sheet_latency = args.latency, args.sheet_latency
+    sheet_client = FakeSheetClient(sheet_latency)
+    writer = sheets.SheetWriter("bench://sheet", {}, spool_path=os.path.join(BENCH_DIR, "spool.jsonl"),
+                                client_factory=lambda: sheet_client)
+    store = HistoryStore(os.path.join(BENCH_DIR, "e2e_history.sqlite3"))
+    log_path = os.path.join(BENCH_DIR, "e2e_metrics.jsonl")
+
+    days = {}
+    for entry in files:
+        days.setdefault(entry["day"], []).append(entry["name"])
+
+    def run_day(mode, day, names):
+        uploads = [load_upload(corpus_dir, n) for n in names]
+        metrics.start_run("bench", mode=mode, day=day)
+        user_content, report_date, _, _, _ = assemble_payload(uploads, {})
+        messages = [
+            {"role": "system", "content": build_system_prompt(RESPONSE_SCHEMA)},
+            {"role": "user", "content": user_content},
+        ]
+        if mode == "stream":
+            text = "".join(llm.stream_completion(client, messages, **llm.JSON_PARAMS))
+            with metrics.span("JSON 解析"):
+                data, _ = llm.decode_response(text, SECTION_KEYS)
+        else:
+            data, _, _, _ = llm.complete_report(client, messages, SECTION_KEYS, use_cache=False)
+        with metrics.span("数据归一化"):
+            data = normalize_data(data, target_date=report_date)
+            prepare_strength(data)
+        with metrics.span("历史库写入"):
+            store.save_report(data)
+        with metrics.span("Sheet 入队"):
+            writer.enqueue(sheets.build_row(data))
+        return metrics.finish_run(log_path)
+
+    for mode in ("plain", "stream"):
+        records = []
+        for _ in range(repeat):
+            for day, names in days.items():
+                cold_cache()
+                records.append(run_day(mode, day, names))
+
+        results[f"e2e/{mode}/total"] = stats([r["total"] for r in records], days=len(days), latency=latency)
+        for stage in records[0]["stages"]:
+            results[f"e2e/{mode}/{stage}"] = stats([r["stages"].get(stage, 0.0) for r in records])
+        results[f"e2e/{mode}/tokens"] = {
+            "n": len(records), "unit": "tokens",
+            "prompt_p50": float(np.percentile([r["tokens"]["prompt_tokens"] for r in records], 50)),
+            "completion_p50": float(np.percentile([r["tokens"]["completion_tokens"] for r in records], 50)),
+        }
+
+    # 多会话同时生成报告：各线程绑定不同会话，经 admission 的公平队列共享 CPU 槽位与模型并发
+    if args.sessions > 1:
+        records = []
+
+        def session_worker(k):
+            admission.bind(f"bench-{k}")
+            for day, names in days.items():
+                records.append(run_day("sessions", day, names))
+
+        cold_cache()
+        threads = [threading.Thread(target=session_worker, args=(k,)) for k in range(args.sessions)]
+        t = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results["e2e/sessions/wall"] = stats([time.perf_counter() - t], sessions=args.sessions,
+                                             cpu_slots=admission.CPU_SLOTS, llm_slots=admission.LLM_MAX_CONCURRENCY)
+        results["e2e/sessions/total"] = stats([r["total"] for r in records])
+        for stage in ("图像处理排队", "模型调用排队", "模型调用"):
+            results[f"e2e/sessions/{stage}"] = stats([r["stages"].get(stage, 0.0) for r in records])
+
+    t = time.perf_counter()
+    writer.wait_idle()
+    results["e2e/sheet_drain"] = stats([time.perf_counter() - t], coalesce=sheets.COALESCE_SECONDS,
+                                       rows=len(sheet_client.sheet1.rows), api_calls=sheet_client.sheet1.calls)
+    results["e2e/model_requests"] = {"n": 1, "unit": "requests", "value": server.requests}
+    results["e2e/transport"] = dict(client.stats(), n=1, unit="count")
+    server.shutdown()
+    return results
+
+
+# 6. 输出
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def environment():
+    import pandas
+    import PIL
+    return {
+        "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "numpy": np.__version__, "pandas": pandas.__version__, "pillow": PIL.__version__,
+        "git": git_revision(), "time": datetime.now().isoformat(timespec="seconds"),
+    }
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    print(f"\n{'基准项':<56}{'基线 p50':>12}{'本次 p50':>12}{'比值':>8}")
+    for name, result in results.items():
+        old = baseline.get(name, {}).get("p50")
+        if old is None or "p50" not in result:
+            continue
+        ratio = result["p50"] / old if old else float("nan")
+        print(f"{name:<56}{old:>12.4f}{result['p50']:>12.4f}{ratio:>7.2f}x")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="健康日报流水线性能基准 (离线)")
+    parser.add_argument("--suite", default="micro,e2e", help="逗号分隔: micro / e2e")
+    parser.add_argument("--repeat", type=int, default=5, help="每项计时轮数 (另有 1 轮预热)")
+    parser.add_argument("--days", type=int, default=2, help="合成语料天数 (每天 %d 张)" % len(DAY_SPEC))
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="语料目录，同参数时复用")
+    parser.add_argument("--latency", type=float, default=0.5, help="假模型服务每次请求的延迟 (秒)")
+    parser.add_argument("--sheet-latency", type=float, default=0.05, help="假 Sheet 每次 API 调用的延迟 (秒)")
+    parser.add_argument("--fail-ratio", type=float, default=0.0, help="假模型服务返回 503 的比例")
+    parser.add_argument("--tail-ratio", type=float, default=0.0, help="假模型服务长尾请求的比例")
+    parser.add_argument("--tail-latency", type=float, default=5.0, help="长尾请求的延迟 (秒)")
+    parser.add_argument("--hedge-model", default="", help="对冲使用的备用模型名 (空为关闭)")
+    parser.add_argument("--sessions", type=int, default=4, help="并发会话数 (<=1 时跳过多会话场景)")
+    parser.add_argument("--hedge-after", type=float, default=0.0, help="对冲等待阈值 (秒)，默认取近期 p95")
+    parser.add_argument("--output", help="结果 JSON 路径 (默认输出到 stdout)")
+    parser.add_argument("--baseline", help="与之前的结果 JSON 对比 p50")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="只启动假 OpenAI 服务并阻塞")
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        server = start_fake_openai(latency=args.latency, port=args.serve)
+        print(f"假 OpenAI 服务: {server.url} (Ctrl+C 退出)", file=sys.stderr)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return 0
+
+    suites = {s.strip() for s in args.suite.split(",") if s.strip()}
+    t = time.perf_counter()
+    files = generate_corpus(args.corpus, args.days)
+    print(f"语料: {len(files)} 张 ({sum(e['bytes'] for e in files) / 1024 / 1024:.1f} MB), "
+          f"准备用时 {time.perf_counter() - t:.1f}s", file=sys.stderr)
+
+    results = {}
+    if "micro" in suites:
+        results.update(micro_benchmarks(args.corpus, files, args.repeat))
+    if "e2e" in suites:
+        results.update(e2e_benchmarks(args.corpus, files, args.repeat, args))
+
+    report = {"environment": environment(), "args": vars(args), "results": results}
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        compare(results, args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
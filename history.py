@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+import pandas as pd
+from sheets import build_row
+from schema import COLUMNS, to_number, to_minutes, to_km
+
+# 本地历史库 (SQLite)：与 Google Sheet 同列、按类型解析 ("7h 30min" → 分钟, "5.2km" → 公里)
+
+DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "history.sqlite3"))
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# 报告写入时额外保存完整动作明细 (Sheet 中只有拼接后的字符串)
+SETS_COLUMN = "力量训练_动作流水明细_json"
+# 增量更新用：归一化后的完整报告 + 已分析过的图片指纹
+REPORT_COLUMN = "报告_json"
+IMAGES_COLUMN = "图片指纹_json"
+
+PARSERS = {
+    "text": lambda v: None if v is None else str(v),
+    "num": to_number,
+    "minutes": to_minutes,
+    "hours": lambda v: to_minutes(v, default_unit=60),
+    "km": to_km,
+}
+
+def parse_row(row):
+    """
+    Sheet 扁平行 (build_row 输出或从表格读回的字符串) → {列名: 类型化值}
+    """
+    record = {}
+    for (name, kind), value in zip(COLUMNS, row):
+        record[name] = PARSERS[kind](value if value != "" else None)
+    return record
+
+
+class HistoryStore:
+    def __init__(self, path=DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        columns = [(name, "TEXT" if kind == "text" else "REAL") for name, kind in COLUMNS]
+        columns += [(SETS_COLUMN, "TEXT"), (REPORT_COLUMN, "TEXT"), (IMAGES_COLUMN, "TEXT"),
+                    ("更新时间", "REAL"), ("来源", "TEXT")]
+        with self._lock, self._conn:
+            defs = ", ".join(f'"{name}" {sql_type}' for name, sql_type in columns)
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS days ({defs}, PRIMARY KEY ("日期"))')
+            # 新增列时就地迁移
+            existing = {r[1] for r in self._conn.execute("PRAGMA table_info(days)")}
+            for name, sql_type in columns:
+                if name not in existing:
+                    self._conn.execute(f'ALTER TABLE days ADD COLUMN "{name}" {sql_type}')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS days_updated ON days ("更新时间")')
+
+    def upsert(self, records, source):
+        with self._lock, self._conn:
+            # 在锁内取时间戳：同一进程内更新时间与提交顺序一致，不会落在已读取的水位之前
+            now = time.time()
+            for record in records:
+                record = dict(record, 更新时间=now, 来源=source)
+                names = list(record)
+                cols = ", ".join(f'"{n}"' for n in names)
+                marks = ", ".join("?" for _ in names)
+                updates = ", ".join(f'"{n}" = excluded."{n}"' for n in names if n != "日期")
+                self._conn.execute(
+                    f'INSERT INTO days ({cols}) VALUES ({marks}) ON CONFLICT("日期") DO UPDATE SET {updates}',
+                    [record[n] for n in names],
+                )
+
+    def save_report(self, data, images=None):
+        """
+        images: 本次报告覆盖的图片指纹 (含补剂标记)，供下次增量更新跳过已分析的图片
+        """
+        record = parse_row(build_row(data))
+        record[SETS_COLUMN] = json.dumps(data.get("力量训练", {}).get("动作流水明细", []), ensure_ascii=False)
+        record[REPORT_COLUMN] = json.dumps(data, ensure_ascii=False)
+        if images is not None:
+            record[IMAGES_COLUMN] = json.dumps(sorted(images))
+        self.upsert([record], "report")
+
+    def load_report(self, date):
+        """
+        返回 (报告 dict 或 None, 已分析图片指纹 set)
+        """
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT "{REPORT_COLUMN}", "{IMAGES_COLUMN}" FROM days WHERE "日期" = ?', (date,)
+            ).fetchone()
+        if not row or not row[0]:
+            return None, set()
+        return json.loads(row[0]), set(json.loads(row[1] or "[]"))
+
+    def dates(self):
+        with self._lock:
+            return {r[0] for r in self._conn.execute('SELECT "日期" FROM days')}
+
+    def watermark(self):
+        with self._lock:
+            return self._conn.execute('SELECT MAX("日期") FROM days').fetchone()[0]
+
+    def frame(self, columns=None, since=None, updated_after=None):
+        """
+        按日期升序返回 DataFrame；columns 为空时返回全部列
+        updated_after: 只返回该时间戳之后写入/更新的行 (增量刷新用)
+        """
+        cols = ", ".join(f'"{c}"' for c in (["日期"] + [c for c in columns if c != "日期"])) if columns else "*"
+        query = f'SELECT {cols} FROM days'
+        where = []
+        params = []
+        if since:
+            where.append('"日期" >= ?')
+            params.append(since)
+        if updated_after is not None:
+            where.append('"更新时间" > ?')
+            params.append(updated_after)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += ' ORDER BY "日期"'
+        with self._lock:
+            return pd.read_sql_query(query, self._conn, params=params)
+
+    def version(self):
+        """
+        (行数, 最近更新时间)：任一变化即说明历史库有写入，供派生结果判断缓存是否失效
+        """
+        with self._lock:
+            return tuple(self._conn.execute('SELECT COUNT(*), MAX("更新时间") FROM days').fetchone())
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM days").fetchone()[0]
+
+
+history_store = HistoryStore()
+
+
+# --- 与 Google Sheet 同步 ---
+def sync_from_sheet(store, sheet):
+    """
+    只读 A 列日期；晚于本地水位线或本地缺失的日期才读取整行，返回导入天数
+    """
+    known = store.dates()
+    mark = store.watermark() or ""
+    targets = {}
+    for i, date in enumerate(sheet.col_values(1)):
+        if DATE_RE.match(date or "") and (date > mark or date not in known):
+            targets[i + 1] = date
+    if not targets:
+        return 0
+    lo, hi = min(targets), max(targets)
+    rows = sheet.get(f"A{lo}:{hi}")
+    records = [parse_row(row) for offset, row in enumerate(rows) if lo + offset in targets]
+    store.upsert(records, "sheet")
+    return len(records)
+
+_synced = set()
+_synced_lock = threading.Lock()
+
+def schedule_sync(writer, store=None):
+    """
+    每个进程每个表格只同步一次，在写入线程中执行 (共用缓存的工作表句柄与重试)
+    """
+    store = store or history_store
+    with _synced_lock:
+        if writer.sheet_url in _synced:
+            return
+        _synced.add(writer.sheet_url)
+    writer.submit(lambda sheet: sync_from_sheet(store, sheet))
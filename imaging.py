@@ -0,0 +1,895 @@
+import io
+import os
+import re
+import math
+import zlib
+import base64
+import hashlib
+import time
+import threading
+import multiprocessing
+import numpy as np
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from cache import MemoryLRU, DiskCache, TieredCache
+import metrics
+import admission
+
+# 图像预处理工具 (独立模块，进程池子进程可直接导入，不依赖 Streamlit 脚本)
+
+# 少于该数量的大图直接串行处理，进程调度开销不划算
+PARALLEL_MIN_FILES = 4
+# 小于该大小的食物照片直接透传，不做解码 (截图见 passthrough)
+PASSTHROUGH_KB = 500
+TARGET_WIDTH = 2048
+# JPEG DCT 降采样允许略低于目标宽度 (4000px 照片可 1/2 解码到 2000px，而不是全尺寸解码)
+DRAFT_SLACK = 0.9
+# 单次请求解码像素的内存上限 (MB)，并行时按进程数平分
+DECODE_MEMORY_MB = int(os.getenv("DECODE_MEMORY_MB", "256"))
+# Pillow 内部 RGB/RGBA 每像素 4 字节
+BYTES_PER_PIXEL = 4
+
+# 预处理逻辑变更时递增，使旧缓存失效
+PROCESS_VERSION = "6"
+
+# 编码档位 (最大宽度, JPEG 质量)，第 0 档为默认质量，超出预算时逐档下调
+# 食物照片先降；截图保持原宽度优先降质量，保证 OCR 可读
+ENCODE_LADDERS = {
+    "food": [(TARGET_WIDTH, 75), (1600, 70), (1280, 65), (1024, 60), (768, 55)],
+    "screenshot": [(None, 95), (None, 85), (None, 75), (1080, 70)],
+}
+# 预算不足时的降档顺序
+PROFILE_PRIORITY = ["food", "screenshot"]
+# JPEG 体积随质量的相对系数 (经验值，仅用于预估)，透传原图按 90 估计
+QUALITY_SIZE_FACTOR = {95: 2.4, 90: 1.8, 85: 1.45, 75: 1.0, 70: 0.9, 65: 0.82, 60: 0.75, 55: 0.7}
+PASSTHROUGH_QUALITY = 90
+
+# 整个请求的图片预算：base64 后的总字节数 & 视觉 token 数
+PAYLOAD_BUDGET_MB = float(os.getenv("PAYLOAD_BUDGET_MB", "16"))
+PAYLOAD_TOKEN_BUDGET = int(os.getenv("PAYLOAD_TOKEN_BUDGET", "60000"))
+# Gemini 视觉计费：两边都不超过 384px 计 258 token，否则按 768px 切块每块 258
+VISION_TILE = 768
+VISION_TOKENS_PER_TILE = 258
+ALLOCATION_ROUNDS = 3
+
+# 截图裁剪/切块
+SCREENSHOT_TRIM = os.getenv("SCREENSHOT_TRIM", "1") != "0"
+# 与背景灰度差超过该值视为有内容；一行至少 INK_MIN_PIXELS 个内容像素才算非空行 (过滤 JPEG 噪点)
+INK_THRESHOLD = 24
+INK_MIN_PIXELS = 3
+# 全屏截图 (高宽比 >= 1.6) 顶部状态栏高度约为宽度的 6%
+STATUS_BAR_RATIO = 0.06
+FULLSCREEN_ASPECT = 1.6
+# 连续空白超过宽度的 8% 视为可丢弃区域，保留 BLANK_SPACER px 间隔
+BLANK_GAP_RATIO = 0.08
+BLANK_SPACER = 16
+CONTENT_PADDING = 8
+# 高度超过宽度 TILE_MAX_ASPECT 倍的长截图切块，每块高度约为宽度的 TILE_ASPECT 倍
+TILE_MAX_ASPECT = 3.0
+TILE_ASPECT = 2.0
+# 整图超出解码上限的 PNG 截图按行带解码：支持的原始模式及每像素字节数 (非隔行、8 位)
+PNG_BAND_BYTES = {"L": 1, "LA": 2, "RGB": 3, "RGBA": 4, "P": 1}
+# 行带只占解码上限的 1/4，其余留给灰度、内容掩码和正在拼接的块
+BAND_SHARE = 4
+BAND_MIN_ROWS = 16
+
+# 近似重复检测：16x16 dHash (256 bit)
+HASH_SIZE = 16
+# 食物照片汉明距离阈值 (同一餐重拍/缩放/亮度变化约 10，不同照片 > 100)
+DEDUPE_FOOD_DISTANCE = 24
+# 截图的 dHash 对文字变化不敏感，仅作预筛；再逐像素确认差异像素数
+DEDUPE_SHOT_DISTANCE = 8
+DEDUPE_SHOT_DIFF_PIXELS = 8
+DEDUPE_PIXEL_DELTA = 32
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# --- 处理结果缓存 (按内容哈希) ---
+def _build_cache():
+    memory = MemoryLRU(int(os.getenv("IMAGE_CACHE_MB", "128")) * 1024 * 1024)
+    disk = None
+    cache_dir = os.getenv("IMAGE_CACHE_DIR", "")
+    if cache_dir:
+        disk = DiskCache(cache_dir, int(os.getenv("IMAGE_CACHE_DISK_MB", "512")) * 1024 * 1024)
+    return TieredCache(memory, disk)
+
+image_cache = _build_cache()
+
+def cache_key(digest, profile, level):
+    # 同一内容按类别、档位、解码内存上限编码结果不同，需区分
+    return f"{digest}-{profile}-l{level}-m{decode_budget()}-v{PROCESS_VERSION}"
+
+def _pack(parts):
+    # 头部记录每块的 mime 与长度，随后依次拼接图片字节
+    header = ";".join(f"{mime},{len(img_bytes)}" for img_bytes, mime in parts)
+    return header.encode() + b"\n" + b"".join(img_bytes for img_bytes, _ in parts)
+
+def _unpack(value):
+    header, body = value.split(b"\n", 1)
+    parts = []
+    offset = 0
+    for field in header.decode().split(";"):
+        mime, n = field.rsplit(",", 1)
+        parts.append((body[offset:offset + int(n)], mime))
+        offset += int(n)
+    return parts
+
+
+def image_profile(file_type):
+    return "food" if file_type == "food" else "screenshot"
+
+def passthrough(profile, level, size_kb):
+    """
+    第 0 档的小文件原样上传；截图不论大小都要裁剪，状态栏和空白消耗的视觉 token 与文件字节数无关
+    """
+    if profile == "screenshot" and SCREENSHOT_TRIM:
+        return False
+    return level == 0 and size_kb < PASSTHROUGH_KB
+
+def sniff_mime(head):
+    # 按文件头判断格式，避免把 PNG 标成 image/jpeg
+    head = bytes(head[:12])
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+def _fit_decode(image, target_width, max_decode_bytes):
+    """
+    食物照片：解码前用 JPEG draft 选择 1/2、1/4、1/8 缩放，使解码尺寸接近目标宽度且不超过内存上限
+    返回 False 表示无法在上限内解码
+    """
+    w, h = image.size
+    if image.format == "JPEG":
+        scale = 1
+        if target_width:
+            while scale < 8 and w / (scale * 2) >= target_width * DRAFT_SLACK:
+                scale *= 2
+        if max_decode_bytes:
+            while scale < 8 and math.ceil(w / scale) * math.ceil(h / scale) * BYTES_PER_PIXEL > max_decode_bytes:
+                scale *= 2
+        if scale > 1:
+            image.draft(None, (math.ceil(w / scale), math.ceil(h / scale)))
+            w, h = image.size
+    if max_decode_bytes and w * h * BYTES_PER_PIXEL > max_decode_bytes:
+        return False
+    return True
+
+def _fit_full(image, max_decode_bytes):
+    """
+    截图按原尺寸解码 (DCT 降采样会糊掉小字)；RGB 超出上限的 JPEG 改为灰度解码，只占 1/4 内存
+    返回 False 表示无法在上限内整图解码
+    """
+    w, h = image.size
+    if not max_decode_bytes or w * h * BYTES_PER_PIXEL <= max_decode_bytes:
+        return True
+    if image.format == "JPEG" and w * h <= max_decode_bytes:
+        image.draft("L", image.size)
+        return image.mode == "L"
+    return False
+
+def _band_rawmode(image):
+    """
+    可按行带解码的 PNG 返回原始模式，否则返回 None
+    """
+    if image.format != "PNG" or image.info.get("interlace") or len(image.tile) != 1:
+        return None
+    rawmode = image.tile[0].args
+    return rawmode if rawmode in PNG_BAND_BYTES else None
+
+def _png_idat(data):
+    # 按块长度跳读，依次返回 IDAT 块的数据
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], "big")
+        kind = data[pos + 4:pos + 8]
+        if kind == b"IDAT":
+            yield data[pos + 8:pos + 8 + length]
+        elif kind == b"IEND":
+            return
+        pos += 12 + length
+
+def _png_bands(data, image, rawmode, band_rows):
+    """
+    逐行带解码 PNG：自行解压 IDAT，每个行带前补上一行带的最后一行 (滤波类型 0)，
+    交给 Pillow 的 zip 解码器反滤波；内存只占一个行带
+    依次生成 (y0, 行带图像, 灰度)
+    """
+    w, h = image.size
+    stride = 1 + w * PNG_BAND_BYTES[rawmode]
+    # 直接取 PLTE 原始数据 (getpalette 会触发整图解码)
+    palette = image.palette if rawmode == "P" else None
+    inflater = zlib.decompressobj()
+    pending = bytearray()
+    state = {"y0": 0, "prev": None}
+
+    def emit(rows):
+        n = len(rows) // stride
+        prev = state["prev"]
+        raw = bytes(rows) if prev is None else b"\0" + prev + bytes(rows)
+        band = Image.frombytes(rawmode, (w, n if prev is None else n + 1), zlib.compress(raw, 0), "zip", rawmode)
+        if prev is not None:
+            band = band.crop((0, 1, w, n + 1))
+        state["prev"] = band.crop((0, n - 1, w, n)).tobytes()
+        if palette:
+            band.putpalette(palette.palette, palette.rawmode or palette.mode)
+        if band.mode not in ("RGB", "L"):
+            band = band.convert("RGB")
+        y0 = state["y0"]
+        state["y0"] += n
+        return y0, band, np.asarray(band.convert("L"), dtype=np.int16)
+
+    chunk_bytes = band_rows * stride
+    for chunk in _png_idat(data):
+        while chunk and state["y0"] < h:
+            pending += inflater.decompress(chunk, chunk_bytes)
+            chunk = inflater.unconsumed_tail
+            while len(pending) >= chunk_bytes:
+                yield emit(pending[:chunk_bytes])
+                del pending[:chunk_bytes]
+    rows = min(len(pending) // stride, h - state["y0"])
+    if rows > 0:
+        yield emit(pending[:rows * stride])
+
+def _content_segments(rows, gap):
+    """
+    rows: 每行是否有内容；返回内容行区间 [(y0, y1)]，间隔不超过 gap 的区间合并
+    """
+    idx = np.flatnonzero(rows)
+    if idx.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > gap)
+    starts = np.concatenate(([idx[0]], idx[breaks + 1]))
+    ends = np.concatenate((idx[breaks], [idx[-1]])) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def _split_segment(rows, y0, y1, tile_h):
+    """
+    过高的内容区间按 tile_h 切分，切点优先落在附近的空白行上
+    """
+    pieces = []
+    while y1 - y0 > tile_h:
+        target = y0 + tile_h
+        window = np.flatnonzero(~rows[y0 + tile_h // 2:target]) + y0 + tile_h // 2
+        cut = int(window[-1]) if window.size else target
+        pieces.append((y0, cut))
+        y0 = cut
+    pieces.append((y0, y1))
+    return pieces
+
+def _trim_plan(w, h, bands):
+    """
+    bands(): 每次调用从头生成 (y0, 行带图像, 灰度)，整图时只有一个行带
+    返回 (x0, x1, 各块的内容区间, 背景色)；没有内容时返回 None
+    """
+    # 左右边缘像素的中位数作为背景色
+    bg = int(np.median(np.concatenate([gray[:, [0, -1]].ravel() for _, _, gray in bands()])))
+    rows = np.zeros(h, dtype=bool)
+    # 内容像素留到内容行确定后计算左右边界；分行带时按位压缩保存 (整图只有一个行带时直接保留)
+    packed = []
+    for y0, _, gray in bands():
+        ink = np.abs(gray - bg) > INK_THRESHOLD
+        rows[y0:y0 + len(ink)] = ink.sum(axis=1) >= INK_MIN_PIXELS
+        packed.append((y0, ink if len(ink) == h else np.packbits(ink, axis=1)))
+    if h / w >= FULLSCREEN_ASPECT:
+        rows[:int(w * STATUS_BAR_RATIO)] = False
+
+    segments = _content_segments(rows, int(w * BLANK_GAP_RATIO))
+    if not segments:
+        return None
+    segments = [(max(0, y0 - CONTENT_PADDING), min(h, y1 + CONTENT_PADDING)) for y0, y1 in segments]
+
+    content = np.zeros(h, dtype=bool)
+    for y0, y1 in segments:
+        content[y0:y1] = True
+    counts = np.zeros(w, dtype=np.int64)
+    for y0, bits in packed:
+        ink = bits if bits.dtype == bool else np.unpackbits(bits, axis=1, count=w).view(bool)
+        counts += ink[content[y0:y0 + len(ink)]].sum(axis=0)
+    cols = np.flatnonzero(counts >= INK_MIN_PIXELS)
+    x0 = max(0, int(cols[0]) - CONTENT_PADDING) if cols.size else 0
+    x1 = min(w, int(cols[-1]) + 1 + CONTENT_PADDING) if cols.size else w
+
+    # 按块高度装箱：相邻区间之间只保留 BLANK_SPACER 的间隔
+    # 块高度以原始屏幕宽度为基准，避免内容较窄时切出大量小块 (每块至少计 258 token)
+    tile_h = int(w * TILE_ASPECT)
+    total_h = sum(y1 - y0 for y0, y1 in segments) + BLANK_SPACER * (len(segments) - 1)
+    if total_h <= w * TILE_MAX_ASPECT:
+        tile_h = total_h
+    tiles = [[]]
+    used = 0
+    for y0, y1 in segments:
+        for p0, p1 in _split_segment(rows, y0, y1, tile_h):
+            extra = (p1 - p0) + (BLANK_SPACER if tiles[-1] else 0)
+            if tiles[-1] and used + extra > tile_h:
+                tiles.append([])
+                used = 0
+                extra = p1 - p0
+            tiles[-1].append((p0, p1))
+            used += extra
+    return x0, x1, tiles, bg
+
+def _render_tiles(plan, mode, bands):
+    """
+    按裁剪计划从行带拼接各块；块按从上到下的顺序生成，拼完即交出
+    """
+    x0, x1, tiles, bg = plan
+    fill = (bg, bg, bg) if mode == "RGB" else bg
+    # (起始行, 结束行, 块序号, 块内纵向偏移)
+    placements = []
+    heights = []
+    for i, pieces in enumerate(tiles):
+        y = 0
+        for p0, p1 in pieces:
+            placements.append((p0, p1, i, y))
+            y += p1 - p0 + BLANK_SPACER
+        heights.append(y - BLANK_SPACER)
+
+    building = {}
+    done = 0
+    for y0, band, _ in bands():
+        y1 = y0 + band.height
+        for p0, p1, i, offset in placements:
+            a, b = max(p0, y0), min(p1, y1)
+            if a >= b:
+                continue
+            if i not in building:
+                building[i] = Image.new(mode, (x1 - x0, heights[i]), fill)
+            building[i].paste(band.crop((x0, a - y0, x1, b - y0)), (0, offset + a - p0))
+        while done < len(tiles) and tiles[done][-1][1] <= y1:
+            yield building.pop(done)
+            done += 1
+
+def trim_screenshot(image):
+    """
+    截图预处理：去掉状态栏和四周纯色边距，折叠大段空白，长截图切成多块
+    返回 PIL Image 列表 (按从上到下顺序)
+    """
+    gray = np.asarray(image.convert("L"), dtype=np.int16)
+    bands = lambda: [(0, image, gray)]
+    plan = _trim_plan(image.width, image.height, bands)
+    if plan is None:
+        return [image]
+    return list(_render_tiles(plan, image.mode, bands))
+
+def trim_png_bands(data, image, max_decode_bytes):
+    """
+    整图超出解码上限的 PNG 截图：按行带解码三遍 (背景色、内容行、拼接)，不保留整图
+    返回逐块生成器；没有内容时返回 None
+    """
+    w, h = image.size
+    rawmode = _band_rawmode(image)
+    band_rows = max(BAND_MIN_ROWS, max_decode_bytes // (w * BYTES_PER_PIXEL * BAND_SHARE))
+    bands = lambda: _png_bands(data, image, rawmode, band_rows)
+    plan = _trim_plan(w, h, bands)
+    if plan is None:
+        return None
+    mode = "L" if rawmode == "L" else "RGB"
+    return _render_tiles(plan, mode, bands)
+
+def _encode_parts(images, max_width, quality):
+    parts = []
+    for image in images:
+        if max_width and image.width > max_width:
+            ratio = max_width / image.width
+            new_height = int(image.height * ratio)
+            image = image.resize((max_width, new_height), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        parts.append((buffer.getvalue(), "image/jpeg"))
+    return parts
+
+def smart_process_image(uploaded_file, max_decode_bytes=None, file_type=None, level=0):
+    """
+    返回 [(img_bytes, mime), ...]：食物照片为单张；长截图可能被切成多块
+    """
+    uploaded_file.seek(0)
+    with uploaded_file.getbuffer() as view:
+        size_kb = view.nbytes / 1024
+        mime = sniff_mime(view)
+    if file_type is None:
+        _, file_type = parse_file_info(uploaded_file.name)
+    profile = image_profile(file_type)
+    if passthrough(profile, level, size_kb):
+        return [(uploaded_file.getvalue(), mime)]
+
+    ladder = ENCODE_LADDERS[profile]
+    max_width, quality = ladder[min(level, len(ladder) - 1)]
+
+    # Image.open 只读取文件头，像素在 draft 设定缩放后才解码
+    image = Image.open(uploaded_file)
+    trim = profile == "screenshot" and SCREENSHOT_TRIM
+    fits = _fit_decode(image, max_width, max_decode_bytes) if profile == "food" else _fit_full(image, max_decode_bytes)
+    if not fits:
+        if trim and _band_rawmode(image):
+            tiles = trim_png_bands(uploaded_file.getvalue(), image, max_decode_bytes)
+            if tiles is not None:
+                return _encode_parts(tiles, max_width, quality)
+        # 照片降到 1/8 仍超出上限 (或无法按行带解码的截图)：不解码，原样上传
+        return [(uploaded_file.getvalue(), Image.MIME.get(image.format, mime))]
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    images = [image]
+    if trim:
+        images = trim_screenshot(image)
+        # 小截图裁剪后 token 没有减少 (几乎没有空白)：重编码只会变大，原样上传
+        if level == 0 and size_kb < PASSTHROUGH_KB and \
+                sum(vision_tokens(*im.size) for im in images) >= vision_tokens(*image.size):
+            return [(uploaded_file.getvalue(), mime)]
+    return _encode_parts(images, max_width, quality)
+
+def filename_datetime(filename):
+    """
+    文件名中的完整日期时间 (YYYYMMDD_HHMMSS)，没有则返回 None
+    """
+    match_full = re.search(r'(20\d{2})(\d{2})(\d{2})_(\d{6})', filename)
+    if match_full:
+        try:
+            y, m, d, t = match_full.groups()
+            return datetime.strptime(f"{y}{m}{d}{t}", "%Y%m%d%H%M%S")
+        except:
+            pass
+    return None
+
+# --- 拍摄时间 (只读文件头) ---
+# JPEG 的 APP1 (Exif) 段位于 SOS 之前，一般在前 64KB 内
+EXIF_SCAN_BYTES = 256 * 1024
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXIF_DATETIME = 0x0132
+EXIF_IFD_POINTER = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+def _jpeg_exif(head):
+    pos = 2
+    while pos + 4 <= len(head) and head[pos] == 0xFF:
+        marker = head[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        if marker in (0xDA, 0xD9):
+            break
+        length = int.from_bytes(head[pos + 2:pos + 4], "big")
+        if marker == 0xE1 and head[pos + 4:pos + 10] == b"Exif\x00\x00":
+            return head[pos + 10:pos + 2 + length]
+        pos += 2 + length
+    return None
+
+def _png_exif(f):
+    # 按块长度跳读 (IDAT 不读取)，eXIf 块可能位于图像数据之后
+    pos = len(PNG_SIGNATURE)
+    while True:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        length = int.from_bytes(header[:4], "big")
+        kind = header[4:]
+        if kind == b"eXIf":
+            return f.read(length)
+        if kind == b"IEND":
+            return None
+        pos += 12 + length
+
+def _tiff_datetime(tiff):
+    """
+    最小 TIFF 解析：IFD0 的 DateTime 与 Exif 子 IFD 的 DateTimeOriginal，后者优先
+    """
+    order = {b"II": "little", b"MM": "big"}.get(bytes(tiff[:2]))
+    if order is None:
+        return None
+
+    def u16(at):
+        return int.from_bytes(tiff[at:at + 2], order)
+
+    def u32(at):
+        return int.from_bytes(tiff[at:at + 4], order)
+
+    def entries(offset):
+        found = {}
+        if offset + 2 > len(tiff):
+            return found
+        for i in range(u16(offset)):
+            at = offset + 2 + i * 12
+            if at + 12 > len(tiff):
+                break
+            tag, count = u16(at), u32(at + 4)
+            if tag in (EXIF_DATETIME, EXIF_DATETIME_ORIGINAL):
+                start = u32(at + 8) if count > 4 else at + 8
+                found[tag] = bytes(tiff[start:start + count])
+            elif tag == EXIF_IFD_POINTER:
+                found[tag] = u32(at + 8)
+        return found
+
+    ifd0 = entries(u32(4))
+    exif = entries(ifd0[EXIF_IFD_POINTER]) if EXIF_IFD_POINTER in ifd0 else {}
+    for raw in (exif.get(EXIF_DATETIME_ORIGINAL), ifd0.get(EXIF_DATETIME)):
+        if raw:
+            try:
+                return datetime.strptime(raw.decode("ascii").strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+            except ValueError:
+                continue
+    return None
+
+def exif_datetime(uploaded_file):
+    """
+    EXIF 拍摄时间 (DateTimeOriginal，其次 DateTime)；只读取文件头字节，不经过 Pillow 解码
+    """
+    try:
+        uploaded_file.seek(0)
+        head = uploaded_file.read(EXIF_SCAN_BYTES)
+        if head[:2] == b"\xff\xd8":
+            tiff = _jpeg_exif(head)
+        elif head[:8] == PNG_SIGNATURE:
+            tiff = _png_exif(uploaded_file)
+        else:
+            tiff = None
+        return _tiff_datetime(tiff) if tiff else None
+    except Exception:
+        return None
+    finally:
+        uploaded_file.seek(0)
+
+def capture_info(uploaded_file):
+    """
+    (拍摄时间, 类型)：文件名完整日期 → EXIF 文件头 → 原有文件名规则 (仅时分秒时按今天)
+    SHealth 汇总截图不参与时间线，不读取 EXIF
+    """
+    file_dt, file_type = parse_file_info(uploaded_file.name)
+    if file_type == 's_health':
+        return file_dt, file_type
+    taken = filename_datetime(uploaded_file.name) or exif_datetime(uploaded_file)
+    return taken or file_dt, file_type
+
+def parse_file_info(filename):
+    """
+    文件名解析逻辑
+    """
+    # 1. 显式关键字匹配
+    if "ReactNative" in filename or "Screenshot" in filename or "屏幕截图" in filename:
+        return None, 'workout_snapshot'
+    if "SHealth" in filename:
+        return None, 's_health'
+
+    # 2. 纯数字文件名匹配 (如 1769760746481.jpg)
+    if re.match(r'^\d{13}\.', filename):
+        return None, 's_health'
+
+    # 3. 日期匹配 (YYYYMMDD)
+    dt_obj = filename_datetime(filename)
+    if dt_obj:
+        return dt_obj, 'food'
+
+    # 4. 时间匹配 (Fallback)
+    match_time = re.search(r'_(\d{6})', filename)
+    if match_time:
+        try:
+            t_str = match_time.group(1)
+            if int(t_str) < 240000:
+                now = datetime.now()
+                t_obj = datetime.strptime(t_str, "%H%M%S").time()
+                return datetime.combine(now.date(), t_obj), 'food'
+        except:
+            pass
+
+    return None, 'food'
+
+
+# --- 并行预处理 ---
+def pool_workers():
+    return admission.CPU_SLOTS
+
+def decode_budget():
+    """
+    单张图片的解码内存上限：所有会话同时解码的图片数不超过 CPU 槽位数，按槽位平分
+    """
+    return DECODE_MEMORY_MB * 1024 * 1024 // pool_workers()
+
+def _process_file(name, file_bytes, max_decode_bytes, file_type, level):
+    """
+    子进程入口：解码/缩放/重编码，返回 ([(img_bytes, mime), ...], 子进程内耗时)
+    """
+    t = time.perf_counter()
+    buf = io.BytesIO(file_bytes)
+    buf.name = name
+    return smart_process_image(buf, max_decode_bytes, file_type, level), time.perf_counter() - t
+
+def _b64(img_bytes):
+    return base64.b64encode(img_bytes).decode('utf-8')
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = pool_workers()
+            # 不用 fork：Streamlit 服务进程里有 Tornado、Sheet 写入、模型对冲等线程，fork 出的子进程可能死锁
+            # forkserver / spawn 的子进程只导入 imaging (不依赖 Streamlit)，streamlit 的 __main__ 有入口保护，不会重跑 app.py
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("forkserver")
+                # 由预先导入了 imaging 的服务进程派生 worker，省去每个 worker 重新导入 PIL / numpy
+                ctx.set_forkserver_preload(["imaging"])
+            else:
+                ctx = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+        return _pool
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+# --- 请求级预算分配 ---
+def vision_tokens(width, height):
+    if width <= 384 and height <= 384:
+        return VISION_TOKENS_PER_TILE
+    return math.ceil(width / VISION_TILE) * math.ceil(height / VISION_TILE) * VISION_TOKENS_PER_TILE
+
+def message_tokens(messages):
+    """
+    请求 token 粗估 (用于限流预扣)：文本按 2 字符 1 token，图片只解析 data URL 头部取尺寸
+    """
+    total = 0
+    for message in messages:
+        content = message.get("content") or ""
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                total += _data_url_tokens(part["image_url"]["url"])
+            else:
+                total += len(part.get("text", "")) // 2
+    return total
+
+def _data_url_tokens(url):
+    head = url.partition(",")[2][:b64_size(EXIF_SCAN_BYTES)]
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(head[:len(head) // 4 * 4]))) as image:
+            return vision_tokens(*image.size)
+    except (OSError, ValueError, SyntaxError):
+        return vision_tokens(TARGET_WIDTH, TARGET_WIDTH)
+
+def b64_size(n):
+    return (n + 2) // 3 * 4
+
+def _level_quality(profile, level, size_kb):
+    if passthrough(profile, level, size_kb):
+        return PASSTHROUGH_QUALITY
+    ladder = ENCODE_LADDERS[profile]
+    return ladder[min(level, len(ladder) - 1)][1]
+
+def _estimate(entry, level):
+    """
+    以当前实际编码结果为基准，按像素比例和质量系数预估目标档位的 (base64 字节, token)
+    """
+    max_width, quality = ENCODE_LADDERS[entry["profile"]][level]
+    pixels = new_pixels = tokens = 0
+    for w, h in entry["dims"]:
+        nw, nh = w, h
+        if max_width and w > max_width:
+            nw, nh = max_width, max(1, int(h * max_width / w))
+        pixels += w * h
+        new_pixels += nw * nh
+        tokens += vision_tokens(nw, nh)
+    src_q = _level_quality(entry["profile"], entry["level"], entry["src_kb"])
+    ratio = new_pixels / max(1, pixels) * QUALITY_SIZE_FACTOR[quality] / QUALITY_SIZE_FACTOR[src_q]
+    return b64_size(int(entry["bytes"] * ratio)), tokens
+
+def allocate_levels(entries, byte_budget, token_budget):
+    """
+    贪心分配：总量超预算时，按 PROFILE_PRIORITY 先降食物照片，同类中优先降当前最大的一张
+    entries: [{"profile", "level", "bytes", "dims": [(w, h), ...], "src_kb"}]，返回每个文件的目标档位
+    """
+    levels = [e["level"] for e in entries]
+    sizes = [b64_size(e["bytes"]) for e in entries]
+    tokens = [sum(vision_tokens(*d) for d in e["dims"]) for e in entries]
+
+    while sum(sizes) > byte_budget or sum(tokens) > token_budget:
+        over_bytes = sum(sizes) > byte_budget
+        pick = None
+        for profile in PROFILE_PRIORITY:
+            candidates = [
+                i for i, e in enumerate(entries)
+                if e["profile"] == profile and levels[i] + 1 < len(ENCODE_LADDERS[profile])
+            ]
+            if candidates:
+                pick = max(candidates, key=lambda i: sizes[i] if over_bytes else tokens[i])
+                break
+        if pick is None:
+            break
+        levels[pick] += 1
+        sizes[pick], tokens[pick] = _estimate(entries[pick], levels[pick])
+    return levels
+
+def preprocess_files(uploaded_files, on_progress=None, byte_budget=None, token_budget=None):
+    """
+    批量预处理上传文件，返回与输入顺序一致的列表，每个文件对应 [(b64_str, mime), ...] (截图可能多块)
+    已处理过的内容直接从 image_cache 取结果，跳过 Pillow
+    大图数量达到 PARALLEL_MIN_FILES 且多核时走进程池，否则串行
+    先按默认档位编码；总量超出 byte_budget (base64 字节) / token_budget 时按类别降档重编码
+    on_progress(done, total, name) 在调用线程中回调，可直接更新 Streamlit 组件
+    """
+    if byte_budget is None:
+        byte_budget = int(PAYLOAD_BUDGET_MB * 1024 * 1024)
+    if token_budget is None:
+        token_budget = PAYLOAD_TOKEN_BUDGET
+
+    file_types = [parse_file_info(f.name)[1] for f in uploaded_files]
+    profiles = [image_profile(t) for t in file_types]
+    digests = {}
+    sizes_kb = []
+    for f in uploaded_files:
+        with f.getbuffer() as view:
+            sizes_kb.append(view.nbytes / 1024)
+
+    levels = [0] * len(uploaded_files)
+    first = _encode(uploaded_files, file_types, profiles, levels, range(len(uploaded_files)), digests, on_progress)
+    outputs = [first[i] for i in range(len(uploaded_files))]
+
+    for _ in range(ALLOCATION_ROUNDS):
+        entries = []
+        for i, parts in enumerate(outputs):
+            dims = []
+            for img_bytes, _ in parts:
+                try:
+                    dims.append(Image.open(io.BytesIO(img_bytes)).size)
+                except Exception:
+                    dims.append((1, 1))
+            entries.append({"profile": profiles[i], "level": levels[i], "bytes": sum(len(b) for b, _ in parts),
+                            "dims": dims, "src_kb": sizes_kb[i]})
+        plan = allocate_levels(entries, byte_budget, token_budget)
+        changed = [i for i in range(len(plan)) if plan[i] != levels[i]]
+        if not changed:
+            break
+        levels = plan
+        redone = _encode(uploaded_files, file_types, profiles, levels, changed, digests, on_progress)
+        for i in changed:
+            outputs[i] = redone[i]
+
+    with metrics.span("base64 编码"):
+        return [[(_b64(img_bytes), mime) for img_bytes, mime in parts] for parts in outputs]
+
+# --- 近似重复检测 ---
+def perceptual_hash(img_bytes, size=HASH_SIZE):
+    image = Image.open(io.BytesIO(img_bytes))
+    image.draft("L", (size * 8, size * 8))
+    pixels = np.asarray(image.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def _same_pixels(a_bytes, b_bytes):
+    a = np.asarray(Image.open(io.BytesIO(a_bytes)).convert("L"), dtype=np.int16)
+    b = np.asarray(Image.open(io.BytesIO(b_bytes)).convert("L"), dtype=np.int16)
+    if a.shape != b.shape:
+        return False
+    return int((np.abs(a - b) > DEDUPE_PIXEL_DELTA).sum()) <= DEDUPE_SHOT_DIFF_PIXELS
+
+def find_duplicates(processed, file_types, times):
+    """
+    processed: preprocess_files 的输出；times: 每个文件的拍摄时间 (可为 None)
+    返回 {被丢弃的下标: 保留的下标}；同类内比较，优先保留时间最早的 (有时间的优先于无时间的)
+    """
+    order = sorted(range(len(processed)), key=lambda i: (times[i] is None, times[i] or datetime.max, i))
+    raw = {}
+    hashes = {}
+    kept = []
+    dropped = {}
+
+    def decoded(i):
+        if i not in raw:
+            raw[i] = [base64.b64decode(data) for data, _ in processed[i]]
+        return raw[i]
+
+    for i in order:
+        profile = image_profile(file_types[i])
+        try:
+            hashes[i] = perceptual_hash(decoded(i)[0])
+        except Exception:
+            kept.append(i)
+            continue
+        for j in kept:
+            if image_profile(file_types[j]) != profile or j not in hashes:
+                continue
+            distance = bin(hashes[i] ^ hashes[j]).count("1")
+            if profile == "food":
+                if distance <= DEDUPE_FOOD_DISTANCE:
+                    dropped[i] = j
+                    break
+            elif distance <= DEDUPE_SHOT_DISTANCE and len(processed[i]) == len(processed[j]):
+                if all(_same_pixels(a, b) for a, b in zip(decoded(i), decoded(j))):
+                    dropped[i] = j
+                    break
+        if i not in dropped:
+            kept.append(i)
+    return dropped
+
+def _encode(uploaded_files, file_types, profiles, levels, indices, digests, on_progress):
+    """
+    按指定档位编码 indices 中的文件，返回 {index: [(img_bytes, mime), ...]}
+    """
+    indices = list(indices)
+    total = len(indices)
+    results = {}
+    budget = decode_budget()
+    done = 0
+
+    def report(name):
+        if on_progress:
+            on_progress(done, total, name)
+
+    # 透传的小图无需解码；其余先查缓存，只有未命中的才真正解码
+    # 直接在上传缓冲区上哈希/解码，只有提交到进程池时才复制字节
+    pending = []
+    keys = {}
+    for i in indices:
+        file = uploaded_files[i]
+        with file.getbuffer() as view:
+            if passthrough(profiles[i], levels[i], view.nbytes / 1024):
+                results[i] = [(file.getvalue(), sniff_mime(view))]
+                metrics.add_image(file.name, 0.0, "passthrough")
+            else:
+                if i not in digests:
+                    digests[i] = hashlib.sha256(view).hexdigest()
+                keys[i] = cache_key(digests[i], profiles[i], levels[i])
+        if i in keys:
+            cached = image_cache.get(keys[i])
+            if cached is None:
+                pending.append(i)
+                continue
+            results[i] = _unpack(cached)
+            metrics.add_image(file.name, 0.0, "cache")
+        done += 1
+        report(file.name)
+
+    def finish(i, processed, seconds):
+        nonlocal done
+        metrics.add_image(uploaded_files[i].name, seconds, "decode")
+        image_cache.put(keys[i], _pack(processed))
+        results[i] = processed
+        done += 1
+        report(uploaded_files[i].name)
+
+    # 每张图提交前先向 admission.cpu_queue 取槽位 (完成时归还)，多个会话同时上传时按会话轮流解码
+    use_pool = len(pending) >= PARALLEL_MIN_FILES and pool_workers() > 1
+    if use_pool:
+        try:
+            pool = _get_pool()
+            futures = {}
+            for i in pending:
+                for fut in [f for f in futures if f.done()]:
+                    finish(futures.pop(fut), *fut.result())
+                started = admission.cpu_queue.acquire()
+                file = uploaded_files[i]
+                try:
+                    fut = pool.submit(_process_file, file.name, file.getvalue(), budget, file_types[i], levels[i])
+                except BaseException:
+                    admission.cpu_queue.release(started)
+                    raise
+                fut.add_done_callback(lambda f, started=started: admission.cpu_queue.release(started))
+                futures[fut] = i
+            for fut in as_completed(futures):
+                finish(futures[fut], *fut.result())
+        except BrokenProcessPool:
+            # 子进程被杀 (如 OOM)，重建进程池并对剩余文件降级串行
+            _reset_pool()
+
+    for i in pending:
+        if i not in results:
+            started = admission.cpu_queue.acquire()
+            t = time.perf_counter()
+            try:
+                processed = smart_process_image(uploaded_files[i], budget, file_types[i], levels[i])
+            finally:
+                admission.cpu_queue.release(started)
+            finish(i, processed, time.perf_counter() - t)
+
+    return results
@@ -0,0 +1,341 @@
+import os
+import json
+import asyncio
+import time
+import hashlib
+from cache import DiskCache
+import metrics
+import transport
+import admission
+import schema
+
+# LLM 调用相关工具
+
+MODEL = "gemini-2.5-flash"
+# 可指向本地 OpenAI 兼容服务 (如 bench.py --serve)
+BASE_URL = os.getenv("LLM_BASE_URL", "https://api.poixe.com/v1")
+
+# 响应缓存修改格式时递增
+CACHE_VERSION = "1"
+CACHE_DIR = os.getenv("LLM_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "llm"))
+CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+CACHE_MB = int(os.getenv("LLM_CACHE_MB", "64"))
+
+response_cache = DiskCache(CACHE_DIR, CACHE_MB * 1024 * 1024, ttl=CACHE_TTL_HOURS * 3600, suffix=".json")
+
+JSON_PARAMS = {"temperature": 0.0, "response_format": {"type": "json_object"}}
+
+# 分段并行模式：每类输入只负责 schema 中对应的键 (见 schema.SECTIONS 的来源列)
+SECTION_KEYS = {source: keys for source, keys in schema.SOURCE_SECTIONS.items() if source != "summary"}
+SUMMARY_KEY = schema.SOURCE_SECTIONS["summary"][0]
+
+SUMMARY_PROMPT = """你是一名精英营养师和数据分析师。
+以下是用户当天已解析的结构化健康数据 (JSON)。请基于摄入与消耗、睡眠、心率、压力和训练情况：
+1. 给出热量盈余/缺口分析 (写入 `总盈余缺口分析`)；
+2. 撰写本日总结与指导建议。
+
+【输出要求】
+严格 JSON 格式，不要多余文本。
+{schema}
+"""
+
+
+def fingerprint(model, messages, **params):
+    """
+    请求指纹：模型 + 完整 messages (含 system prompt / RESPONSE_SCHEMA / 图片 base64) + 采样参数
+    """
+    h = hashlib.sha256()
+    h.update(f"v{CACHE_VERSION}|{model}|".encode())
+    h.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode())
+    # 逐条写入，避免把几十 MB 的 base64 拼成一个大字符串
+    for msg in messages:
+        h.update(json.dumps(msg, sort_keys=True, ensure_ascii=False).encode())
+    return h.hexdigest()
+
+def get_cached_response(key):
+    value = response_cache.get(key)
+    if value is None:
+        return None
+    return value.decode("utf-8")
+
+def store_response(key, text):
+    response_cache.put(key, text.encode("utf-8"))
+
+def _schema_score(data, expected):
+    return len(set(data) & set(expected)) if isinstance(data, dict) else -1
+
+def _scan_objects(text, expected):
+    """
+    从每个 '{' 起用 raw_decode 尝试解码，返回包含最多 schema 顶层键的对象
+    """
+    decoder = json.JSONDecoder()
+    best = None
+    idx = text.find("{")
+    while idx != -1:
+        try:
+            obj, end = decoder.raw_decode(text, idx)
+        except ValueError:
+            idx = text.find("{", idx + 1)
+            continue
+        if isinstance(obj, dict) and _schema_score(obj, expected) > _schema_score(best, expected):
+            best = obj
+        idx = text.find("{", end)
+    return best
+
+def validate_sections(data, keys):
+    """
+    返回缺失或结构错误的顶层键：键不存在、不是对象 / 不含任何预期字段、应为数组的字段不是数组
+    字段定义取自 schema.SECTION_FIELDS / LIST_FIELDS
+    """
+    bad = []
+    for key in keys:
+        value = data.get(key)
+        if value is None:
+            bad.append(key)
+        elif not isinstance(value, dict) or not set(value) & set(schema.SECTION_FIELDS[key]):
+            bad.append(key)
+        elif any(sub in value and not isinstance(value[sub], list) for sub in schema.LIST_FIELDS[key]):
+            bad.append(key)
+    return bad
+
+def decode_response(text, keys=None, required=None):
+    """
+    容错解码：json.loads → raw_decode 扫描 → 截断/残缺输出按已完成的顶层键抢救
+    keys: 本次请求 schema 中的顶层键；required: 必须返回的键 (默认同 keys)
+    返回 (data, bad_keys)；未提供 keys 时 bad_keys 为空
+    """
+    text = text or ""
+    expected = set(keys or ())
+    try:
+        data = json.loads(text)
+        if not isinstance(data, dict):
+            data = {}
+    except json.JSONDecodeError:
+        data = _scan_objects(text, expected) or {}
+        # 截断时外层对象无法解码，抢救已经完整输出的顶层键
+        start = text.find("{")
+        if start != -1:
+            parser = IncrementalJSONParser()
+            parser.feed(text[start:])
+            if _schema_score(parser.completed, expected) > _schema_score(data, expected):
+                data = parser.completed
+    bad = validate_sections(data, required or keys) if keys else []
+    return data, bad
+
+def extract_json_from_response(text):
+    return decode_response(text)[0]
+
+
+# --- 缺失板块修复 ---
+REPAIR_PROMPT = """你之前输出的 JSON 缺少或损坏了部分板块。下面是上一次的原始输出 (可能被截断或格式错误)。
+请仅依据其中已有的信息，补全并只输出以下键；无法确定的数值填 0，文本填空字符串。
+
+【输出要求】
+严格 JSON 格式，不要多余文本。
+{schema}
+"""
+# 修复请求附带的上一轮输出长度上限
+REPAIR_CONTEXT_CHARS = 16000
+
+def repair_messages(previous_text, bad_keys):
+    return [
+        {"role": "system", "content": REPAIR_PROMPT.format(schema=schema.schema_text(bad_keys))},
+        {"role": "user", "content": (previous_text or "(空输出)")[-REPAIR_CONTEXT_CHARS:]},
+    ]
+
+def _accept_repair(text, bad_keys):
+    data, still_bad = decode_response(text, bad_keys)
+    return {k: data[k] for k in bad_keys if k not in still_bad}
+
+def repair_sections(client, previous_text, bad_keys):
+    """
+    仅针对 bad_keys 发起一次纯文本补全请求，返回修复成功的 {键: 值}
+    """
+    with metrics.span("缺失板块修复"):
+        response = client.chat.completions.create(
+            model=MODEL, messages=repair_messages(previous_text, bad_keys), **JSON_PARAMS
+        )
+    metrics.add_usage(getattr(response, "usage", None))
+    return _accept_repair(response.choices[0].message.content, bad_keys)
+
+def complete_report(client, messages, keys, use_cache=True, required=None):
+    """
+    非流式整日解析：响应缓存 → 模型调用 → 容错解码 → 缺失板块修复
+    keys: 请求 schema 中的顶层键；required: 必须返回的顶层键 (默认 keys 全部)
+    返回 (data, missing_keys, repaired_keys, from_cache)；repaired_keys 为由修复请求补全、并非读自模型原始输出的板块
+    """
+    key = fingerprint(MODEL, messages, **JSON_PARAMS)
+    text = get_cached_response(key) if use_cache else None
+    if text is not None:
+        return extract_json_from_response(text), [], [], True
+    with metrics.span("模型调用"):
+        response = client.chat.completions.create(model=MODEL, messages=messages, **JSON_PARAMS)
+    metrics.add_usage(getattr(response, "usage", None))
+    text = response.choices[0].message.content or ""
+    with metrics.span("JSON 解析"):
+        data, bad = decode_response(text, keys, required)
+    if not bad:
+        if data:
+            store_response(key, text)
+        return data, [], [], False
+    # 截断时缺失的板块从未出现在原文中，修复只能填默认值；这类结果不写缓存，下次重新请求
+    fixed = repair_sections(client, text, bad)
+    data.update(fixed)
+    return data, [k for k in bad if k not in fixed], list(fixed), False
+
+# --- 流式解析 ---
+class IncrementalJSONParser:
+    """
+    流式增量解析顶层 JSON 对象：每收到一段文本调用 feed()，返回本次新完成的 [(顶层键, 值)]
+    只跟踪字符串/转义和嵌套深度，不重复扫描已处理文本；顶层对象之前的 ```json 等前缀被忽略
+    """
+    def __init__(self):
+        self.text = ""
+        self.completed = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        events = []
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == '"':
+                    self._in_str = False
+                    if self._key_start is not None:
+                        try:
+                            self._key = json.loads(text[self._key_start:i + 1])
+                        except ValueError:
+                            self._key = None
+                        self._key_start = None
+            elif c == '"':
+                self._in_str = True
+                if self._depth == 1 and self._value_start is None:
+                    self._key_start = i
+            elif c in "{[":
+                self._depth += 1
+            elif c in "}]":
+                if self._depth == 1 and self._value_start is not None:
+                    self._emit(text, i, events)
+                self._depth = max(0, self._depth - 1)
+            elif c == ":" and self._depth == 1 and self._value_start is None and self._key is not None:
+                self._value_start = i + 1
+            elif c == "," and self._depth == 1 and self._value_start is not None:
+                self._emit(text, i, events)
+        self._pos = len(text)
+        return events
+
+    def _emit(self, text, end, events):
+        try:
+            value = json.loads(text[self._value_start:end])
+        except ValueError:
+            value = None
+        else:
+            self.completed[self._key] = value
+            events.append((self._key, value))
+        self._key = None
+        self._value_start = None
+
+def stream_completion(client, messages, **params):
+    """
+    stream=True 调用，逐段产出文本增量；首个增量前的等待记为 "模型首字节" (含上传与排队)
+    最后一个 chunk 携带 usage (include_usage)
+    """
+    t = time.perf_counter()
+    first = None
+    stream = client.chat.completions.create(model=MODEL, messages=messages, stream=True,
+                                            stream_options={"include_usage": True}, **params)
+    for chunk in stream:
+        if getattr(chunk, "usage", None):
+            metrics.add_usage(chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first is None:
+                first = time.perf_counter()
+                metrics.add("模型首字节", first - t)
+            yield chunk.choices[0].delta.content
+    if first is not None:
+        metrics.add("模型生成", time.perf_counter() - first)
+
+
+# --- 分段并行解析 ---
+async def _admitted_create(client, session, messages):
+    # 准入 / 熔断 / 重试 / 对冲都在 transport 中完成；线程池里执行，埋点需显式带过去
+    response = await client.acreate(session=session, run=metrics.current(), model=MODEL, messages=messages,
+                                    **JSON_PARAMS)
+    metrics.add_usage(getattr(response, "usage", None))
+    return response
+
+async def _complete_json(client, session, messages, use_cache, valid=extract_json_from_response):
+    # 只缓存通过 valid 校验的原始输出
+    key = fingerprint(MODEL, messages, **JSON_PARAMS)
+    text = get_cached_response(key) if use_cache else None
+    if text is None:
+        response = await _admitted_create(client, session, messages)
+        text = response.choices[0].message.content or ""
+        if valid(text):
+            store_response(key, text)
+    return text
+
+async def _complete_section(client, session, name, messages, use_cache):
+    valid = lambda text: not decode_response(text, SECTION_KEYS[name])[1]
+    text = await _complete_json(client, session, messages, use_cache, valid)
+    data, bad = decode_response(text, SECTION_KEYS[name])
+    if bad:
+        response = await _admitted_create(client, session, repair_messages(text, bad))
+        data.update(_accept_repair(response.choices[0].message.content, bad))
+    return data
+
+async def _run_sectioned(api_key, sections, build_system_prompt, use_cache):
+    # 与同步模式共用进程级 ModelTransport (连接池、熔断、重试、对冲)
+    client = transport.get_client(api_key, BASE_URL)
+    # 准入排队在线程池中进行，会话标识需在事件循环所在线程取出
+    session = admission.current_session()
+    names = [name for name in SECTION_KEYS if sections.get(name)]
+    jobs = []
+    for name in names:
+        messages = [
+            {"role": "system", "content": build_system_prompt(schema.schema_text(SECTION_KEYS[name]))},
+            {"role": "user", "content": sections[name]},
+        ]
+        jobs.append(_complete_section(client, session, name, messages, use_cache))
+    results = await asyncio.gather(*jobs)
+
+    merged = {}
+    for name, data in zip(names, results):
+        for key in SECTION_KEYS[name]:
+            if key in data:
+                merged[key] = data[key]
+
+    # 总结依赖所有分段结果，最后用一次纯文本请求生成
+    summary_schema = json.dumps(
+        {"总盈余缺口分析": "...", SUMMARY_KEY: schema.SECTION_EXAMPLES[SUMMARY_KEY]}, ensure_ascii=False, indent=2
+    )
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT.format(schema=summary_schema)},
+        {"role": "user", "content": json.dumps(merged, ensure_ascii=False)},
+    ]
+    summary = extract_json_from_response(await _complete_json(client, session, messages, use_cache))
+    if SUMMARY_KEY in summary:
+        merged[SUMMARY_KEY] = summary[SUMMARY_KEY]
+    if summary.get("总盈余缺口分析") and isinstance(merged.get("营养摄入汇总"), dict):
+        merged["营养摄入汇总"]["总盈余缺口分析"] = summary["总盈余缺口分析"]
+    return merged
+
+def run_sectioned(api_key, sections, build_system_prompt, use_cache=True):
+    """
+    sections: build_payload 返回的 {food / s_health / workout_snapshot: user_content 片段}
+    各分段经共享的 ModelTransport 并发请求，按 SECTION_KEYS 合并为 RESPONSE_SCHEMA 结构，
+    再用一次纯文本请求补全本日总结；总耗时约为最慢分段 + 总结
+    """
+    return asyncio.run(_run_sectioned(api_key, sections, build_system_prompt, use_cache))
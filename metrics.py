@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+# 性能埋点：单次报告的分阶段耗时 / 每张图片预处理耗时 / token 用量
+# 运行结束后追加到本地 JSONL，侧边栏按最近若干次统计 p50/p95
+
+METRICS_PATH = os.getenv("METRICS_LOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metrics.jsonl"))
+# 汇总统计只看最近的记录
+SUMMARY_RUNS = 200
+TOKEN_FIELDS = ["prompt_tokens", "completion_tokens", "total_tokens"]
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+class RunMetrics:
+    """
+    一次报告生成的埋点；阶段名可重复出现 (如多次模型调用)，耗时累加
+    """
+    def __init__(self, kind="report", **meta):
+        self.kind = kind
+        self.meta = meta
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self.stages = {}
+        self.images = []
+        self.tokens = dict.fromkeys(TOKEN_FIELDS, 0)
+        self.llm_calls = 0
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - t)
+
+    def add_image(self, name, seconds, source):
+        """
+        source: decode (实际解码) / cache (命中预处理缓存) / passthrough (小图直传)
+        """
+        self.images.append({"name": name, "seconds": round(seconds, 4), "source": source})
+
+    def add_usage(self, usage):
+        if usage is None:
+            return
+        self.llm_calls += 1
+        for field in TOKEN_FIELDS:
+            self.tokens[field] += getattr(usage, field, 0) or 0
+
+    def record(self):
+        return {
+            "time": self.started, "kind": self.kind, **self.meta,
+            "total": round(time.perf_counter() - self._t0, 4),
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+            "images": self.images, "tokens": self.tokens, "llm_calls": self.llm_calls,
+        }
+
+
+# --- 当前线程的运行 (llm / imaging 无需层层传参) ---
+def start_run(kind="report", **meta):
+    _local.run = RunMetrics(kind, **meta)
+    return _local.run
+
+def current():
+    return getattr(_local, "run", None)
+
+def bind(run):
+    """
+    把其他线程的运行绑定到当前线程 (线程池中代为执行的调用)
+    """
+    _local.run = run
+
+@contextmanager
+def span(stage):
+    run = current()
+    if run is None:
+        yield
+        return
+    with run.span(stage):
+        yield
+
+def add(stage, seconds):
+    run = current()
+    if run is not None:
+        run.add(stage, seconds)
+
+def add_usage(usage):
+    run = current()
+    if run is not None:
+        run.add_usage(usage)
+
+def add_image(name, seconds, source):
+    run = current()
+    if run is not None:
+        run.add_image(name, seconds, source)
+
+def finish_run(path=METRICS_PATH):
+    """
+    结束当前运行并追加到日志，返回记录 (无进行中的运行时返回 None)
+    """
+    run = current()
+    _local.run = None
+    if run is None:
+        return None
+    record = run.record()
+    append_record(record, path)
+    return record
+
+def append_record(record, path=METRICS_PATH):
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with _write_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+
+# --- 跨次汇总 ---
+_summary_cache = {"key": None, "value": None}
+
+def load_records(path=METRICS_PATH, limit=SUMMARY_RUNS):
+    records = []
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records[-limit:]
+
+def stage_frame(records):
+    """
+    每条记录的每个阶段一行；报告记录另加一行 "总耗时"
+    """
+    rows = []
+    for r in records:
+        for stage, seconds in r.get("stages", {}).items():
+            rows.append({"阶段": stage, "耗时": seconds})
+        if r.get("kind") == "report":
+            rows.append({"阶段": "总耗时", "耗时": r.get("total", 0)})
+    return pd.DataFrame(rows, columns=["阶段", "耗时"])
+
+def summarize(records):
+    """
+    各阶段耗时 (秒) 的 次数 / p50 / p95 / 最大，以及每次报告 token 用量的 p50 / p95
+    """
+    stages = stage_frame(records)
+    timing = stages.groupby("阶段", sort=False)["耗时"].agg(
+        次数="size", p50=lambda s: s.quantile(0.5), p95=lambda s: s.quantile(0.95), 最大="max",
+    )
+    reports = [r for r in records if r.get("kind") == "report"]
+    tokens = pd.DataFrame([r.get("tokens", {}) for r in reports], columns=TOKEN_FIELDS).fillna(0)
+    token_stats = tokens.quantile([0.5, 0.95]).set_axis(["p50", "p95"]) if len(tokens) else tokens
+    return timing, token_stats
+
+def cached_summary(path=METRICS_PATH):
+    """
+    日志文件未变化时复用上次的汇总 (Streamlit 每次交互都会重跑脚本)
+    """
+    try:
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+    if _summary_cache["key"] != key:
+        records = load_records(path)
+        _summary_cache["value"] = (len(records),) + summarize(records)
+        _summary_cache["key"] = key
+    return _summary_cache["value"]
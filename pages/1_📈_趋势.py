@@ -0,0 +1,44 @@
+import streamlit as st
+from trends import trend_cache, summarize
+
+st.set_page_config(page_title="Health Dashboard Pro · 趋势", layout="wide", page_icon="📈")
+
+st.markdown("### 📈 多日趋势")
+
+RANGES = {"30 天": 30, "90 天": 90, "1 年": 365, "全部": None}
+range_label = st.radio("时间范围", list(RANGES), horizontal=True, label_visibility="collapsed")
+daily, rolled = trend_cache.window(RANGES[range_label])
+
+if daily is None or daily.empty:
+    st.info("暂无历史数据：生成日报或配置 Google Sheet 同步后即可查看趋势。")
+    st.stop()
+
+def fmt(value, unit="", digits=0):
+    return "N/A" if value is None else f"{value:,.{digits}f}{unit}"
+
+kpi = summarize(daily, rolled)
+k1, k2, k3, k4 = st.columns(4)
+k1.metric("热量差 (7天均)", fmt(kpi["热量差"][7], " kcal"), delta=None if kpi["热量差"][28] is None else f"28天均 {kpi['热量差'][28]:+,.0f}", delta_color="off")
+k2.metric("静息心率 (7天均)", fmt(kpi["静息心率"][7], " bpm"), delta=None if kpi["静息心率"][28] is None else f"28天均 {kpi['静息心率'][28]:.0f}", delta_color="off")
+k3.metric("睡眠 (7天均)", fmt(kpi["睡眠时长"][7], " h", 1), delta=None if kpi["睡眠时长"][28] is None else f"28天均 {kpi['睡眠时长'][28]:.1f}", delta_color="off")
+k4.metric("步数 (7天均)", fmt(kpi["步数"][7]), delta=None if kpi["步数"][28] is None else f"28天均 {kpi['步数'][28]:,.0f}", delta_color="off")
+
+st.divider()
+st.markdown("##### 🔥 热量平衡")
+st.line_chart(rolled[["热量摄入_7d", "热量消耗_7d", "热量摄入_28d", "热量消耗_28d"]])
+st.bar_chart(daily["热量差"])
+
+st.markdown("##### 🍱 宏量营养 (7 天均值, g)")
+st.line_chart(rolled[["蛋白质_7d", "碳水_7d", "脂肪_7d", "膳食纤维_7d"]])
+
+c1, c2 = st.columns(2)
+with c1:
+    st.markdown("##### ❤️ 静息心率")
+    st.line_chart(rolled[["静息心率_7d", "静息心率_28d"]])
+    st.markdown("##### 😫 压力")
+    st.line_chart(rolled[["压力_7d", "压力_28d"]])
+with c2:
+    st.markdown("##### 😴 睡眠时长 (h)")
+    st.line_chart(rolled[["睡眠时长_7d", "睡眠时长_28d"]])
+    st.markdown("##### 🚶 步数")
+    st.line_chart(rolled[["步数_7d", "步数_28d"]])
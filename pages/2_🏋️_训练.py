@@ -0,0 +1,48 @@
+import streamlit as st
+from training import history_analytics
+
+st.set_page_config(page_title="Health Dashboard Pro · 训练", layout="wide", page_icon="🏋️")
+
+st.markdown("### 🏋️ 力量训练分析")
+
+result = history_analytics()
+exercises = result["exercises"]
+if exercises.empty:
+    st.info("暂无力量训练历史：生成包含训练截图的日报后即可查看。")
+    st.stop()
+
+st.markdown("##### 📋 动作汇总")
+st.dataframe(
+    exercises, width="stretch", hide_index=True,
+    column_config={
+        "总容量": st.column_config.NumberColumn(format="%.0f kg"),
+        "最佳e1RM": st.column_config.NumberColumn(format="%.1f kg"),
+        "首次训练": st.column_config.DateColumn(),
+        "最近训练": st.column_config.DateColumn(),
+        "最近PR": st.column_config.DateColumn(),
+    },
+)
+
+st.divider()
+exercise = st.selectbox("动作", exercises["动作"].tolist())
+weekly = result["weekly"]
+weekly = weekly[weekly["动作"] == exercise].set_index("周")
+
+c1, c2 = st.columns(2)
+with c1:
+    st.markdown("##### 📈 周最佳 e1RM (kg)")
+    st.line_chart(weekly["最佳e1RM"])
+with c2:
+    st.markdown("##### 📦 周总容量 (kg)")
+    st.bar_chart(weekly["总容量"])
+
+st.markdown("##### 🏆 最近 PR")
+prs = result["prs"]
+st.dataframe(
+    prs[prs["动作"] == exercise].head(10), width="stretch", hide_index=True,
+    column_config={
+        "日期": st.column_config.DateColumn(),
+        "e1RM": st.column_config.NumberColumn(format="%.1f kg"),
+        "此前最佳": st.column_config.NumberColumn(format="%.1f kg"),
+    },
+)
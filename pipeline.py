@@ -0,0 +1,253 @@
+import copy
+import hashlib
+from datetime import datetime
+import pandas as pd
+from imaging import capture_info, preprocess_files, find_duplicates
+from schema import to_number, MEALS, MEAL_NUMBERS, TOTAL_FIELDS
+import schema
+import llm
+import training
+import metrics
+
+# 报告流水线中与 UI 无关的部分：载荷构建、Schema/Prompt、结果归一化 (供 app.py 与 backfill.py 共用)
+
+
+# 1. 核心工具函数
+def normalize_data(data, target_date=None):
+    """
+    按 schema.SECTIONS 补全默认值并转换数值字段，返回新的报告 dict (不修改 data)
+    """
+    return schema.normalize(data, target_date or datetime.now())
+
+# 力量数据聚合 (写入单组容量/总容量，供同步与渲染使用)
+def prepare_strength(data):
+    strength_data = data.get('力量训练', {})
+    details = strength_data.get('动作流水明细', [])
+    workout_df = pd.DataFrame()
+    
+    total_vol = 0
+    if details:
+        workout_df = pd.DataFrame(details)
+        workout_df['单组容量'] = training.set_volumes(workout_df)
+        for d, vol in zip(details, workout_df['单组容量'].tolist()):
+            d['单组容量'] = vol
+        total_vol = float(workout_df['单组容量'].sum())
+        strength_data['总容量'] = total_vol 
+    return strength_data, total_vol, workout_df
+
+
+# 2. Payload 构建
+def report_date_for(file_infos):
+    """
+    报告日期：带时间的食物照片/健身截图中最早的一张，否则为今天
+    """
+    valid_dates = [dt for dt, file_type in file_infos
+                   if file_type in ('food', 'workout_snapshot') and dt and dt.year > 2000]
+    if valid_dates:
+        return min(valid_dates)
+    return datetime.now()
+
+def assemble_payload(uploaded_files, quick_adds, on_progress=None, file_infos=None):
+    """
+    不依赖 Streamlit 的载荷构建：返回 (user_content, report_date, sections, duplicates, payload_mb)
+    file_infos: 可选 [(拍摄时间, 类型)]，默认由 capture_info 按文件名/EXIF 解析
+    """
+    timeline_fixed = []   
+    timeline_float = []   
+
+    with metrics.span("图像预处理"):
+        processed = preprocess_files(uploaded_files, on_progress=on_progress)
+    if file_infos is None:
+        with metrics.span("拍摄时间解析"):
+            file_infos = [capture_info(file) for file in uploaded_files]
+
+    # 近似重复图片只保留一张 (食物保留最早时间)
+    with metrics.span("近似去重"):
+        duplicates = find_duplicates(processed, [t for _, t in file_infos], [dt for dt, _ in file_infos])
+
+    for idx, (file, parts) in enumerate(zip(uploaded_files, processed)):
+        if idx in duplicates:
+            continue
+        file_dt, file_type = file_infos[idx]
+        
+        # 长截图可能被切成多块，按顺序全部发送
+        item = {"type": "image", "name": file.name, "parts": parts, "file_type": file_type}
+        
+        if file_type == 'food':
+            if file_dt:
+                item['time'] = file_dt
+                timeline_fixed.append(item)
+            else:
+                item['label'] = "【未归档食物】"
+                timeline_float.append(item)
+        elif file_type == 'workout_snapshot':
+            item['label'] = "【健身详情截图】"
+            timeline_float.append(item)
+        elif file_type == 's_health':
+            item['label'] = "【SHealth汇总】"
+            timeline_float.append(item)
+                
+    payload_mb = sum(len(b) for idx, parts in enumerate(processed) if idx not in duplicates for b, _ in parts) / 1024 / 1024
+
+    report_date = report_date_for([info for idx, info in enumerate(file_infos) if idx not in duplicates])
+
+    timeline_fixed.sort(key=lambda x: x['time'])
+
+    user_content = []
+    user_content.append({"type": "text", "text": "## Part 1: 饮食照片流\n(请对以下食物照片进行精确视觉估算，包含热量, 蛋白质, 碳水, 脂肪, 膳食纤维)\n"})
+    for item in timeline_fixed:
+        t = item['time'].strftime("%H:%M")
+        if item.get('type') == 'text':
+            user_content.append({"type": "text", "text": f"- {t} {item.get('content')}"})
+        else:
+            user_content.append({"type": "text", "text": f"- {t} [食物照片] (请估算热量及宏量营养素)"})
+            for data, mime in item['parts']:
+                user_content.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{data}"}})
+
+    supplement_text = ""
+    if quick_adds.get('bcaa'): supplement_text += "- BCAA 6g (训练中摄入)\n"
+    if quick_adds.get('protein'): supplement_text += "- 蛋白粉 32g + 肌酸 3g (训练后摄入)\n"
+    if supplement_text:
+        user_content.append({
+            "type": "text", 
+            "text": f"\n## 特别指令：补剂\n【强制要求】请将以下补剂合并计算入 JSON 的 `加餐` 字段：\n{supplement_text}"
+        })
+
+    # 分段并行模式下各部分独立发送：food / s_health / workout_snapshot
+    sections = {}
+    if len(user_content) > 1:
+        sections['food'] = list(user_content)
+
+    part2_header = {"type": "text", "text": "\n## Part 2: 健康数据截图 (OCR)\n请提取包括步频、配速、压力时序等所有详细数据。\n"}
+    imgs = [x for x in timeline_float if x['file_type'] in ['workout_snapshot', 's_health']]
+    if imgs:
+        user_content.append(part2_header)
+        for img in imgs:
+            img_content = [{"type": "text", "text": f"📸 {img['label']}"}]
+            for data, mime in img['parts']:
+                img_content.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{data}"}})
+            user_content.extend(img_content)
+            sections.setdefault(img['file_type'], [part2_header]).extend(img_content)
+            
+    return user_content, report_date, sections, duplicates, payload_mb
+
+
+# 3. JSON Schema
+# 由 schema.SECTIONS 生成，字段顺序与 Sheet 列一致
+RESPONSE_SCHEMA = schema.RESPONSE_SCHEMA
+
+def build_system_prompt(schema):
+    return f"""你是一名精英营养师和数据分析师。
+        
+        【任务 1：力量训练 - 逐行提取】
+        **不要合并！** 截图有几组，数组里就有几个对象。
+        **不要乘序号！** 单组容量 = 重量 * 次数。
+        
+        【任务 2：膳食纤维与营养】
+        对食物照片进行估算时，必须进行精确视觉估算，包含热量, 蛋白质, 碳水, 脂肪, 膳食纤维数据。
+        
+        【任务 3：压力均值】
+        若无直接均值，按 (高*90 + 中*65 + 低*40 + 放松*10)/100 计算。
+
+        【输出要求】
+        严格 JSON 格式，不要多余文本。
+        {schema}
+        """
+
+
+# 4. 增量更新：只分析当天新增的照片，再与已保存的报告合并 (餐次与营养合计字段见 schema.MEALS / TOTAL_FIELDS)
+DELTA_PROMPT = """
+        【增量更新】
+        当天已有一份报告，以下为已记录的内容：
+        {state}
+
+        本次只上传了新增的图片，请只分析这些新图片：
+        - 饮食：只输出有新增食物的餐次，数值只计算新增部分 (不要重复计入已记录的食物)，`内容` 只写新增食物；
+        - 截图：输出对应板块的完整数据；
+        - 必须结合已记录内容与新增内容，重写 `本日总结`。
+        """
+
+def file_digests(uploaded_files, quick_adds=None):
+    """
+    每个上传文件内容的 sha1 (与文件名无关)；勾选的补剂记为 "quick:<名称>"，避免重复计入
+    """
+    digests = [hashlib.sha1(file.getvalue()).hexdigest() for file in uploaded_files]
+    markers = {f"quick:{name}" for name, checked in (quick_adds or {}).items() if checked}
+    return digests, markers
+
+def delta_sections(file_types):
+    """
+    增量请求 schema 中的顶层键与必须返回的键：饮食餐次可选，截图对应板块与本日总结必填
+    """
+    keys = []
+    required = [llm.SUMMARY_KEY]
+    if "food" in file_types:
+        keys += MEALS
+    for file_type in ("s_health", "workout_snapshot"):
+        if file_type in file_types:
+            keys += llm.SECTION_KEYS[file_type]
+            required += llm.SECTION_KEYS[file_type]
+    keys.append(llm.SUMMARY_KEY)
+    return keys, required
+
+def summarize_state(previous):
+    """
+    已保存报告的精简文本 (餐次、营养合计、已有截图板块)，代替完整 JSON 放入 prompt
+    """
+    lines = []
+    for meal in MEALS:
+        item = previous.get(meal) or {}
+        if item.get("内容"):
+            numbers = ", ".join(f"{k} {item.get(k, 0)}" for k in MEAL_NUMBERS)
+            lines.append(f"- {meal} {item.get('时间', 'N/A')}: {item['内容']} ({numbers})")
+    totals = previous.get("营养摄入汇总") or {}
+    lines.append("- 合计: " + ", ".join(f"{total} {totals.get(total, 0)}" for total in TOTAL_FIELDS.values()))
+    defaults = normalize_data({})
+    filled = [key for name in ("s_health", "workout_snapshot") for key in llm.SECTION_KEYS[name]
+              if previous.get(key) and previous[key] != defaults[key]]
+    lines.append("- 已有截图数据: " + ("、".join(filled) if filled else "无"))
+    return "\n        ".join(lines)
+
+def delta_messages(previous, user_content, file_types):
+    keys, _ = delta_sections(file_types)
+    system = build_system_prompt(schema.schema_text(keys)) + DELTA_PROMPT.format(state=summarize_state(previous))
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user_content},
+    ]
+
+def _add(a, b):
+    total = (to_number(a) or 0) + (to_number(b) or 0)
+    return int(total) if total == int(total) else round(total, 1)
+
+def merge_delta(previous, delta):
+    """
+    餐次累加 (内容拼接、数值相加，营养合计同步增加)；截图板块与本日总结直接覆盖
+    """
+    merged = copy.deepcopy(previous)
+    totals = merged.setdefault("营养摄入汇总", {})
+    for key, value in delta.items():
+        if key in MEALS and isinstance(value, dict):
+            old = merged.get(key) or {}
+            if not old.get("内容"):
+                merged[key] = dict(old, **value)
+            else:
+                item = dict(old)
+                if value.get("内容"):
+                    item["内容"] = f"{old['内容']}；{value['内容']}"
+                for field in MEAL_NUMBERS:
+                    item[field] = _add(old.get(field), value.get(field))
+                if old.get("时间") in (None, "", "N/A") and value.get("时间"):
+                    item["时间"] = value["时间"]
+                if value.get("点评"):
+                    item["点评"] = value["点评"]
+                merged[key] = item
+            for field, total in TOTAL_FIELDS.items():
+                totals[total] = _add(totals.get(total), value.get(field))
+        elif key == "营养摄入汇总":
+            # 合计由餐次增量推出，只采用新的盈余缺口分析
+            if isinstance(value, dict) and value.get("总盈余缺口分析"):
+                totals["总盈余缺口分析"] = value["总盈余缺口分析"]
+        else:
+            merged[key] = value
+    return merged
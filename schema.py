@@ -0,0 +1,236 @@
+import re
+import json
+
+# 日报数据结构的唯一定义：Prompt 中的 schema 文本、归一化 (校验 / 类型转换 / 补默认值)、Sheet 扁平行与历史库列
+# 都由下面的 SECTIONS 生成；导入时编译成按顺序排列的槽位表，归一化与扁平化各只需遍历一次
+
+_NUM_RE = re.compile(r"-?\d+(?:\.\d+)?")
+WEEKDAYS = "一二三四五六日"
+
+
+# 1. 数值解析 ("150" / "12 kg" / "7h 30min" / "5.2km")
+def to_number(value):
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _NUM_RE.search(str(value).replace(",", ""))
+    return float(match.group()) if match else None
+
+def to_minutes(value, default_unit=1):
+    """
+    "1h 20min" / "1小时20分钟" / "1:20" / "80min" → 分钟；纯数字按 default_unit (分钟倍数) 解释
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value) * default_unit
+    text = str(value or "").lower().replace(" ", "")
+    clock = re.fullmatch(r"(\d+):(\d{1,2})", text)
+    if clock:
+        return int(clock.group(1)) * 60 + int(clock.group(2))
+    hours = re.search(r"(\d+(?:\.\d+)?)(?:h|小时|hr)", text)
+    minutes = re.search(r"(\d+(?:\.\d+)?)(?:min|分|m(?![a-z]))", text)
+    if hours or minutes:
+        return (float(hours.group(1)) * 60 if hours else 0) + (float(minutes.group(1)) if minutes else 0)
+    number = to_number(text)
+    return None if number is None else number * default_unit
+
+def to_km(value):
+    number = to_number(value)
+    if number is None or isinstance(value, (int, float)):
+        return number
+    text = str(value).lower()
+    if "km" in text or "公里" in text:
+        return number
+    if "m" in text or "米" in text:
+        return number / 1000
+    return number
+
+
+# 2. 报告内的类型转换：num 转为数值 (整数保持 int)，其余标量统一为文本；缺失或无法解析时取默认值
+def _text(value, default):
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+def _num(value, default):
+    if isinstance(value, bool):
+        return default
+    if isinstance(value, (int, float)):
+        return value
+    number = to_number(value)
+    if number is None:
+        return default
+    return int(number) if number.is_integer() else number
+
+def _weight(value):
+    # "20kg" / "20 公斤" → 20；"10+10" (一对哑铃) 与无法解析的文本保持原样，由 training.parse_weights 处理
+    if not isinstance(value, str) or "+" in value:
+        return value
+    return _num(value, value)
+
+def _sets(value, default):
+    # 每组复制为新 dict；次数与重量转为数值，便于直接计算容量
+    if not isinstance(value, list):
+        return []
+    sets = []
+    for item in value:
+        if isinstance(item, dict):
+            item = dict(item)
+            if "次数" in item:
+                item["次数"] = _num(item["次数"], 0)
+            if "重量" in item:
+                item["重量"] = _weight(item["重量"])
+            sets.append(item)
+    return sets
+
+def format_sets(details):
+    """
+    动作明细在 Sheet 中的拼接格式，training._sets_from_text 按同一格式读回
+    """
+    if not isinstance(details, list):
+        return ""
+    return " | ".join(f"{d.get('动作名称', '')}({d.get('重量', '')}kg*{d.get('次数', '')})" for d in details)
+
+# kind → (报告内转换, 无需转换的精确类型, 历史库列解析方式, 列名单位后缀)
+# minutes / hours / km 在报告中保留原文便于展示；动作明细总是复制
+KINDS = {
+    "text": (_text, (str,), "text", ""),
+    "num": (_num, (int, float), "num", ""),
+    "minutes": (_text, (str,), "minutes", "_min"),
+    "hours": (_text, (str,), "hours", "_min"),
+    "km": (_text, (str,), "km", "_km"),
+    "sets": (_sets, (), "text", ""),
+}
+
+
+# 3. 结构定义
+class Slot:
+    """
+    一个字段槽位：kind 决定类型转换与列解析；example 为 Prompt schema 中的示例值
+    """
+    __slots__ = ("name", "kind", "default", "example", "coerce", "accept")
+
+    def __init__(self, name, kind="text", default=None, example=None):
+        self.name = name
+        self.kind = kind
+        self.default = default if default is not None else (0 if kind == "num" else "")
+        self.example = example if example is not None else (0 if kind == "num" else "...")
+        self.coerce, self.accept = KINDS[kind][:2]
+
+def _meal():
+    return [
+        Slot("时间", default="N/A", example="HH:MM"), Slot("内容"), Slot("热量", "num"), Slot("蛋白质", "num"),
+        Slot("碳水", "num"), Slot("脂肪", "num"), Slot("膳食纤维", "num"), Slot("点评"),
+    ]
+
+SET_EXAMPLE = {"动作名称": "...", "OCR原始行": "如: 1/热 10+10kg 12", "组序号": "1", "重量": 20, "次数": 12}
+
+# (板块, 来源, 字段)：来源为负责该板块的上传类型 (分段并行 / 增量更新按此拆分)，summary 由其余板块推出
+# 顺序即 Prompt 中的顺序与 Sheet 的列顺序 (日期、星期之后)
+SECTIONS = [
+    ("营养摄入汇总", "food", [
+        Slot("总热量", "num"), Slot("总蛋白质", "num"), Slot("总碳水", "num"), Slot("总脂肪", "num"),
+        Slot("总膳食纤维", "num"), Slot("总盈余缺口分析", default="暂无分析"),
+    ]),
+    ("早餐", "food", _meal()),
+    ("午餐", "food", _meal()),
+    ("晚餐", "food", _meal()),
+    ("加餐", "food", _meal()),
+    ("睡眠", "s_health", [
+        Slot("入睡时间", default="N/A", example="HH:MM"), Slot("起床时间", default="N/A", example="HH:MM"),
+        Slot("睡眠总时长", "hours", default="0h"), Slot("睡眠阶段分析", default="暂无数据"), Slot("睡眠点评"),
+    ]),
+    ("心率", "s_health", [
+        Slot("静息心率", "num"), Slot("平均静息范围", default="N/A"), Slot("全天心率范围", default="N/A"),
+        Slot("心率时序分析", default="暂无数据"), Slot("心率点评"),
+    ]),
+    ("压力", "s_health", [Slot("压力均值", "num"), Slot("压力时序分析", default="暂无数据"), Slot("压力点评")]),
+    ("全天消耗与活动", "s_health", [
+        Slot("总步数", "num"), Slot("活动时长", "minutes", default="0min"), Slot("活动卡路里", "num"),
+        Slot("燃烧的卡路里总数", "num"),
+    ]),
+    ("力量训练", "workout_snapshot", [
+        Slot("力量主题", default="休息日"), Slot("具体时间", default="N/A", example="HH:MM"),
+        Slot("训练时长", "minutes", default="0min"), Slot("动作流水明细", "sets", example=[SET_EXAMPLE]),
+        Slot("总容量", "num"), Slot("消耗估算", "num"), Slot("力量点评"),
+    ]),
+    ("有氧训练", "workout_snapshot", [
+        Slot("有氧类型", default="无"), Slot("具体时间", default="N/A", example="HH:MM"),
+        Slot("距离", "km", default="0km"), Slot("有氧时长", "minutes", default="0min"), Slot("平均心率", "num"),
+        Slot("平均步频", "num"), Slot("平均步速", default="N/A"), Slot("有氧卡路里消耗", "num"),
+    ]),
+    ("本日总结", "summary", [Slot("本日分析"), Slot("指导建议")]),
+]
+
+
+# 4. 编译产物
+def schema_text(keys=None):
+    """
+    Prompt 中的 JSON schema：每个顶层键一行 (keys 为 None 时输出全部板块)
+    """
+    dump = lambda value: json.dumps(value, ensure_ascii=False)
+    lines = [
+        f"  {dump(section)}: {{ " + ", ".join(f"{dump(s.name)}: {dump(s.example)}" for s in slots) + " }"
+        for section, _, slots in SECTIONS if keys is None or section in keys
+    ]
+    return "{\n" + ",\n".join(lines) + "\n}"
+
+RESPONSE_SCHEMA = schema_text()
+SECTION_KEYS = [section for section, _, _ in SECTIONS]
+# 板块 → 字段名 / 应为数组的字段 (响应校验用)
+SECTION_FIELDS = {section: [s.name for s in slots] for section, _, slots in SECTIONS}
+LIST_FIELDS = {section: [s.name for s in slots if s.kind == "sets"] for section, _, slots in SECTIONS}
+# 板块 → 各字段的示例值 (局部 schema，如总结请求)
+SECTION_EXAMPLES = {section: {s.name: s.example for s in slots} for section, _, slots in SECTIONS}
+# 上传类型 → 负责的板块
+SOURCE_SECTIONS = {source: [section for section, src, _ in SECTIONS if src == source] for _, source, _ in SECTIONS}
+
+# 餐次：结构与 _meal() 相同的板块；数值字段在营养摄入汇总中对应 "总" + 字段名
+MEAL_FIELDS = [s.name for s in _meal()]
+MEALS = [section for section, fields in SECTION_FIELDS.items() if fields == MEAL_FIELDS]
+MEAL_NUMBERS = [s.name for s in _meal() if s.kind == "num"]
+TOTAL_FIELDS = {name: f"总{name}" for name in MEAL_NUMBERS if f"总{name}" in SECTION_FIELDS["营养摄入汇总"]}
+
+# 归一化用：[(板块, [(字段, 无需转换的类型, 转换函数, 默认值)])]；列表默认值由 _sets 每次新建
+_NORMALIZE = [(section, [(s.name, s.accept, s.coerce, s.default) for s in slots]) for section, _, slots in SECTIONS]
+# 扁平化用：[(板块, [(字段, 是否为动作明细)])]
+_FLATTEN = [(section, [(s.name, s.kind == "sets") for s in slots]) for section, _, slots in SECTIONS]
+
+# 历史库 / Sheet 列：[(列名, 解析方式)]，时长列存为分钟、距离列存为公里
+COLUMNS = [("日期", "text"), ("星期", "text")] + [
+    (f"{section}_{s.name}{KINDS[s.kind][3]}", KINDS[s.kind][2]) for section, _, slots in SECTIONS for s in slots
+]
+
+
+def normalize(data, day):
+    """
+    单次遍历生成新的报告 dict：缺失板块/字段补默认值，数值字段转为数字，未定义的键丢弃
+    不修改 data；动作明细中的每组复制为新 dict (之后会写入单组容量)
+    """
+    record = {"日期": day.strftime("%Y-%m-%d"), "星期": f"周{WEEKDAYS[day.weekday()]}"}
+    for section, slots in _NORMALIZE:
+        values = data.get(section)
+        if not isinstance(values, dict):
+            values = {}
+        # 类型已正确的值 (常见情况) 直接取用；bool 不在精确类型内，会走转换
+        out = {}
+        for name, accept, coerce, default in slots:
+            value = values.get(name)
+            out[name] = value if value.__class__ in accept else coerce(value, default)
+        record[section] = out
+    return record
+
+def flat_row(data):
+    """
+    报告 → Sheet 扁平行，与 COLUMNS 一一对应
+    """
+    row = [data.get("日期"), data.get("星期")]
+    for section, slots in _FLATTEN:
+        values = data.get(section) or {}
+        for name, is_sets in slots:
+            row.append(format_sets(values.get(name, [])) if is_sets else values.get(name))
+    return row
@@ -0,0 +1,297 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager
+import gspread
+from google.oauth2.service_account import Credentials
+import metrics
+import schema
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Google Sheets 同步：行扁平化 + 后台批量写入队列 (本地 spool 文件保证重启不丢数据)
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+SPOOL_PATH = os.getenv("SHEET_SPOOL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "sheet_spool.jsonl"))
+# 第一行入队后等待片刻再写，合并同一时间段的多次保存
+COALESCE_SECONDS = 1.0
+BATCH_MAX = 100
+# 单次 Sheets API 调用超时，避免网络挂起卡住写入线程
+API_TIMEOUT_SECONDS = 30
+RETRY_BASE_SECONDS = 2.0
+RETRY_MAX_SECONDS = 300.0
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    跨进程互斥 (应用与 backfill 共用同一个 spool 文件)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def build_row(data):
+    """
+    归一化后的报告 → Sheet 扁平行 (列顺序见 schema.COLUMNS)
+    """
+    return schema.flat_row(data)
+
+
+class SheetWriter:
+    """
+    后台写入线程：enqueue() 立即返回，行先追加到 spool 文件，
+    线程把积压的行按日期 upsert (batch_update / append_rows)，失败按指数退避 + 抖动重试
+    """
+    def __init__(self, sheet_url, creds_dict, spool_path=SPOOL_PATH, client_factory=None):
+        self.sheet_url = sheet_url
+        self.spool_path = spool_path
+        self.last_error = ""
+        self.last_success = None
+        self._creds_dict = creds_dict
+        self._client_factory = client_factory or self._authorize
+        # 授权后的客户端 (requests 会话，连接池长连接) 在失败重试时保留，只重新打开工作表
+        self._client = None
+        self._sheet = None
+        # 日期 → 行号索引 (A 列)，首次写入时整列读取一次，之后只读新增的尾部
+        self._index = None
+        self._rows = 0
+        self._pending = self._load_spool()
+        # 需要工作表句柄的其他任务 (如历史同步)，与写入共用线程和重试
+        self._jobs = []
+        self._failures = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="sheet-writer", daemon=True)
+        self._thread.start()
+
+    # --- 凭证与工作表句柄 (授权一次，失败后重建) ---
+    def _authorize(self):
+        creds = Credentials.from_service_account_info(self._creds_dict, scopes=SCOPES)
+        client = gspread.authorize(creds)
+        client.set_timeout(API_TIMEOUT_SECONDS)
+        return client
+
+    def _worksheet(self):
+        if self._sheet is None:
+            if self._client is None:
+                self._client = self._client_factory()
+            self._sheet = self._client.open_by_url(self.sheet_url).sheet1
+        return self._sheet
+
+    # --- spool 持久化 ---
+    def _load_spool(self):
+        pending = []
+        try:
+            with open(self.spool_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("url") == self.sheet_url:
+                        pending.append(entry)
+        except OSError:
+            pass
+        return pending
+
+    def _compact_spool(self, done):
+        """
+        从 spool 中删去已写入的条目；其他进程/表格的条目原样保留 (追加与压缩都在文件锁内)
+        """
+        with _file_lock(self.spool_path + ".lock"):
+            kept = []
+            try:
+                with open(self.spool_path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            if json.loads(line).get("id") not in done:
+                                kept.append(line)
+                        except ValueError:
+                            continue
+            except OSError:
+                return
+            tmp = self.spool_path + ".tmp"
+            try:
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.writelines(kept)
+                os.replace(tmp, self.spool_path)
+            except OSError:
+                pass
+
+    def enqueue(self, row):
+        entry = {"id": uuid.uuid4().hex, "url": self.sheet_url, "row": row}
+        with self._cond:
+            with _file_lock(self.spool_path + ".lock"), open(self.spool_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending.append(entry)
+            self._cond.notify()
+        return entry["id"]
+
+    def submit(self, job):
+        """
+        job(worksheet) 在写入线程中执行，失败时与写入一样退避重试
+        """
+        with self._cond:
+            self._jobs.append(job)
+            self._cond.notify()
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def wait_idle(self, timeout=None):
+        """
+        等待队列清空 (批处理/测试使用)，返回是否已清空
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._jobs:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    # --- 后台线程 ---
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._jobs:
+                    self._cond.wait()
+            time.sleep(COALESCE_SECONDS)
+            with self._cond:
+                batch = list(self._pending[:BATCH_MAX])
+                jobs = list(self._jobs)
+            try:
+                if batch:
+                    t = time.perf_counter()
+                    self._write(batch)
+                    self._commit(batch)
+                    metrics.append_record({"time": time.time(), "kind": "sheet", "rows": len(batch),
+                                           "stages": {"Sheet 写入": round(time.perf_counter() - t, 4)}})
+                for job in jobs:
+                    job(self._worksheet())
+                    with self._cond:
+                        self._jobs.remove(job)
+                        self._cond.notify_all()
+            except Exception as e:
+                self._sheet = None
+                self._index = None
+                self._failures += 1
+                self.last_error = "找不到表格，请检查 URL 或权限" if isinstance(e, gspread.SpreadsheetNotFound) else str(e)
+                delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (self._failures - 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                continue
+            self._failures = 0
+            self.last_error = ""
+            self.last_success = time.time()
+
+    def _commit(self, batch):
+        done = {entry["id"] for entry in batch}
+        with self._cond:
+            self._pending = [entry for entry in self._pending if entry["id"] not in done]
+            self._compact_spool(done)
+            self._cond.notify_all()
+
+    # --- 按日期 upsert ---
+    def _add_dates(self, values, start):
+        for i, value in enumerate(values):
+            if value:
+                self._index[str(value)] = start + i
+        self._rows = max(self._rows, start + len(values) - 1)
+
+    def _refresh_index(self, sheet):
+        if self._index is None:
+            self._index = {}
+            self._rows = 0
+            self._add_dates(sheet.col_values(1), 1)
+        else:
+            # 其他进程/手工追加的行
+            tail = sheet.get(f"A{self._rows + 1}:A")
+            self._add_dates([r[0] if r else "" for r in tail], self._rows + 1)
+
+    def _verify_index(self, sheet, dates):
+        """
+        覆盖前确认索引行的 A 列仍是对应日期 (行可能被手工删除/排序)；不一致时整列重建
+        """
+        targets = [d for d in dates if d in self._index]
+        if not targets:
+            return
+        cells = sheet.batch_get([f"A{self._index[d]}" for d in targets])
+        if [str(c[0][0]) if c and c[0] else "" for c in cells] == targets:
+            return
+        self._index = None
+        self._refresh_index(sheet)
+
+    def _write(self, batch):
+        """
+        已存在的日期 → 一次 batch_update 覆盖对应行；新日期 → 一次 append_rows
+        同一批次内同一天多次保存只保留最后一行
+        """
+        sheet = self._worksheet()
+        self._refresh_index(sheet)
+        latest = {}
+        undated = []
+        for entry in batch:
+            date = entry["row"][0]
+            if date:
+                latest[str(date)] = entry["row"]
+            else:
+                undated.append(entry["row"])
+        self._verify_index(sheet, latest)
+
+        updates = [{"range": f"A{self._index[d]}", "values": [row]} for d, row in latest.items() if d in self._index]
+        new_dates = [d for d in latest if d not in self._index]
+        if updates:
+            sheet.batch_update(updates)
+        appends = [latest[d] for d in new_dates] + undated
+        if appends:
+            response = sheet.append_rows(appends)
+            match = re.search(r"![A-Z]+(\d+)", (response or {}).get("updates", {}).get("updatedRange", ""))
+            if match:
+                start = int(match.group(1))
+                self._add_dates(new_dates + [""] * len(undated), start)
+            else:
+                # 无法确定追加位置，下次整列重建
+                self._index = None
+
+
+def get_writer(sheet_url, creds_dict):
+    """
+    进程内每个表格共享一个写入线程 (跨 Streamlit 会话与重跑)
+    """
+    with _writers_lock:
+        writer = _writers.get(sheet_url)
+        if writer is None:
+            writer = SheetWriter(sheet_url, creds_dict)
+            _writers[sheet_url] = writer
+        return writer
@@ -0,0 +1,175 @@
+import json
+import threading
+import numpy as np
+import pandas as pd
+from history import history_store, SETS_COLUMN
+
+# 力量训练分析：动作名归一化、单组容量、e1RM、PR 与周进度 (全部为列运算，不逐组循环)
+
+# 归一化后的名称键 → 标准名
+ALIASES = {
+    "benchpress": "卧推", "bench": "卧推", "杠铃卧推": "卧推",
+    "squat": "深蹲", "杠铃深蹲": "深蹲", "backsquat": "深蹲",
+    "deadlift": "硬拉", "杠铃硬拉": "硬拉",
+    "latpulldown": "高位下拉", "pulldown": "高位下拉",
+    "ohp": "推举", "overheadpress": "推举", "shoulderpress": "推举",
+    "pullup": "引体向上",
+    "row": "划船", "barbellrow": "杠铃划船",
+}
+# e1RM (Epley) 只对该次数以内的组可靠，超出的组不参与 PR
+E1RM_MAX_REPS = 15
+WEEK_FREQ = "W-SUN"
+
+
+def clean_names(names):
+    """
+    去掉组序号前缀 ("1/")、热身标记 ("热" / "warmup")、嵌入的重量 ("10+10kg") 和末尾次数 ("12" / "x12")，
+    合并多余空白，保留原写法；清理后为空的名称返回 ""
+    """
+    return (
+        names.fillna("").astype(str)
+        .str.replace(r"^\s*\d+\s*[/.、)）]\s*", "", regex=True)
+        .str.replace(r"[(（]\s*(?:热身?组?|warm\s*-?\s*up)\s*[)）]|(?:^|(?<=\s))(?:热身?组?|warm\s*-?\s*up|wu)(?=\s|$)",
+                     "", regex=True, case=False)
+        .str.replace(r"\d+(?:\.\d+)?\s*(?:\+\s*\d+(?:\.\d+)?)?\s*(?:kg|公斤|lbs?)|\d+(?:\.\d+)?\s*\+\s*\d+(?:\.\d+)?",
+                     "", regex=True, case=False)
+        .str.replace(r"(?:\s*(?:[x×*]\s*)?\d+\s*(?:次|下|reps?)?)+\s*$", "", regex=True, case=False)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+    )
+
+def name_keys(cleaned):
+    """
+    归一化键：英文转小写，去掉空白和括号等分隔符，再按 ALIASES 合并同义名
+    """
+    return cleaned.str.lower().str.replace(r"[\s\-_·()（）\[\]【】]+", "", regex=True).replace(ALIASES)
+
+def canonical_names(names):
+    """
+    名称索引只在去重后的名称上计算；同一键的多个写法取出现最多的一个作为显示名
+    """
+    codes, uniques = pd.factorize(names.fillna("").astype(str))
+    cleaned = clean_names(pd.Series(uniques))
+    keys = name_keys(cleaned)
+    counts = pd.DataFrame({"key": keys.to_numpy()[codes], "name": cleaned.to_numpy()[codes]})
+    display = (
+        counts.value_counts().reset_index()
+        .drop_duplicates("key").set_index("key")["name"]
+    )
+    aliased = keys.isin(ALIASES.values())
+    labels = np.where(aliased, keys, keys.map(display))
+    return pd.Series(labels[codes], index=names.index)
+
+def _extract_weight(text, unit=""):
+    pair = text.str.extract(r"(\d+(?:\.\d+)?)\s*\+\s*(\d+(?:\.\d+)?)\s*" + unit).astype(float)
+    single = text.str.extract(r"(\d+(?:\.\d+)?)\s*" + unit)[0].astype(float)
+    return (pair[0] + pair[1]).fillna(single)
+
+def parse_weights(weights, raw_lines=None):
+    """
+    重量列 → 数值；"10+10" (哑铃一对) 求和；缺失时回退到 OCR 原始行中的 "10+10kg" / "20kg"
+    正则只作用于数值转换失败的行
+    """
+    values = pd.to_numeric(weights, errors="coerce")
+    missing = values.isna() & weights.notna()
+    if missing.any():
+        values[missing] = _extract_weight(weights[missing].astype(str))
+    if raw_lines is not None:
+        missing = ~(values > 0) & raw_lines.notna()
+        if missing.any():
+            values[missing] = _extract_weight(raw_lines[missing].astype(str), "kg")
+    return values.fillna(0)
+
+def _column(df, name):
+    return df[name] if name in df.columns else pd.Series(np.nan, index=df.index)
+
+def set_volumes(df):
+    """
+    单组容量 = 重量 × 次数 (无法解析的组记为 0)
+    """
+    weights = parse_weights(_column(df, "重量"), df.get("OCR原始行"))
+    reps = pd.to_numeric(_column(df, "次数"), errors="coerce").fillna(0)
+    return weights * reps
+
+def estimate_1rm(weights, reps):
+    """
+    Epley: w × (1 + r / 30)；1 次即为本身，超过 E1RM_MAX_REPS 或非正数为 NaN
+    """
+    w = np.asarray(weights, dtype=float)
+    r = np.asarray(reps, dtype=float)
+    e1rm = np.where(r <= 1, w, w * (1 + r / 30))
+    return np.where((w > 0) & (r >= 1) & (r <= E1RM_MAX_REPS), e1rm, np.nan)
+
+
+# --- 历史组数据 ---
+def _sets_from_json(days):
+    lists = [json.loads(v) if v else [] for v in days[SETS_COLUMN]]
+    lists = [[s for s in v if isinstance(s, dict)] if isinstance(v, list) else [] for v in lists]
+    lengths = np.fromiter((len(v) for v in lists), dtype=int, count=len(lists))
+    if not lengths.sum():
+        return pd.DataFrame(columns=["日期", "动作名称", "重量", "次数", "OCR原始行"])
+    sets = pd.DataFrame([s for v in lists for s in v])
+    sets["日期"] = np.repeat(days["日期"].to_numpy(), lengths)
+    return sets
+
+def _sets_from_text(days):
+    # Sheet 同步来的日期只有 "动作(20kg*12) | ..." 字符串
+    parts = days.set_index("日期")["力量训练_动作流水明细"].dropna().str.split(r"\s*\|\s*").explode()
+    parts = parts[parts.astype(bool)]
+    fields = parts.str.extract(r"^(?P<动作名称>.*)\((?P<重量>[^()]*?)kg\*(?P<次数>[^()]*?)\)$")
+    return fields.dropna(subset=["动作名称"]).reset_index()
+
+def history_sets(store):
+    days = store.frame(["力量训练_动作流水明细", SETS_COLUMN])
+    has_json = days[SETS_COLUMN].notna()
+    sets = pd.concat([_sets_from_json(days[has_json]), _sets_from_text(days[~has_json])], ignore_index=True)
+    return sets
+
+def analyze(sets):
+    """
+    返回 {"sets", "exercises", "prs", "weekly"} 四张表
+    """
+    sets = sets.copy()
+    sets["日期"] = pd.to_datetime(sets["日期"])
+    sets["动作"] = canonical_names(sets["动作名称"])
+    sets["重量"] = parse_weights(_column(sets, "重量"), sets.get("OCR原始行"))
+    sets["次数"] = pd.to_numeric(_column(sets, "次数"), errors="coerce").fillna(0)
+    sets["容量"] = sets["重量"] * sets["次数"]
+    sets["e1RM"] = estimate_1rm(sets["重量"], sets["次数"])
+    sets = sets[sets["动作"] != ""].sort_values("日期", kind="stable")
+
+    daily = sets.groupby(["动作", "日期"], as_index=False)["e1RM"].max().dropna(subset=["e1RM"])
+    previous = daily.groupby("动作")["e1RM"].cummax().groupby(daily["动作"]).shift()
+    daily["此前最佳"] = previous
+    prs = daily[daily["e1RM"] > daily["此前最佳"]].sort_values("日期", ascending=False)
+
+    weekly = (
+        sets.assign(周=sets["日期"].dt.to_period(WEEK_FREQ).dt.start_time)
+        .groupby(["动作", "周"], as_index=False)
+        .agg(组数=("容量", "size"), 总容量=("容量", "sum"), 最佳e1RM=("e1RM", "max"))
+    )
+    weekly["容量变化%"] = weekly.groupby("动作")["总容量"].pct_change() * 100
+
+    exercises = sets.groupby("动作").agg(
+        组数=("容量", "size"), 总容量=("容量", "sum"), 最佳e1RM=("e1RM", "max"),
+        首次训练=("日期", "min"), 最近训练=("日期", "max"),
+    )
+    exercises["最近PR"] = prs.groupby("动作")["日期"].max()
+    exercises = exercises.sort_values("总容量", ascending=False).reset_index()
+    return {"sets": sets, "exercises": exercises, "prs": prs, "weekly": weekly}
+
+
+_cache = {"version": None, "result": None}
+_cache_lock = threading.Lock()
+
+def history_analytics(store=None):
+    """
+    按历史库版本记忆化：库无写入时直接复用上次结果
+    """
+    store = store or history_store
+    with _cache_lock:
+        version = store.version()
+        if _cache["version"] != version:
+            _cache["result"] = analyze(history_sets(store))
+            _cache["version"] = version
+        return _cache["result"]
@@ -0,0 +1,326 @@
+import os
+import time
+import asyncio
+import functools
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+import numpy as np
+import openai
+from openai import OpenAI, DefaultHttpxClient, Timeout, DEFAULT_CONNECTION_LIMITS
+import admission
+import metrics
+from imaging import message_tokens
+
+# 进程级共享的模型调用层：长连接池 (跨会话复用 TCP/TLS)、单次调用总时限、带抖动的重试、熔断、
+# 以及主模型超过近期 p95 延迟时向备用模型发起的对冲请求；每次尝试先经过 admission 的并发与速率准入
+# 对外提供与 OpenAI 客户端相同的 client.chat.completions.create(...)，现有调用处无需改动
+
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# 单次 HTTP 读取超时 (流式时为两个 chunk 之间的最长间隔)
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+# 一次调用 (含全部重试) 的总时限
+CALL_DEADLINE = float(os.getenv("LLM_CALL_DEADLINE", "240"))
+# 空闲连接保留时间：默认 5s 太短，两次点击之间连接就被关闭
+KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "120"))
+MAX_CONNECTIONS = 20
+
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 20.0
+
+# 连续失败达到阈值后熔断，冷却期内直接失败；冷却后放行一次试探请求
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN_SECONDS = 30.0
+
+# 对冲：未配置备用模型时关闭；等待阈值默认取主模型近期延迟的 p95
+HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "")
+HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "0")) or None
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+HEDGE_WORKERS = 8
+# 异步调用 (分段并行模式) 在线程池中执行同步 create，线程数上限
+ASYNC_WORKERS = 16
+
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN_SECONDS):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._count = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened is None:
+                return "closed"
+            return "half-open" if time.monotonic() - self._opened >= self.cooldown else "open"
+
+    def allow(self):
+        """
+        返回 None 表示放行，否则为距离冷却结束的秒数
+        """
+        with self._lock:
+            if self._opened is None:
+                return None
+            remaining = self.cooldown - (time.monotonic() - self._opened)
+            if remaining > 0:
+                return remaining
+            if self._trial:
+                return 0.0
+            self._trial = True
+            return None
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self._trial or self._count >= self.failures:
+                self._opened = time.monotonic()
+                self._trial = False
+
+
+class LatencyWindow:
+    """
+    最近 LATENCY_WINDOW 次成功调用的耗时 (流式为建立连接到收到响应头)
+    """
+    def __init__(self, size=LATENCY_WINDOW):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, q, min_samples=HEDGE_MIN_SAMPLES):
+        with self._lock:
+            if len(self._values) < min_samples:
+                return None
+            return float(np.percentile(list(self._values), q))
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def retry_delay(error, attempt):
+    """
+    指数退避 × [0.5, 1.5) 抖动；429 带 Retry-After 时以其为下限
+    """
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.5)
+    response = getattr(error, "response", None)
+    try:
+        delay = max(delay, float(response.headers.get("retry-after")))
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return delay
+
+def _discard(future):
+    # 对冲中落败的一方：流式响应需关闭以归还连接
+    if future.cancelled() or future.exception() is not None:
+        return
+    close = getattr(future.result(), "close", None)
+    if callable(close):
+        close()
+
+
+class _AdmittedStream:
+    """
+    流式响应：并发槽位在流读完或关闭时才归还，最后一个 chunk 的 usage 用于修正 token 预扣
+    """
+    def __init__(self, stream, grant):
+        self._stream = stream
+        self._grant = grant
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                usage = getattr(chunk, "usage", None)
+                if usage:
+                    self._grant.settle(usage)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._grant.release()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _Completions:
+    def __init__(self, transport):
+        self._transport = transport
+
+    def create(self, **kwargs):
+        return self._transport.create(**kwargs)
+
+class _Chat:
+    def __init__(self, transport):
+        self.completions = _Completions(transport)
+
+
+class ModelTransport:
+    def __init__(self, api_key, base_url, hedge_model=HEDGE_MODEL, client=None):
+        self.base_url = base_url
+        self.hedge_model = hedge_model
+        self.client = client or OpenAI(
+            api_key=api_key, base_url=base_url, max_retries=0, timeout=request_timeout(),
+            http_client=DefaultHttpxClient(limits=connection_limits(), timeout=request_timeout()),
+        )
+        self.chat = _Chat(self)
+        self.breaker = CircuitBreaker()
+        # 流式与非流式的耗时分布差别很大，分开统计
+        self.latency = {False: LatencyWindow(), True: LatencyWindow()}
+        self.counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0}
+        self._pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+        self._async_pool = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix="llm-async")
+        self._lock = threading.Lock()
+
+    def _count(self, field):
+        with self._lock:
+            self.counters[field] += 1
+
+    def create(self, deadline=CALL_DEADLINE, **kwargs):
+        """
+        kwargs 同 chat.completions.create；stream=True 时返回流对象 (重试只覆盖建立连接阶段，读完前占用并发槽位)
+        """
+        self._count("calls")
+        end = time.monotonic() + deadline
+        tokens = message_tokens(kwargs.get("messages", []))
+        attempt = 0
+        while True:
+            wait_s = self.breaker.allow()
+            if wait_s is not None:
+                raise CircuitOpenError(f"模型服务连续失败，已暂停请求 ({wait_s:.0f}s 后重试)")
+            grant = admission.admit_llm(tokens)
+            remaining = end - time.monotonic()
+            try:
+                result = self._hedged(kwargs, min(READ_TIMEOUT, max(remaining, 1.0)))
+            except Exception as e:
+                grant.release()
+                if not is_retryable(e):
+                    raise
+                self.breaker.failure()
+                self._count("failures")
+                delay = retry_delay(e, attempt)
+                if attempt >= MAX_RETRIES or time.monotonic() + delay >= end:
+                    raise
+                attempt += 1
+                self._count("retries")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                grant.release()
+                raise
+            self.breaker.success()
+            if kwargs.get("stream"):
+                return _AdmittedStream(result, grant)
+            grant.settle(getattr(result, "usage", None))
+            grant.release()
+            return result
+
+    async def acreate(self, session=None, run=None, **kwargs):
+        """
+        异步版本：在线程池中执行 create，与同步调用共用连接池、熔断、重试与对冲
+        会话与埋点是调用方线程的线程局部变量，需显式传入 (session / run)
+        """
+        call = functools.partial(self._create_bound, session, run, kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._async_pool, call)
+
+    def _create_bound(self, session, run, kwargs):
+        admission.bind(session)
+        metrics.bind(run)
+        try:
+            return self.create(**kwargs)
+        finally:
+            admission.unbind()
+            metrics.bind(None)
+
+    def _timed(self, kwargs, timeout, window=None):
+        t = time.perf_counter()
+        result = self.client.chat.completions.create(timeout=timeout, **kwargs)
+        if window is not None:
+            window.add(time.perf_counter() - t)
+        return result
+
+    def _hedged(self, kwargs, timeout):
+        window = self.latency[bool(kwargs.get("stream"))]
+        hedge_after = HEDGE_AFTER_SECONDS or window.percentile(HEDGE_PERCENTILE)
+        if not self.hedge_model or self.hedge_model == kwargs.get("model") or hedge_after is None:
+            return self._timed(kwargs, timeout, window)
+
+        primary = self._pool.submit(self._timed, kwargs, timeout, window)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+        self._count("hedges")
+        backup = self._pool.submit(self._timed, dict(kwargs, model=self.hedge_model), timeout)
+        error = None
+        for future in as_completed([primary, backup]):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            (backup if future is primary else primary).add_done_callback(_discard)
+            if future is backup:
+                self._count("hedge_wins")
+            return result
+        raise error
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["breaker"] = self.breaker.state
+        stats["p95"] = self.latency[False].percentile(95, min_samples=1)
+        stats["stream_p95"] = self.latency[True].percentile(95, min_samples=1)
+        return stats
+
+
+def request_timeout():
+    return Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+def connection_limits():
+    # httpx.Limits 从 openai 的默认值取类型，不直接依赖 httpx
+    return type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS, keepalive_expiry=KEEPALIVE_SECONDS,
+    )
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key, base_url):
+    """
+    进程内每个 (API Key, 地址) 共享一个 ModelTransport (跨 Streamlit 会话与重跑)
+    """
+    with _clients_lock:
+        client = _clients.get((api_key, base_url))
+        if client is None:
+            client = ModelTransport(api_key, base_url)
+            _clients[(api_key, base_url)] = client
+        return client
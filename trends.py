@@ -0,0 +1,106 @@
+import threading
+import numpy as np
+import pandas as pd
+from history import history_store
+
+# 多日趋势：日度指标 + 7/28 天滚动均值，按历史库的更新时间增量刷新
+
+# 指标名 → 历史库列名
+METRICS = {
+    "热量摄入": "营养摄入汇总_总热量",
+    "热量消耗": "全天消耗与活动_燃烧的卡路里总数",
+    "蛋白质": "营养摄入汇总_总蛋白质",
+    "碳水": "营养摄入汇总_总碳水",
+    "脂肪": "营养摄入汇总_总脂肪",
+    "膳食纤维": "营养摄入汇总_总膳食纤维",
+    "静息心率": "心率_静息心率",
+    "睡眠时长": "睡眠_睡眠总时长_min",
+    "压力": "压力_压力均值",
+    "步数": "全天消耗与活动_总步数",
+}
+WINDOWS = [7, 28]
+MAX_WINDOW = max(WINDOWS)
+# 增量读取时回看的秒数：其他进程 (如 backfill) 的时间戳取在提交之前，可能略早于已读到的最大更新时间
+REFRESH_OVERLAP_SECONDS = 10.0
+
+
+def daily_metrics(rows):
+    """
+    历史库行 → 按日期索引的指标表；normalize_data 的默认值 0 视为未记录
+    """
+    df = pd.DataFrame({name: pd.to_numeric(rows[col], errors="coerce") for name, col in METRICS.items()})
+    df = df.where(df != 0)
+    df["睡眠时长"] = df["睡眠时长"] / 60
+    df["热量差"] = df["热量摄入"] - df["热量消耗"]
+    df.index = pd.DatetimeIndex(pd.to_datetime(rows["日期"]), name="日期")
+    return df.sort_index()
+
+def rolling_metrics(daily):
+    """
+    按自然日窗口 ("7D" / "28D") 计算滚动均值，缺失日期不计入分母
+    """
+    parts = [daily.rolling(f"{w}D", min_periods=1).mean().add_suffix(f"_{w}d") for w in WINDOWS]
+    return pd.concat(parts, axis=1)
+
+
+class TrendCache:
+    """
+    refresh() 只读取上次之后更新过的日期；滚动结果从最早变动日期起重算 (最多回看 28 天)，其余部分复用
+    水位前 REFRESH_OVERLAP_SECONDS 内的行会重新读取，已应用过的 (日期, 更新时间) 跳过
+    """
+    def __init__(self, store):
+        self.store = store
+        self.daily = None
+        self.rolled = None
+        self._seen = None
+        self._recent = set()
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            after = None if self._seen is None else self._seen - REFRESH_OVERLAP_SECONDS
+            rows = self.store.frame(list(METRICS.values()) + ["更新时间"], updated_after=after)
+            stamps = list(zip(rows["日期"], rows["更新时间"]))
+            rows = rows[[stamp not in self._recent for stamp in stamps]]
+            if rows.empty:
+                return False
+            self._seen = max(self._seen or 0.0, float(rows["更新时间"].max()))
+            self._recent = {(d, t) for d, t in stamps if t > self._seen - REFRESH_OVERLAP_SECONDS}
+            changed = daily_metrics(rows)
+            if self.daily is None:
+                self.daily = changed
+                self.rolled = rolling_metrics(changed)
+                return True
+            self.daily = pd.concat([self.daily.drop(changed.index, errors="ignore"), changed]).sort_index()
+            start = changed.index.min()
+            context = self.daily.loc[start - pd.Timedelta(days=MAX_WINDOW - 1):]
+            recomputed = rolling_metrics(context).loc[start:]
+            self.rolled = pd.concat([self.rolled.loc[:start - pd.Timedelta(days=1)], recomputed])
+            return True
+
+    def window(self, days=None):
+        """
+        返回 (daily, rolled) 最近 days 天的切片；days 为 None 时返回全部
+        """
+        self.refresh()
+        with self._lock:
+            if self.daily is None:
+                return None, None
+            if days is None:
+                return self.daily, self.rolled
+            start = self.daily.index.max() - pd.Timedelta(days=days - 1)
+            return self.daily.loc[start:], self.rolled.loc[start:]
+
+
+def summarize(daily, rolled):
+    """
+    最新一天的 7/28 天均值，供 KPI 卡片使用
+    """
+    latest = rolled.iloc[-1]
+    return {
+        name: {w: (None if np.isnan(latest[f"{name}_{w}d"]) else float(latest[f"{name}_{w}d"])) for w in WINDOWS}
+        for name in daily.columns
+    }
+
+
+trend_cache = TrendCache(history_store)